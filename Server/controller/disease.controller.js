@@ -40,7 +40,9 @@ const upload = multer({
     });
 
     // Send image to prediction service
-    const predictionResponse = await axios.post('http://localhost:8000/predict/', formData, {
+    // Point DISEASE_PREDICTION_URL at the gateway (.../disease-identify/predict/) when using it
+    const predictionUrl = process.env.DISEASE_PREDICTION_URL || 'http://localhost:8000/predict/';
+    const predictionResponse = await axios.post(predictionUrl, formData, {
       headers: {
         ...formData.getHeaders()
       }
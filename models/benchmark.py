@@ -0,0 +1,461 @@
+"""
+Load-test the model services and write a JSON report that can be diffed
+between commits.
+
+Each service is started with uvicorn from its own directory (or an already
+running instance is used with --url), warmed up, then driven with seeded
+synthetic workloads at every requested concurrency level:
+
+    disease-qna          random symptom sets        /predict, /predict/batch
+    breeding_model       generated cow/bull pairs   /predict, /rank
+    breed-identification synthetic JPEGs            /predict/, /predict/batch
+    disease_identify     synthetic JPEGs            /predict/, /predict/batch
+
+The report holds p50/p95/p99 latency, throughput, error counts, the server's
+peak RSS and, where the service exposes /metrics, the mean time per stage.
+
+Usage (from models/, with the trained models exported into each service):
+    python benchmark.py --output bench.json
+    python benchmark.py disease-qna breeding_model --concurrency 1,8,32 --requests 500
+    python benchmark.py disease_identify --url disease_identify=http://localhost:8080
+    python benchmark.py --compare before.json after.json
+"""
+import argparse
+import ast
+import io
+import json
+import logging
+import os
+import platform
+import random
+import re
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+logger = logging.getLogger("benchmark")
+
+MODELS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+BREEDS = ["Gir", "Sahiwal", "Red Sindhi", "Tharparkar", "Kankrej", "Ongole", "Hariana", "Jersey"]
+TEMPERAMENTS = ["Calm", "Aggressive", "Moderate"]
+SUCCESS_LEVELS = ["High", "Moderate", "Low"]
+
+
+# ---------------------------------------------------------------------------
+# Payload generators. Each returns (path, body, content_type) for one request.
+# ---------------------------------------------------------------------------
+
+def json_request(path, payload):
+    return path, json.dumps(payload).encode("utf-8"), "application/json"
+
+
+def multipart_request(path, field, files):
+    """Encode ``files`` ([(filename, bytes)]) as multipart/form-data under ``field``"""
+    boundary = uuid.uuid4().hex
+    body = io.BytesIO()
+    for filename, data in files:
+        body.write(f"--{boundary}\r\n".encode())
+        body.write(f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'.encode())
+        body.write(b"Content-Type: image/jpeg\r\n\r\n")
+        body.write(data)
+        body.write(b"\r\n")
+    body.write(f"--{boundary}--\r\n".encode())
+    return path, body.getvalue(), f"multipart/form-data; boundary={boundary}"
+
+
+def load_symptom_list():
+    """Read symptom_list from disease-qna/main.py without importing the service"""
+    with open(os.path.join(MODELS_DIR, "disease-qna", "main.py")) as f:
+        tree = ast.parse(f.read())
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(getattr(t, "id", None) == "symptom_list" for t in node.targets):
+            return ast.literal_eval(node.value)
+    raise RuntimeError("symptom_list not found in disease-qna/main.py")
+
+
+def random_symptoms(rng, symptoms):
+    return rng.sample(symptoms, rng.randint(2, 8))
+
+
+def qna_predict(rng, args):
+    return json_request("/predict", {"symptoms": random_symptoms(rng, args.symptoms)})
+
+
+def qna_batch(rng, args):
+    sets = [random_symptoms(rng, args.symptoms) for _ in range(args.batch_size)]
+    return json_request("/predict/batch", {"symptom_sets": sets})
+
+
+def random_animal(rng, prefix):
+    animal = {
+        f"{prefix}_Breed": rng.choice(BREEDS),
+        f"{prefix}_Age": rng.randint(2, 12),
+        f"{prefix}_Weight": round(rng.uniform(350, 800), 1),
+        f"{prefix}_Height": round(rng.uniform(120, 170), 1),
+        f"{prefix}_Health_Status": rng.randint(0, 1),
+        f"{prefix}_Drought_Resistance": round(rng.uniform(40, 95), 1),
+        f"{prefix}_Temperament": rng.choice(TEMPERAMENTS),
+        f"{prefix}_Fertility_Rate": round(rng.uniform(50, 95), 1),
+        f"{prefix}_Breeding_Success_Rate": round(rng.uniform(40, 95), 1),
+        f"{prefix}_Past_Breeding_Success": rng.choice(SUCCESS_LEVELS),
+        f"{prefix}_Market_Value": round(rng.uniform(20000, 120000), -2),
+        f"{prefix}_Mother_Milk_Yield": round(rng.uniform(5, 25), 1),
+    }
+    if prefix == "Cow":
+        animal["Cow_Milk_Yield"] = round(rng.uniform(4, 25), 1)
+    return animal
+
+
+def random_pair_fields(rng):
+    return {
+        "Same_Parents": int(rng.random() < 0.05),
+        "Trait_Difference": round(rng.uniform(0, 40), 1),
+        "Genetic_Diversity": round(rng.uniform(1, 10), 1),
+        "Fertility_Rate": round(rng.uniform(50, 95), 1),
+        "Breeding_Success_Rate": round(rng.uniform(40, 95), 1),
+        "Disease_Resistance_Score": round(rng.uniform(1, 10), 1),
+        "Market_Value": round(rng.uniform(20000, 120000), -2),
+        "Past_Breeding_Success": rng.choice(SUCCESS_LEVELS),
+    }
+
+
+def breeding_predict(rng, args):
+    pair = {**random_animal(rng, "Cow"), **random_animal(rng, "Bull"), **random_pair_fields(rng)}
+    return json_request("/predict", pair)
+
+
+def breeding_rank(rng, args):
+    cow = random_animal(rng, "Cow")
+    bulls = [
+        {"bull_id": f"B{i}", **random_animal(rng, "Bull"), **random_pair_fields(rng)}
+        for i in range(args.batch_size)
+    ]
+    return json_request("/rank", {"cow": cow, "bulls": bulls, "top_k": 3})
+
+
+def synthetic_jpeg(rng, size):
+    """A noisy gradient JPEG, so file sizes resemble real photos rather than flat colour"""
+    import numpy as np
+    from PIL import Image
+
+    width, height = size
+    noise = np.random.default_rng(rng.getrandbits(32))
+    gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+    pixels = gradient + noise.normal(0, 40, (height, width, 3))
+    buffer = io.BytesIO()
+    Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def image_predict(rng, args):
+    size = rng.choice(args.image_sizes)
+    return multipart_request("/predict/", "file", [("image.jpg", synthetic_jpeg(rng, size))])
+
+
+def image_batch(rng, args):
+    files = [(f"image{i}.jpg", synthetic_jpeg(rng, rng.choice(args.image_sizes))) for i in range(args.batch_size)]
+    return multipart_request("/predict/batch", "files", files)
+
+
+SERVICES = {
+    "disease-qna": {"workloads": {"predict": qna_predict, "batch": qna_batch}},
+    "breeding_model": {"workloads": {"predict": breeding_predict, "rank": breeding_rank}},
+    "breed-identification": {"workloads": {"predict": image_predict, "batch": image_batch}},
+    "disease_identify": {"workloads": {"predict": image_predict, "batch": image_batch}},
+}
+
+
+# ---------------------------------------------------------------------------
+# Server process and measurement helpers
+# ---------------------------------------------------------------------------
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def send(base_url, request, timeout=120):
+    """
+    Send one request; returns (latency_seconds, status). Status 0 means the
+    request failed outright, and a 200 whose JSON body has an "error" key
+    (how breeding_model reports failures) is counted as a 500.
+    """
+    path, body, content_type = request
+    req = urllib.request.Request(base_url + path, data=body, headers={"Content-Type": content_type})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            content = response.read()
+            status = response.status
+            if response.headers.get_content_type() == "application/json" and b'"error"' in content:
+                if "error" in json.loads(content):
+                    status = 500
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except (urllib.error.URLError, OSError):
+        status = 0
+    return time.perf_counter() - start, status
+
+
+def wait_until_ready(base_url, process=None, timeout=600):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"Service exited with code {process.returncode} during startup")
+        try:
+            with urllib.request.urlopen(base_url + "/", timeout=5):
+                return
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.5)
+    raise RuntimeError(f"Service at {base_url} was not ready after {timeout}s")
+
+
+def process_tree(pid):
+    pids = [pid]
+    for task in os.listdir(f"/proc/{pid}/task"):
+        try:
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                for child in f.read().split():
+                    pids.extend(process_tree(int(child)))
+        except OSError:
+            continue
+    return pids
+
+
+def peak_rss_mb(pid):
+    """Sum of peak RSS over the server process and its children (Linux only)"""
+    total_kb = 0
+    try:
+        for child in process_tree(pid):
+            with open(f"/proc/{child}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        total_kb += int(line.split()[1])
+    except OSError:
+        return None
+    return round(total_kb / 1024, 1)
+
+
+STAGE_PATTERN = re.compile(r'^inference_stage_seconds_(sum|count)\{stage="([^"]+)"\} (\S+)$', re.M)
+
+
+def stage_totals(base_url):
+    """Cumulative {stage: [seconds, count]} from /metrics, or None if it is not exposed"""
+    try:
+        with urllib.request.urlopen(base_url + "/metrics", timeout=10) as response:
+            text = response.read().decode("utf-8")
+    except (urllib.error.URLError, OSError):
+        return None
+    totals = {}
+    for kind, stage, value in STAGE_PATTERN.findall(text):
+        totals.setdefault(stage, [0.0, 0.0])[0 if kind == "sum" else 1] = float(value)
+    return totals
+
+
+def stage_means_ms(before, after):
+    if before is None or after is None:
+        return None
+    means = {}
+    for stage, (seconds, count) in sorted(after.items()):
+        prev_seconds, prev_count = before.get(stage, (0.0, 0.0))
+        if count > prev_count:
+            means[stage] = round((seconds - prev_seconds) / (count - prev_count) * 1000, 3)
+    return means
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(q / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def run_workload(base_url, payloads, requests, concurrency, server_pid=None):
+    before = stage_totals(base_url)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda i: send(base_url, payloads[i % len(payloads)]), range(requests)))
+    duration = time.perf_counter() - start
+
+    latencies = sorted(latency * 1000 for latency, status in results if 200 <= status < 300)
+    statuses = [status for _, status in results]
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "ok": len(latencies),
+        "rejected": statuses.count(503),
+        "errors": sum(1 for status in statuses if not 200 <= status < 300 and status != 503),
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(len(latencies) / duration, 2) if duration else None,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50), 2) if latencies else None,
+            "p95": round(percentile(latencies, 95), 2) if latencies else None,
+            "p99": round(percentile(latencies, 99), 2) if latencies else None,
+            "mean": round(sum(latencies) / len(latencies), 2) if latencies else None,
+            "max": round(latencies[-1], 2) if latencies else None,
+        },
+        "stage_mean_ms": stage_means_ms(before, stage_totals(base_url)),
+        "server_peak_rss_mb": peak_rss_mb(server_pid) if server_pid else None,
+    }
+
+
+def benchmark_service(name, args):
+    spec = SERVICES[name]
+    process = None
+    base_url = args.urls.get(name)
+    startup_seconds = None
+    if base_url is None:
+        port = free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        env = dict(os.environ, **args.env)
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+             "--log-level", "warning"],
+            cwd=os.path.join(MODELS_DIR, name), env=env
+        )
+    try:
+        wait_until_ready(base_url, process, args.startup_timeout)
+        if process is not None:
+            startup_seconds = round(time.perf_counter() - start, 2)
+            logger.info(f"{name}: ready in {startup_seconds}s")
+
+        results = {}
+        for workload, generate in spec["workloads"].items():
+            if args.workloads and workload not in args.workloads:
+                continue
+            rng = random.Random(f"{args.seed}:{name}:{workload}")
+            payloads = [generate(rng, args) for _ in range(args.distinct or args.requests)]
+            for i in range(args.warmup):
+                send(base_url, payloads[i % len(payloads)])
+
+            results[workload] = {}
+            for concurrency in args.concurrency:
+                result = run_workload(base_url, payloads, args.requests, concurrency,
+                                      process.pid if process else None)
+                results[workload][f"c{concurrency}"] = result
+                latency = result["latency_ms"]
+                logger.info(f"{name} {workload} c={concurrency}: {result['throughput_rps']} req/s, "
+                            f"p50 {latency['p50']} ms, p95 {latency['p95']} ms, p99 {latency['p99']} ms, "
+                            f"errors {result['errors']}, rejected {result['rejected']}")
+        return {"url": base_url, "startup_s": startup_seconds,
+                "server_peak_rss_mb": peak_rss_mb(process.pid) if process else None,
+                "workloads": results}
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=MODELS_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(base_path, new_path):
+    """Print throughput and latency changes between two reports"""
+    with open(base_path) as f:
+        base = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    logger.info(f"{base.get('commit')} -> {new.get('commit')}")
+
+    def change(old, value):
+        if old in (None, 0) or value is None:
+            return "n/a"
+        return f"{(value - old) / old * 100:+.1f}%"
+
+    for name, service in new["services"].items():
+        for workload, levels in service["workloads"].items():
+            for level, result in levels.items():
+                old = base["services"].get(name, {}).get("workloads", {}).get(workload, {}).get(level)
+                if old is None:
+                    continue
+                parts = [f"rps {change(old['throughput_rps'], result['throughput_rps'])}"]
+                for q in ("p50", "p95", "p99"):
+                    parts.append(f"{q} {change(old['latency_ms'][q], result['latency_ms'][q])}")
+                logger.info(f"{name} {workload} {level}: " + ", ".join(parts))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("services", nargs="*", help=f"services to benchmark (default: all of {', '.join(SERVICES)})")
+    parser.add_argument("--requests", type=int, default=200, help="requests per workload and concurrency level")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma-separated concurrency levels")
+    parser.add_argument("--workloads", default="", help="comma-separated workload names (default: all)")
+    parser.add_argument("--warmup", type=int, default=10, help="unmeasured requests before each workload")
+    parser.add_argument("--distinct", type=int, default=0,
+                        help="number of distinct payloads to cycle through (default: one per request, "
+                             "so result caches never hit)")
+    parser.add_argument("--batch-size", type=int, default=16, help="items per batch/rank request")
+    parser.add_argument("--image-sizes", default="320x240,1280x960,4000x3000",
+                        help="comma-separated WxH resolutions for synthetic JPEGs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--url", action="append", default=[], metavar="SERVICE=URL",
+                        help="benchmark an already running service instead of starting one")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="environment variable for the services started by the benchmark")
+    parser.add_argument("--startup-timeout", type=float, default=600)
+    parser.add_argument("--output", default="bench.json", help="report path")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="compare two reports and exit")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.services if name not in SERVICES]
+    if unknown:
+        parser.error(f"unknown services: {', '.join(unknown)}")
+
+    args.concurrency = [int(c) for c in args.concurrency.split(",") if c]
+    args.workloads = [w for w in args.workloads.split(",") if w]
+    args.image_sizes = [tuple(int(v) for v in size.split("x")) for size in args.image_sizes.split(",") if size]
+    args.urls = dict(item.split("=", 1) for item in args.url)
+    args.env = dict(item.split("=", 1) for item in args.env)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.compare:
+        compare(*args.compare)
+        return 0
+
+    services = args.services or list(SERVICES)
+    if "disease-qna" in services:
+        args.symptoms = load_symptom_list()
+
+    report = {
+        "commit": git_commit(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {
+            "requests": args.requests, "concurrency": args.concurrency, "warmup": args.warmup,
+            "distinct": args.distinct, "batch_size": args.batch_size,
+            "image_sizes": [f"{w}x{h}" for w, h in args.image_sizes], "seed": args.seed, "env": args.env
+        },
+        "services": {}
+    }
+    for name in services:
+        report["services"][name] = benchmark_service(name, args)
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Wrote {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,304 @@
+"""
+Inference backends for the image classifiers.
+
+INFERENCE_BACKEND selects how the loaded Keras model is executed:
+
+    compiled     traced tf.function per padded batch-size bucket (default)
+    keras        model.predict
+    tflite       TFLite interpreter, float32 weights
+    tflite-fp16  TFLite with float16 weights
+    tflite-int8  TFLite with int8 weights, activations, inputs and outputs, calibrated
+                 on the images in CALIBRATION_DIR (required)
+    onnx         ONNX Runtime (needs the tf2onnx and onnxruntime packages)
+
+A converted backend is only used after its outputs agree with the Keras model
+on a set of sample images; otherwise the service falls back to Keras. Without
+CALIBRATION_DIR that check runs on synthetic noise, which says little about
+real photos.
+
+Both image services keep an identical copy of this module. Change all copies
+together; tests/test_shared_copies.py fails when they differ.
+"""
+import io
+import logging
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("compiled", "keras", "tflite", "tflite-fp16", "tflite-int8", "onnx")
+
+
+class KerasBackend:
+    name = "keras"
+
+    def __init__(self, model):
+        self.model = model
+
+    def predict(self, batch):
+        return self.model.predict(batch, verbose=0)
+
+
+class CompiledBackend:
+    """
+    Calls the model through traced tf.functions with fixed input shapes, one
+    per batch-size bucket, skipping the data adapter and predict loop that
+    ``model.predict`` sets up on every call. Batches are zero-padded up to the
+    next bucket; batches larger than the biggest bucket run in chunks.
+    """
+
+    name = "compiled"
+
+    def __init__(self, model, buckets=(1, 2, 4, 8, 16)):
+        import tensorflow as tf
+
+        self.buckets = sorted(set(int(b) for b in buckets if int(b) > 0))
+        self.input_shape = tuple(model.input_shape[1:])
+        forward = tf.function(lambda batch: model(batch, training=False))
+        self._functions = {
+            size: forward.get_concrete_function(tf.TensorSpec((size,) + self.input_shape, tf.float32))
+            for size in self.buckets
+        }
+
+    def warmup(self):
+        """Run every bucket once so the first requests don't pay for graph setup"""
+        for size in self.buckets:
+            self._run(np.zeros((size,) + self.input_shape, dtype=np.float32))
+
+    def _run(self, batch):
+        return self._functions[len(batch)](batch).numpy()
+
+    def predict(self, batch):
+        batch = np.asarray(batch, dtype=np.float32)
+        largest = self.buckets[-1]
+        if len(batch) > largest:
+            return np.concatenate([self.predict(batch[i:i + largest]) for i in range(0, len(batch), largest)])
+
+        size = next(b for b in self.buckets if b >= len(batch))
+        if size == len(batch):
+            return self._run(batch)
+        padded = np.zeros((size,) + self.input_shape, dtype=np.float32)
+        padded[:len(batch)] = batch
+        return self._run(padded)[:len(batch)]
+
+
+class TFLiteBackend:
+    """
+    Runs a converted flatbuffer through the TFLite interpreter. Interpreters
+    are not thread-safe, so each worker thread gets its own, resized on demand
+    to the batch it is given. Fully quantized models take and return int8
+    tensors; float batches are quantized on the way in and the outputs
+    dequantized with the scales stored in the model.
+    """
+
+    def __init__(self, model_content, name="tflite", num_threads=None):
+        self.name = name
+        self.model_content = model_content
+        self.num_threads = num_threads
+        self._local = threading.local()
+
+    @classmethod
+    def from_keras(cls, model, quantization=None, samples=None, num_threads=None):
+        import tensorflow as tf
+
+        converter = tf.lite.TFLiteConverter.from_keras_model(model)
+        name = "tflite"
+        if quantization == "fp16":
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.target_spec.supported_types = [tf.float16]
+            name = "tflite-fp16"
+        elif quantization == "int8":
+            if samples is None or len(samples) == 0:
+                raise ValueError("int8 quantization needs calibration samples")
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.representative_dataset = lambda: ([samples[i:i + 1]] for i in range(len(samples)))
+            # Integer-only: conversion fails rather than leaving float ops behind
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+            converter.inference_input_type = tf.int8
+            converter.inference_output_type = tf.int8
+            name = "tflite-int8"
+        return cls(converter.convert(), name=name, num_threads=num_threads)
+
+    def _interpreter(self, shape):
+        local = self._local
+        if getattr(local, "interpreter", None) is None:
+            try:
+                from ai_edge_litert.interpreter import Interpreter
+            except ImportError:
+                import tensorflow as tf
+                Interpreter = tf.lite.Interpreter
+            local.interpreter = Interpreter(model_content=self.model_content, num_threads=self.num_threads)
+            local.input = local.interpreter.get_input_details()[0]
+            local.output = local.interpreter.get_output_details()[0]
+            local.shape = None
+        if local.shape != shape:
+            local.interpreter.resize_tensor_input(local.input["index"], shape)
+            local.interpreter.allocate_tensors()
+            local.shape = shape
+        return local.interpreter
+
+    def predict(self, batch):
+        batch = np.ascontiguousarray(batch, dtype=np.float32)
+        interpreter = self._interpreter(batch.shape)
+        local = self._local
+        interpreter.set_tensor(local.input["index"], _quantize(batch, local.input))
+        interpreter.invoke()
+        # get_tensor returns a copy, so the result survives the next invoke
+        return _dequantize(interpreter.get_tensor(local.output["index"]), local.output)
+
+
+def _quantize(batch, details):
+    if details["dtype"] == np.float32:
+        return batch
+    scale, zero_point = details["quantization"]
+    limits = np.iinfo(details["dtype"])
+    quantized = np.round(batch / scale + zero_point)
+    return np.clip(quantized, limits.min, limits.max).astype(details["dtype"])
+
+
+def _dequantize(outputs, details):
+    if details["dtype"] == np.float32:
+        return outputs
+    scale, zero_point = details["quantization"]
+    return (outputs.astype(np.float32) - zero_point) * scale
+
+
+class OnnxBackend:
+    name = "onnx"
+
+    def __init__(self, model_bytes, num_threads=None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(model_bytes, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    @classmethod
+    def from_keras(cls, model, num_threads=None):
+        import tensorflow as tf
+        import tf2onnx
+
+        signature = [tf.TensorSpec((None,) + tuple(model.input_shape[1:]), tf.float32, name="input")]
+        model_proto, _ = tf2onnx.convert.from_keras(model, input_signature=signature, opset=13)
+        return cls(model_proto.SerializeToString(), num_threads=num_threads)
+
+    def predict(self, batch):
+        return self.session.run(None, {self.input_name: np.asarray(batch, dtype=np.float32)})[0]
+
+
+def create_backend(model, kind, samples=None, num_threads=None, buckets=None):
+    """Build the backend named ``kind`` (one of BACKENDS) for a loaded Keras model"""
+    if kind == "keras":
+        return KerasBackend(model)
+    if kind == "compiled":
+        backend = CompiledBackend(model, buckets) if buckets else CompiledBackend(model)
+        backend.warmup()
+        return backend
+    if kind == "tflite":
+        return TFLiteBackend.from_keras(model, num_threads=num_threads)
+    if kind == "tflite-fp16":
+        return TFLiteBackend.from_keras(model, "fp16", num_threads=num_threads)
+    if kind == "tflite-int8":
+        return TFLiteBackend.from_keras(model, "int8", samples, num_threads=num_threads)
+    if kind == "onnx":
+        return OnnxBackend.from_keras(model, num_threads=num_threads)
+    raise ValueError(f"Unknown inference backend {kind!r}; expected one of {', '.join(BACKENDS)}")
+
+
+def calibration_samples(load_image, directory=None, limit=64, seed=0):
+    """
+    Preprocessed sample images for int8 calibration and the parity check, read
+    from ``directory`` when it has images, otherwise synthetic noise images.
+    ``load_image`` is the service's bytes -> batch-of-one function. Returns
+    ``(samples, synthetic)``.
+    """
+    blobs = []
+    if directory and os.path.isdir(directory):
+        for name in sorted(os.listdir(directory)):
+            if name.lower().endswith((".png", ".jpg", ".jpeg")):
+                with open(os.path.join(directory, name), "rb") as f:
+                    blobs.append(f.read())
+            if len(blobs) >= limit:
+                break
+    synthetic = not blobs
+    if synthetic:
+        rng = np.random.default_rng(seed)
+        for _ in range(min(limit, 16)):
+            buffer = io.BytesIO()
+            Image.fromarray(rng.integers(0, 256, (256, 256, 3), dtype=np.uint8)).save(buffer, format="PNG")
+            blobs.append(buffer.getvalue())
+    return np.concatenate([load_image(blob) for blob in blobs], axis=0), synthetic
+
+
+def check_parity(reference, candidate, samples, batch_size=8):
+    """Compare two backends on ``samples``: max absolute difference and top-1 agreement"""
+    expected = np.concatenate([reference.predict(samples[i:i + batch_size])
+                               for i in range(0, len(samples), batch_size)])
+    actual = np.concatenate([candidate.predict(samples[i:i + batch_size])
+                             for i in range(0, len(samples), batch_size)])
+    return {
+        "samples": int(len(samples)),
+        "max_abs_diff": float(np.max(np.abs(expected - actual))),
+        "top1_agreement": float(np.mean(expected.argmax(axis=1) == actual.argmax(axis=1))),
+    }
+
+
+def default_buckets(max_batch_size):
+    """Powers of two up to ``max_batch_size``, plus ``max_batch_size`` itself"""
+    buckets = [1]
+    while buckets[-1] * 2 < max_batch_size:
+        buckets.append(buckets[-1] * 2)
+    if buckets[-1] < max_batch_size:
+        buckets.append(max_batch_size)
+    return buckets
+
+
+def select_backend(model, load_image, kind=None, calibration_dir=None, min_agreement=None, num_threads=None,
+                   max_batch_size=16):
+    """
+    Build the backend named by ``kind`` (default: INFERENCE_BACKEND, else
+    compiled) and verify it against Keras. Returns ``(backend, parity)``;
+    parity is None when no conversion was checked. Any conversion error or
+    parity failure falls back to Keras. The compiled backend traces one
+    function per BATCH_BUCKETS size, by default powers of two up to
+    ``max_batch_size``.
+    """
+    kind = (kind or os.environ.get("INFERENCE_BACKEND", "compiled")).lower()
+    keras_backend = KerasBackend(model)
+    if kind == "keras":
+        return keras_backend, None
+
+    calibration_dir = calibration_dir or os.environ.get("CALIBRATION_DIR")
+    if min_agreement is None:
+        min_agreement = float(os.environ.get("BACKEND_MIN_AGREEMENT", 0.98))
+    if num_threads is None and os.environ.get("BACKEND_THREADS"):
+        num_threads = int(os.environ["BACKEND_THREADS"])
+    buckets = [int(b) for b in os.environ.get("BATCH_BUCKETS", "").split(",") if b.strip()]
+    buckets = buckets or default_buckets(max_batch_size)
+
+    try:
+        samples, synthetic = calibration_samples(load_image, calibration_dir)
+        if synthetic and kind == "tflite-int8":
+            raise ValueError("int8 ranges must be calibrated on real photos; set CALIBRATION_DIR to a directory of them")
+        if synthetic:
+            logger.warning(f"No images in CALIBRATION_DIR ({calibration_dir or 'not set'}): the {kind} backend is "
+                           f"only checked against keras on synthetic noise, which says little about real photos")
+        backend = create_backend(model, kind, samples, num_threads, buckets)
+        parity = check_parity(keras_backend, backend, samples)
+        parity["synthetic_samples"] = synthetic
+    except Exception as e:
+        logger.error(f"Could not build the {kind} backend, using keras: {e}")
+        return keras_backend, None
+
+    if parity["top1_agreement"] < min_agreement:
+        logger.error(f"{backend.name} agrees with keras on {parity['top1_agreement']:.1%} of samples "
+                     f"(minimum {min_agreement:.1%}), using keras")
+        return keras_backend, parity
+    logger.info(f"Using the {backend.name} backend: top-1 agreement {parity['top1_agreement']:.1%}, "
+                f"max abs diff {parity['max_abs_diff']:.2e} on {parity['samples']} samples")
+    return backend, parity
@@ -0,0 +1,71 @@
+"""
+One-time conversion of the cow identification model into a canonical artifact.
+
+Runs the full format-detection chain in main.load_model() once, saves the model
+it resolves as a native Keras file and writes a JSON manifest next to it. On
+startup main.py finds the manifest and loads only that artifact.
+
+Usage (from this directory, after exporting the .h5 into model/):
+    python convert_model.py
+"""
+import json
+import logging
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import main
+
+logger = logging.getLogger(__name__)
+
+
+def convert():
+    # Always resolve from the original .h5, never from a previous conversion
+    start = time.perf_counter()
+    model, load_method = main.load_model(use_canonical=False)
+    resolve_seconds = time.perf_counter() - start
+
+    if model is None or load_method == "dummy":
+        logger.error("Could not resolve a working architecture; nothing was written")
+        return 1
+
+    logger.info(f"Resolved via {load_method} in {resolve_seconds:.1f}s")
+    model.save(main.CANONICAL_MODEL_PATH)
+
+    # Check the artifact reloads and reproduces the resolved model's outputs
+    start = time.perf_counter()
+    reloaded = tf.keras.models.load_model(main.CANONICAL_MODEL_PATH, compile=False)
+    load_seconds = time.perf_counter() - start
+
+    sample = np.random.default_rng(0).uniform(-1.0, 1.0, (2,) + tuple(model.input_shape[1:]))
+    sample = sample.astype(np.float32)
+    max_diff = float(np.max(np.abs(
+        model.predict(sample, verbose=0) - reloaded.predict(sample, verbose=0)
+    )))
+    if max_diff > 1e-4:
+        logger.error(f"Reloaded model differs from the resolved model (max abs diff {max_diff})")
+        return 1
+
+    manifest = {
+        "artifact": main.CANONICAL_MODEL_PATH,
+        "source": main.MODEL_PATH,
+        "source_sha256": main.file_sha256(main.MODEL_PATH),
+        "resolved_by": load_method,
+        "input_shape": list(model.input_shape),
+        "output_shape": list(model.output_shape),
+        "total_parameters": int(model.count_params()),
+        "tensorflow_version": tf.__version__,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    }
+    with open(main.MODEL_MANIFEST_PATH, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    logger.info(f"Wrote {main.CANONICAL_MODEL_PATH} and {main.MODEL_MANIFEST_PATH}; "
+                f"canonical load takes {load_seconds:.2f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(convert())
@@ -1,14 +1,25 @@
 import os
 import io
+import json
+import asyncio
 import numpy as np
 import tensorflow as tf
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, Form, UploadFile, HTTPException, Request
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from PIL import Image
 import uvicorn
 from typing import List
 import logging
 import h5py
+import time
+
+from backends import CompiledBackend, select_backend
+from serving import (
+    AdmittedStreamingResponse, InferencePool, MicroBatcher, PoolSaturated, PredictionCache, is_archive, metrics,
+    read_archive, ModelManager, SingleFlight, file_sha256, peak_rss_mb, pool_saturated_handler
+)
+from vector_index import VectorIndex
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -28,17 +39,73 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Configure these variables
-MODEL_PATH = 'model/cowidentification.h5'
-UPLOAD_FOLDER = 'uploads'
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    """Reject bodies whose declared size is over the upload limit before they are parsed"""
+    content_length = request.headers.get("content-length")
+    limit_mb = MAX_BATCH_UPLOAD_MB if request.url.path.startswith("/predict/batch") else MAX_UPLOAD_MB
+    # Allow some room for multipart boundaries and headers
+    if content_length and content_length.isdigit() and int(content_length) > (limit_mb + 1) * 1024 * 1024:
+        return JSONResponse(
+            status_code=413,
+            content={"detail": f"File too large. Maximum size is {limit_mb:g} MB"}
+        )
+    return await call_next(request)
+
+# Bounded executor for decoding and inference; when full, requests get 503 + Retry-After
+pool = InferencePool.from_env(allow_processes=False)
+app.add_exception_handler(PoolSaturated, pool_saturated_handler)
+metrics.track_pool(pool)
+
+# Results keyed by a hash of the uploaded bytes and the model version
+prediction_cache = PredictionCache.from_env()
+metrics.track_cache(prediction_cache)
+
+# Identical uploads that arrive while one is being predicted share its result
+predict_flight = SingleFlight("breed_predict")
+metrics.track_flight(predict_flight)
+
+# Stage latency histograms, batch sizes and cache counters on /metrics
+metrics.install(app)
+
+# Configure these variables; paths resolve against this directory and MODEL_PATH can point elsewhere
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MODEL_PATH = os.environ.get("MODEL_PATH", os.path.join(BASE_DIR, 'model', 'cowidentification.h5'))
+UPLOAD_FOLDER = os.path.join(BASE_DIR, 'uploads')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+IMAGE_SIZE = (224, 224)  # Model input (width, height)
+# Uploads larger than this are rejected with 413 before they are fully read
+MAX_UPLOAD_MB = float(os.environ.get("MAX_UPLOAD_MB", 15))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# /predict/batch limits: image count and total request size (images or a zip/tar archive)
+MAX_BATCH_FILES = int(os.environ.get("MAX_BATCH_FILES", 500))
+MAX_BATCH_UPLOAD_MB = float(os.environ.get("MAX_BATCH_UPLOAD_MB", 500))
 CLASS_NAMES = []  # Replace with your model's class names if available
 
+# Micro-batching: concurrent uploads are stacked into a single forward pass
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", 16))
+BATCH_MAX_WAIT_MS = float(os.environ.get("BATCH_MAX_WAIT_MS", 5))
+
+# Identity index of enrolled animals' embeddings, memory-mapped from this directory
+INDEX_DIR = os.environ.get("EMBEDDING_INDEX_DIR", os.path.join(BASE_DIR, 'index'))
+# IVF lists scanned per identity lookup once the index is partitioned
+INDEX_NPROBE = int(os.environ.get("INDEX_NPROBE", 8))
+MAX_MATCHES = 50
+
 # Setup upload folder
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-# Global model variable
-model = None
+def canonical_paths(model_path):
+    """Canonical artifact and manifest that convert_model.py writes next to ``model_path``"""
+    stem = os.path.splitext(model_path)[0]
+    return stem + '.keras', stem + '.manifest.json'
+
+# Canonical artifact and manifest written once by convert_model.py
+CANONICAL_MODEL_PATH, MODEL_MANIFEST_PATH = canonical_paths(MODEL_PATH)
+
+# Shared by every model version; each batch runs on the version active when it is
+# dispatched and comes back tagged with it, so results are cached under that version
+batcher = None
 
 def inspect_h5_model(model_path):
     """Inspect the H5 file to understand its structure"""
@@ -69,13 +136,13 @@ def inspect_h5_model(model_path):
         logger.error(f"Error inspecting H5 file: {e}")
         return 'error'
 
-def create_flexible_model(input_shape=(224, 224, 3), num_classes=None):
+def create_flexible_model(model_path, input_shape=(224, 224, 3), num_classes=None):
     """Create a flexible model that can adapt to different architectures"""
     
     # Try to determine number of classes from the H5 file
     if num_classes is None:
         try:
-            with h5py.File(MODEL_PATH, 'r') as f:
+            with h5py.File(model_path, 'r') as f:
                 # Look for output layer information
                 if 'model_weights' in f:
                     layer_names = f.attrs.get('layer_names', [])
@@ -162,22 +229,55 @@ def create_flexible_model(input_shape=(224, 224, 3), num_classes=None):
     
     return models_to_try
 
-def load_model():
-    global model
+def load_canonical_model(model_path):
+    """
+    Load the artifact written by convert_model.py as ``(model, load method)``.
+    Returns None when there is no manifest, or when the source .h5 has changed
+    since the conversion.
+    """
+    canonical_path, manifest_path = canonical_paths(model_path)
+    if not os.path.exists(manifest_path):
+        return None
+    
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+    
+    if os.path.exists(model_path) and file_sha256(model_path) != manifest.get("source_sha256"):
+        logger.warning(f"{model_path} changed since it was converted; run convert_model.py again")
+        return None
+    
+    logger.info(f"Loading canonical model from: {canonical_path}")
+    model = tf.keras.models.load_model(canonical_path, compile=False)
+    return model, f"canonical ({manifest.get('resolved_by')})"
+
+def load_model(model_path=MODEL_PATH, use_canonical=True):
+    """Load the model at ``model_path`` as ``(model, load method)``"""
+    # Fast path: a single deterministic load of the converted artifact
+    if use_canonical:
+        canonical = load_canonical_model(model_path)
+        if canonical is not None:
+            return canonical
+    
+    model = None
+    model_load_method = None
+    
+    logger.warning("No canonical model found, falling back to format detection. "
+                   "Run convert_model.py once to speed up startup.")
     
     try:
-        logger.info(f"Loading model from: {MODEL_PATH}")
+        logger.info(f"Loading model from: {model_path}")
         
         # First, inspect the H5 file
-        h5_type = inspect_h5_model(MODEL_PATH)
+        h5_type = inspect_h5_model(model_path)
         
         # Method 1: Try loading complete model with different compile options
         for compile_option in [False, True]:
             try:
                 logger.info(f"Attempting to load full model with compile={compile_option}")
-                model = tf.keras.models.load_model(MODEL_PATH, compile=compile_option)
+                model = tf.keras.models.load_model(model_path, compile=compile_option)
+                model_load_method = f"full model, compile={compile_option}"
                 logger.info("Model loaded successfully as full model")
-                return
+                return model, model_load_method
             except Exception as e:
                 logger.warning(f"Failed to load full model with compile={compile_option}: {e}")
         
@@ -186,42 +286,45 @@ def load_model():
             try:
                 logger.info(f"Attempting to load with safe_mode={safe_mode}")
                 model = tf.keras.models.load_model(
-                    MODEL_PATH, 
+                    model_path, 
                     custom_objects=None,
                     safe_mode=safe_mode,
                     compile=False
                 )
+                model_load_method = f"full model, safe_mode={safe_mode}"
                 logger.info("Model loaded successfully with safe_mode approach")
-                return
+                return model, model_load_method
             except Exception as e:
                 logger.warning(f"Failed to load with safe_mode={safe_mode}: {e}")
         
         # Method 3: Try to load architecture from JSON if available
-        json_path = MODEL_PATH.replace('.h5', '_architecture.json')
+        json_path = model_path.replace('.h5', '_architecture.json')
         if os.path.exists(json_path):
             try:
                 logger.info("Attempting to load from JSON architecture file")
                 with open(json_path, 'r') as f:
                     model_json = f.read()
                     model = tf.keras.models.model_from_json(model_json)
-                    model.load_weights(MODEL_PATH)
+                    model.load_weights(model_path)
+                    model_load_method = "JSON architecture with H5 weights"
                     logger.info("Model loaded from JSON architecture and H5 weights")
-                    return
+                    return model, model_load_method
             except Exception as e:
                 logger.warning(f"Failed to load from JSON: {e}")
         
         # Method 4: Try flexible model creation and weight loading
         logger.info("Attempting flexible model creation and weight matching...")
         
-        models_to_try = create_flexible_model()
+        models_to_try = create_flexible_model(model_path)
         
         for model_name, candidate_model in models_to_try:
             try:
                 logger.info(f"Trying {model_name} architecture")
-                candidate_model.load_weights(MODEL_PATH)
+                candidate_model.load_weights(model_path)
                 model = candidate_model
+                model_load_method = f"{model_name} architecture with H5 weights"
                 logger.info(f"Successfully loaded weights with {model_name} architecture")
-                return
+                return model, model_load_method
             except Exception as e:
                 logger.warning(f"Failed to load weights with {model_name}: {e}")
         
@@ -232,7 +335,7 @@ def load_model():
             # Use the first model architecture as base
             model = models_to_try[0][1]
             
-            with h5py.File(MODEL_PATH, 'r') as f:
+            with h5py.File(model_path, 'r') as f:
                 if 'model_weights' in f:
                     saved_layer_names = f.attrs.get('layer_names', [])
                     model_layer_names = [layer.name for layer in model.layers]
@@ -266,8 +369,9 @@ def load_model():
                                 except Exception as e:
                                     logger.warning(f"Failed to load weights for {model_layer.name}: {e}")
                     
+                    model_load_method = "manual layer matching"
                     logger.info("Manual weight loading completed")
-                    return
+                    return model, model_load_method
                     
         except Exception as e:
             logger.error(f"Manual weight loading failed: {e}")
@@ -282,6 +386,7 @@ def load_model():
             tf.keras.layers.Dense(10, activation='softmax')
         ])
         
+        model_load_method = "dummy"
         logger.info("Dummy model created. API will run but predictions will be random.")
         
     except Exception as e:
@@ -308,56 +413,258 @@ def load_model():
         logger.info(f"Model input shape: {model.input_shape}")
         logger.info(f"Model output shape: {model.output_shape}")
         logger.info(f"Total parameters: {model.count_params()}")
+    
+    return model, model_load_method
 
 def is_valid_file(filename: str) -> bool:
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def preprocess_image(image: Image.Image, target_size=(224, 224)):
+def run_model(batch):
+    """One forward pass over a stacked batch of preprocessed images, with the version that ran it"""
+    current = models.current
+    return current.version, current.backend.predict(batch)
+
+def build_embedder(model):
+    """
+    Sub-model ending at the last GlobalAveragePooling2D layer, whose output is
+    the image embedding; without one, at the input of the classification layer.
+    """
+    pooling = [layer for layer in model.layers if isinstance(layer, tf.keras.layers.GlobalAveragePooling2D)]
+    features = pooling[-1].output if pooling else model.layers[-1].input
+    return tf.keras.Model(inputs=model.inputs, outputs=features)
+
+@metrics.time("inference_stage_seconds", stage="preprocess")
+def preprocess_image(image: Image.Image, target_size=IMAGE_SIZE, out=None):
     """
     Preprocess image for model prediction.
     Adjust this function based on how your model was trained.
+    
+    Writes into ``out`` (a float32 array of shape (1, height, width, 3)) when
+    given, so callers can decode straight into a preallocated batch.
     """
     # Resize image
     image = image.resize(target_size)
     
-    # Convert to array and add batch dimension
-    image_array = np.array(image)
-    image_array = np.expand_dims(image_array, axis=0)
+    # Copy the pixels into a float32 batch of one without intermediate arrays
+    if out is None:
+        out = np.empty((1, target_size[1], target_size[0], 3), dtype=np.float32)
+    np.copyto(out[0], np.asarray(image), casting='unsafe')
     
     # Normalize based on your training preprocessing
     # Common preprocessing options:
     
-    # Option 1: MobileNet preprocessing (scale to [-1, 1])
-    image_array = image_array.astype(np.float32)
-    image_array = image_array / 127.5 - 1.0
+    # Option 1: MobileNet preprocessing (scale to [-1, 1]), in place
+    np.divide(out, 127.5, out=out)
+    np.subtract(out, 1.0, out=out)
     
     # Option 2: Standard normalization (scale to [0, 1])
-    # image_array = image_array.astype(np.float32) / 255.0
+    # np.divide(out, 255.0, out=out)
     
     # Option 3: ImageNet preprocessing
-    # image_array = tf.keras.applications.mobilenet_v2.preprocess_input(image_array)
+    # out = tf.keras.applications.mobilenet_v2.preprocess_input(out)
     
-    return image_array
+    return out
+
+@metrics.time("inference_stage_seconds", stage="postprocess")
+def format_predictions(probabilities):
+    """Build the response body from one row of model output"""
+    if len(CLASS_NAMES) > 0:
+        # If we have class names
+        predicted_class_idx = np.argmax(probabilities)
+        predicted_class = CLASS_NAMES[predicted_class_idx]
+        confidence = float(probabilities[predicted_class_idx])
+        
+        # Get top 3 predictions
+        top_indices = probabilities.argsort()[-3:][::-1]
+        top_predictions = [
+            {
+                "class": CLASS_NAMES[idx],
+                "confidence": float(probabilities[idx])
+            }
+            for idx in top_indices
+        ]
+        
+        return {
+            "success": True,
+            "prediction": {
+                "class": predicted_class,
+                "confidence": confidence
+            },
+            "top_predictions": top_predictions
+        }
+
+    # Return raw predictions if no class names
+    # Get top 5 predictions
+    top_indices = probabilities.argsort()[-5:][::-1]
+    return {
+        "success": True,
+        "predictions": [
+            {
+                "class_id": int(idx), 
+                "confidence": float(probabilities[idx])
+            } 
+            for idx in top_indices
+        ]
+    }
+
+def load_image(contents: bytes, out=None):
+    """Decode uploaded bytes and preprocess them into a model-ready batch of one"""
+    with metrics.time("inference_stage_seconds", stage="decode"):
+        image = Image.open(io.BytesIO(contents))
+    
+        # JPEGs are decoded at a reduced scale (up to 8x) that still covers the
+        # model input, instead of decoding full 4000x3000 phone photos
+        image.draft("RGB", IMAGE_SIZE)
+    
+        # Convert grayscale to RGB if needed
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        
+        # Decode now so decode and resize show up as separate stages
+        image.load()
+        
+    return preprocess_image(image, out=out)
+
+async def read_upload(file: UploadFile, max_mb: float = MAX_UPLOAD_MB) -> bytes:
+    """Read an upload in chunks, stopping as soon as it exceeds ``max_mb``"""
+    max_bytes = int(max_mb * 1024 * 1024)
+    chunks = []
+    size = 0
+    with metrics.time("inference_stage_seconds", stage="upload_read"):
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_bytes:
+                raise HTTPException(status_code=413, detail=f"File too large. Maximum size is {max_mb:g} MB")
+            chunks.append(chunk)
+    return b"".join(chunks)
+
+async def decode_chunk(chunk):
+    """Decode a chunk of uploads in parallel into one float32 batch"""
+    batch = np.empty((len(chunk), IMAGE_SIZE[1], IMAGE_SIZE[0], 3), dtype=np.float32)
+    results = await asyncio.gather(
+        *[pool.run(load_image, contents, batch[i:i + 1]) for i, (_, _, contents) in enumerate(chunk)],
+        return_exceptions=True
+    )
+    errors = {i: str(result) for i, result in enumerate(results) if isinstance(result, Exception)}
+    return batch, errors
+
+async def stream_batch_predictions(cached_lines, pending):
+    """Yield NDJSON result lines, one model batch at a time"""
+    # The handler holds an admission slot for the whole response
+    next_decode = None
+    try:
+        if cached_lines:
+            yield "".join(cached_lines)
+        
+        chunks = [pending[i:i + BATCH_MAX_SIZE] for i in range(0, len(pending), BATCH_MAX_SIZE)]
+        if chunks:
+            next_decode = asyncio.ensure_future(decode_chunk(chunks[0]))
+        for n, chunk in enumerate(chunks):
+            batch, errors = await next_decode
+            # Decode the next chunk while this one is in the model
+            next_decode = asyncio.ensure_future(decode_chunk(chunks[n + 1])) if n + 1 < len(chunks) else None
+            
+            decoded = [i for i in range(len(chunk)) if i not in errors]
+            predictions = []
+            if decoded:
+                try:
+                    inputs = batch if len(decoded) == len(chunk) else batch[decoded]
+                    version, predictions = await batcher.submit(inputs)
+                except Exception as e:
+                    errors.update({i: f"Prediction failed: {e}" for i in decoded})
+                    decoded = []
+            
+            lines = []
+            for i, (index, filename, contents) in enumerate(chunk):
+                if i in errors:
+                    result = {"error": f"Error processing image: {errors[i]}"}
+                else:
+                    result = format_predictions(predictions[decoded.index(i)])
+                    prediction_cache.put(PredictionCache.make_key(version, contents), result)
+                lines.append(json.dumps({"index": index, "filename": filename, **result}) + "\n")
+            yield "".join(lines)
+    finally:
+        if next_decode is not None:
+            next_decode.cancel()
+
+def load_model_version(path):
+    """Model, load method and inference backend for ``path``"""
+    start = time.perf_counter()
+    model, load_method = load_model(path)
+    if model is None:
+        raise RuntimeError(f"Could not load a model from {path}")
+    if load_method == "dummy" and models.current is not None:
+        raise RuntimeError(f"No working architecture found for {path}")
+    logger.info(f"Model loaded via {load_method} in {time.perf_counter() - start:.2f}s, "
+                f"peak RSS {peak_rss_mb():.0f} MB")
+    # Traced tf.functions by default, or INFERENCE_BACKEND=keras|tflite|tflite-fp16|tflite-int8|onnx
+    backend, backend_parity = select_backend(model, load_image, max_batch_size=BATCH_MAX_SIZE)
+    # Embeddings are computed one upload at a time, so a single traced batch size
+    try:
+        embedder = CompiledBackend(build_embedder(model), buckets=(1,))
+    except Exception as e:
+        logger.error(f"Embeddings are unavailable for this model: {e}")
+        embedder = None
+    return {"model": model, "load_method": load_method, "backend": backend, "backend_parity": backend_parity,
+            "embedder": embedder}
+
+def warm_up_model_version(candidate):
+    """Check a newly loaded model takes our input size and run a batch through its backend"""
+    input_shape = tuple(candidate.model.input_shape[1:])
+    if input_shape != (IMAGE_SIZE[1], IMAGE_SIZE[0], 3):
+        raise ValueError(f"model expects inputs of shape {input_shape}, the service produces "
+                         f"{(IMAGE_SIZE[1], IMAGE_SIZE[0], 3)}")
+    outputs = candidate.backend.predict(np.zeros((1,) + input_shape, dtype=np.float32))
+    if not np.all(np.isfinite(outputs)):
+        raise ValueError("model produced non-finite outputs")
+    if candidate.embedder is not None:
+        candidate.embedder.predict(np.zeros((1,) + input_shape, dtype=np.float32))
+
+def model_files(path):
+    return [path, *canonical_paths(path)]
+
+# The active model version, replaced atomically by POST /admin/reload or, with
+# MODEL_WATCH_INTERVAL set, when the model files change
+models = ModelManager(MODEL_PATH, load_model_version, warmup=warm_up_model_version, watch_files=model_files)
+models.install(app)
+
+# Enrolled animals for /identify; embeddings are only comparable within one model version
+identity_index = VectorIndex(INDEX_DIR, nprobe=INDEX_NPROBE)
+metrics.collect("identity_index_images", "gauge", "Images enrolled in the identity index",
+                lambda: len(identity_index))
 
 @app.on_event("startup")
 async def startup_event():
     """Load the model on startup"""
+    global batcher
     try:
-        load_model()
-        if model is None:
-            logger.error("Model failed to load during startup")
-        else:
-            logger.info("Startup completed successfully")
+        models.preload()
+        batcher = MicroBatcher(run_model, BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS, executor=pool.executor, tagged=True)
+        batcher.start()
+        models.start_watching()
+        logger.info("Startup completed successfully")
     except Exception as e:
         logger.error(f"Startup failed: {e}")
         raise
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop the batching scheduler and the inference pool, and let a running IVF training finish"""
+    await models.stop_watching()
+    if batcher is not None:
+        await batcher.stop()
+    pool.shutdown()
+    await asyncio.get_running_loop().run_in_executor(None, identity_index.wait_for_training)
+
 @app.get("/")
 def read_root():
     """Root endpoint"""
     return {
         "message": "Cow Identification API",
-        "model_loaded": model is not None,
+        "model_loaded": models.current is not None,
         "tensorflow_version": tf.__version__
     }
 
@@ -365,17 +672,28 @@ def read_root():
 def health_check():
     """Health check endpoint"""
     return {
-        "status": "healthy" if model is not None else "unhealthy",
-        "model_loaded": model is not None
+        "status": "healthy" if models.current is not None else "unhealthy",
+        "model_loaded": models.current is not None
     }
 
+@app.get("/cache-stats")
+def cache_stats():
+    """Prediction cache counters and size, and requests coalesced with identical ones in flight"""
+    return {**prediction_cache.stats(), "singleflight": predict_flight.stats()}
+
 @app.get("/model-info")
 def model_info():
     """Get model information"""
-    if model is None:
+    current = models.current
+    if current is None:
         raise HTTPException(status_code=503, detail="Model not loaded")
     
+    model = current.model
     return {
+        **models.info(),
+        "load_method": current.load_method,
+        "backend": current.backend.name,
+        "backend_parity": current.backend_parity,
         "input_shape": str(model.input_shape),
         "output_shape": str(model.output_shape),
         "total_parameters": int(model.count_params()),
@@ -388,7 +706,8 @@ async def predict_image(file: UploadFile = File(...)):
     """Predict cow identification from uploaded image"""
     
     # Check if model is loaded
-    if model is None:
+    current = models.current
+    if current is None or batcher is None:
         raise HTTPException(status_code=503, detail="Model not loaded. Please check server logs.")
     
     # Validate file
@@ -401,69 +720,185 @@ async def predict_image(file: UploadFile = File(...)):
             detail="Invalid file format. Supported formats: PNG, JPG, JPEG"
         )
     
-    # Read and preprocess the image
-    try:
-        contents = await file.read()
-        image = Image.open(io.BytesIO(contents))
-        
-        # Convert grayscale to RGB if needed
-        if image.mode != "RGB":
-            image = image.convert("RGB")
+    contents = await read_upload(file)
+    
+    # Resubmitted photos are answered from the cache without touching the model
+    cache_key = PredictionCache.make_key(current.version, contents)
+    cached = await prediction_cache.get_async(cache_key)
+    if cached is not None:
+        return cached
+    
+    # Retries and duplicate uploads of a photo still being predicted wait for that prediction
+    return await predict_flight.run(cache_key, predict_contents, contents)
+
+async def predict_contents(contents: bytes):
+    """Decode and predict one upload, and cache the result under the version that predicted it"""
+    async with pool.admit():
+        try:
+            # Preprocess the image
+            processed_image = await pool.run(load_image, contents)
             
-        processed_image = preprocess_image(image)
-        
-        # Make prediction
-        predictions = model.predict(processed_image, verbose=0)
-        
-        # Process results
-        if len(CLASS_NAMES) > 0:
-            # If we have class names
-            predicted_class_idx = np.argmax(predictions[0])
-            predicted_class = CLASS_NAMES[predicted_class_idx]
-            confidence = float(predictions[0][predicted_class_idx])
+            # Make prediction as part of the next batch
+            version, predictions = await batcher.submit(processed_image)
             
-            # Get top 3 predictions
-            top_indices = predictions[0].argsort()[-3:][::-1]
-            top_predictions = [
-                {
-                    "class": CLASS_NAMES[idx],
-                    "confidence": float(predictions[0][idx])
-                }
-                for idx in top_indices
-            ]
+            result = format_predictions(predictions[0])
+            prediction_cache.put(PredictionCache.make_key(version, contents), result)
+            return result
             
-            result = {
-                "success": True,
-                "prediction": {
-                    "class": predicted_class,
-                    "confidence": confidence
-                },
-                "top_predictions": top_predictions
-            }
+        except Exception as e:
+            logger.error(f"Error processing image: {str(e)}")
+            raise HTTPException(
+                status_code=500, 
+                detail=f"Error processing image: {str(e)}"
+            )
+
+@app.post("/predict/batch")
+async def predict_batch(files: List[UploadFile] = File(...)):
+    """
+    Predict many images in one request, given as several files or zip/tar
+    archives. Results stream back as NDJSON, one line per image, as each
+    model batch completes.
+    """
+    current = models.current
+    if current is None or batcher is None:
+        raise HTTPException(status_code=503, detail="Model not loaded. Please check server logs.")
+    if not files:
+        raise HTTPException(status_code=400, detail="No file provided")
+    
+    # (index, filename, contents); contents is None for unsupported files
+    entries = []
+    for file in files:
+        if is_archive(file.filename):
+            data = await read_upload(file, MAX_BATCH_UPLOAD_MB)
+            try:
+                members = await pool.run(
+                    read_archive, file.filename, data, ALLOWED_EXTENSIONS,
+                    int(MAX_UPLOAD_MB * 1024 * 1024), MAX_BATCH_FILES
+                )
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=f"Invalid archive: {str(e)}")
+            for name, contents in members:
+                entries.append((len(entries), name, contents))
+        elif is_valid_file(file.filename):
+            entries.append((len(entries), file.filename, await read_upload(file)))
         else:
-            # Return raw predictions if no class names
-            # Get top 5 predictions
-            top_indices = predictions[0].argsort()[-5:][::-1]
-            result = {
-                "success": True,
-                "predictions": [
-                    {
-                        "class_id": int(idx), 
-                        "confidence": float(predictions[0][idx])
-                    } 
-                    for idx in top_indices
-                ]
-            }
-            
-        return result
+            entries.append((len(entries), file.filename, None))
         
+        if len(entries) > MAX_BATCH_FILES:
+            raise HTTPException(status_code=413, detail=f"Too many images. Maximum is {MAX_BATCH_FILES} per request")
+    
+    cached_lines = []
+    pending = []
+    for index, filename, contents in entries:
+        if contents is None:
+            result = {"error": "Invalid file format. Supported formats: PNG, JPG, JPEG"}
+        else:
+            result = await prediction_cache.get_async(PredictionCache.make_key(current.version, contents))
+            if result is None:
+                pending.append((index, filename, contents))
+                continue
+        cached_lines.append(json.dumps({"index": index, "filename": filename, **result}) + "\n")
+    
+    # Answer 503 before any headers go out; the response returns the slot once sent
+    pool.acquire()
+    return AdmittedStreamingResponse(pool, stream_batch_predictions(cached_lines, pending),
+                                     media_type="application/x-ndjson")
+
+async def extract_embedding(file: UploadFile, current):
+    """Embedding of one uploaded image from ``current``'s embedder"""
+    if current.embedder is None:
+        raise HTTPException(status_code=501, detail="Embeddings are not available for this model")
+    if not file:
+        raise HTTPException(status_code=400, detail="No file provided")
+    if not is_valid_file(file.filename):
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid file format. Supported formats: PNG, JPG, JPEG"
+        )
+    
+    contents = await read_upload(file)
+    try:
+        processed_image = await pool.run(load_image, contents)
+        return (await pool.run(current.embedder.predict, processed_image))[0]
     except Exception as e:
         logger.error(f"Error processing image: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
+
+def check_index_version(current):
+    """Refuse to mix embeddings of different model versions in the identity index"""
+    if not identity_index.accepts(current.version):
         raise HTTPException(
-            status_code=500, 
-            detail=f"Error processing image: {str(e)}"
+            status_code=409,
+            detail=f"The identity index holds embeddings from model {identity_index.model_version}, "
+                   f"but {current.version} is serving. Re-enroll the herd into a new EMBEDDING_INDEX_DIR."
         )
 
+@app.post("/embed")
+async def embed_image(file: UploadFile = File(...)):
+    """Penultimate-layer embedding of an uploaded image"""
+    current = models.current
+    if current is None:
+        raise HTTPException(status_code=503, detail="Model not loaded. Please check server logs.")
+    
+    async with pool.admit():
+        embedding = await extract_embedding(file, current)
+    return {
+        "success": True,
+        "model_version": current.version,
+        "dimension": len(embedding),
+        "embedding": embedding.tolist()
+    }
+
+@app.post("/enroll")
+async def enroll_animal(animal_id: str = Form(...), file: UploadFile = File(...)):
+    """Add an image of an animal to the identity index; enroll several images per animal for better matches"""
+    current = models.current
+    if current is None:
+        raise HTTPException(status_code=503, detail="Model not loaded. Please check server logs.")
+    check_index_version(current)
+    
+    async with pool.admit():
+        embedding = await extract_embedding(file, current)
+        try:
+            images = await pool.run(identity_index.add, animal_id, embedding, current.version)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "success": True,
+        "animal_id": animal_id.strip(),
+        "images": images,
+        "animals": len(identity_index.images)
+    }
+
+@app.post("/identify")
+async def identify_animal(file: UploadFile = File(...), k: int = 5, exact: bool = False):
+    """
+    The ``k`` enrolled animals that look most like the uploaded image, by
+    cosine similarity of their embeddings. ``exact`` scans every enrolled
+    image instead of the nearest IVF lists.
+    """
+    current = models.current
+    if current is None:
+        raise HTTPException(status_code=503, detail="Model not loaded. Please check server logs.")
+    if not 1 <= k <= MAX_MATCHES:
+        raise HTTPException(status_code=400, detail=f"k must be between 1 and {MAX_MATCHES}")
+    check_index_version(current)
+    
+    async with pool.admit():
+        embedding = await extract_embedding(file, current)
+        with metrics.time("inference_stage_seconds", stage="index_search"):
+            matches, search = await pool.run(identity_index.search, embedding, k, None, exact)
+    return {
+        "success": True,
+        "matches": matches,
+        "search": search
+    }
+
+@app.get("/index-stats")
+def index_stats():
+    """Enrolled animals and images in the identity index"""
+    return identity_index.stats()
+
 # For local development only
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))
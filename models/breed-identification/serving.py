@@ -0,0 +1,1024 @@
+"""
+Shared serving helpers for the model services.
+
+Every service is built from its own Docker context, so this module is kept
+as an identical copy in each service directory. Change all copies together;
+tests/test_shared_copies.py fails when they differ.
+"""
+import asyncio
+import contextlib
+import functools
+import hashlib
+import hmac
+import io
+import json
+import logging
+import math
+import os
+import sys
+import tarfile
+import threading
+import time
+import zipfile
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+from fastapi import Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+class Metrics:
+    """
+    Minimal Prometheus-style registry rendered as text on ``/metrics``.
+
+    Histograms and counters are recorded as they happen; collectors are
+    functions read at scrape time for values another object already keeps
+    (cache counters, pool occupancy). Labels are keyword arguments and should
+    only ever take a small, fixed set of values.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help = {}
+        self._types = {}
+        self._buckets = {}
+        # histograms: name -> labels -> [bucket counts..., sum, count]
+        self._histograms = defaultdict(dict)
+        self._counters = defaultdict(lambda: defaultdict(float))
+        self._gauges = defaultdict(dict)
+        self._collectors = []
+        # Objects already tracked, so a pool or cache shared by several apps is reported once
+        self._tracked = set()
+        # Across every app installed on this registry
+        self._in_flight = 0
+
+    def _declare(self, name, kind, help_text):
+        if name not in self._types:
+            self._types[name] = kind
+            self._help[name] = help_text
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self._declare(name, "histogram", help_text)
+        self._buckets[name] = tuple(buckets)
+
+    def observe(self, name, value, **labels):
+        buckets = self._buckets[name]
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms[name].get(key)
+            if series is None:
+                series = self._histograms[name][key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, name, **labels):
+        """Observe the duration of the ``with`` block into histogram ``name``"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def inc(self, name, help_text, value=1, **labels):
+        self._declare(name, "counter", help_text)
+        with self._lock:
+            self._counters[name][tuple(sorted(labels.items()))] += value
+
+    def set(self, name, help_text, value, **labels):
+        self._declare(name, "gauge", help_text)
+        with self._lock:
+            self._gauges[name][tuple(sorted(labels.items()))] = value
+
+    def collect(self, name, kind, help_text, fn):
+        """Read ``fn()`` at scrape time; it returns a number or a list of ``(labels, value)``"""
+        self._declare(name, kind, help_text)
+        self._collectors.append((name, fn))
+
+    def track_pool(self, pool):
+        if ("pool", id(pool)) in self._tracked:
+            return
+        self._tracked.add(("pool", id(pool)))
+        self.collect("inference_pool_pending", "gauge", "Requests admitted to the inference pool",
+                     lambda: pool.pending)
+        self.collect("inference_pool_max_pending", "gauge", "Admission limit of the inference pool",
+                     lambda: pool.max_pending)
+
+    def track_cache(self, cache, name="prediction_cache"):
+        if (name, id(cache)) in self._tracked:
+            return
+        self._tracked.add((name, id(cache)))
+        self.collect(f"{name}_lookups_total", "counter", "Cache lookups by result",
+                     lambda: [({"result": "hit"}, cache.hits), ({"result": "disk_hit"}, cache.disk_hits),
+                              ({"result": "miss"}, cache.misses)])
+        self.collect(f"{name}_evictions_total", "counter", "Entries evicted from the cache",
+                     lambda: cache.evictions)
+        self.collect(f"{name}_entries", "gauge", "Entries held in memory", lambda: len(cache._entries))
+
+    def track_flight(self, flight):
+        if ("flight", id(flight)) in self._tracked:
+            return
+        self._tracked.add(("flight", id(flight)))
+        self.collect("singleflight_calls_total", "counter",
+                     "Requests that ran the model (leader) or shared an identical in-flight request's result",
+                     lambda: [({"flight": flight.name, "role": "leader"}, flight.leaders),
+                              ({"flight": flight.name, "role": "coalesced"}, flight.coalesced)])
+        self.collect("singleflight_in_flight", "gauge", "Distinct computations currently running",
+                     lambda: [({"flight": flight.name}, len(flight._tasks))])
+
+    def install(self, app):
+        """Add the ``/metrics`` route and request timing/in-flight middleware to ``app``"""
+        self.histogram("http_request_duration_seconds", "Request latency by route and status")
+        self.set("http_requests_in_flight", "Requests currently being handled", self._in_flight)
+
+        @app.middleware("http")
+        async def record_request_metrics(request, call_next):
+            if request.url.path == "/metrics":
+                return await call_next(request)
+            self._in_flight += 1
+            self.set("http_requests_in_flight", "Requests currently being handled", self._in_flight)
+            start = time.perf_counter()
+            status = 500
+            try:
+                response = await call_next(request)
+                status = response.status_code
+                return response
+            finally:
+                self._in_flight -= 1
+                self.set("http_requests_in_flight", "Requests currently being handled", self._in_flight)
+                self.observe("http_request_duration_seconds", time.perf_counter() - start,
+                             method=request.method, route=route_template(request), status=str(status))
+
+        def route_template(request):
+            # Label by route template so path parameters don't create new series;
+            # older Starlette only records the matched endpoint in the scope
+            route = request.scope.get("route")
+            if route is not None:
+                return route.path
+            endpoint = request.scope.get("endpoint")
+            for candidate in app.routes:
+                if endpoint is not None and getattr(candidate, "endpoint", None) is endpoint:
+                    return candidate.path
+            return "unmatched"
+
+        @app.get("/metrics", include_in_schema=False)
+        async def metrics_endpoint():
+            return PlainTextResponse(self.render(), media_type="text/plain; version=0.0.4")
+
+    def render(self):
+        collected = defaultdict(list)
+        for name, fn in self._collectors:
+            try:
+                value = fn()
+            except Exception as e:
+                logger.warning(f"Metrics collector {name} failed: {e}")
+                continue
+            if isinstance(value, list):
+                collected[name].extend((tuple(sorted(labels.items())), v) for labels, v in value)
+            else:
+                collected[name].append(((), value))
+
+        lines = []
+        with self._lock:
+            for name in sorted(self._types):
+                lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} {self._types[name]}")
+                if name in self._histograms:
+                    buckets = self._buckets[name]
+                    for labels, series in sorted(self._histograms[name].items()):
+                        for bound, count in zip(buckets, series):
+                            lines.append(f"{name}_bucket{_format_labels(labels, [('le', f'{bound:g}')])} {count}")
+                        lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {series[-1]}")
+                        lines.append(f"{name}_sum{_format_labels(labels)} {series[-2]:.6f}")
+                        lines.append(f"{name}_count{_format_labels(labels)} {series[-1]}")
+                series = list(self._counters.get(name, {}).items()) + list(self._gauges.get(name, {}).items())
+                for labels, value in series + collected.get(name, []):
+                    lines.append(f"{name}{_format_labels(labels)} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.histogram("inference_stage_seconds", "Time spent in each request stage")
+metrics.histogram("inference_batch_size", "Rows per model forward pass", BATCH_SIZE_BUCKETS)
+
+
+class MicroBatcher:
+    """
+    Collect concurrent prediction requests into one batched forward pass.
+
+    Callers submit arrays whose first axis is the batch dimension (usually a
+    batch of one). Requests that arrive within ``max_wait_ms`` of each other
+    are concatenated, up to ``max_batch_size`` rows, passed to ``predict_fn``
+    in a single call, and the output rows are handed back to each caller.
+    The forward pass runs in ``executor`` so the event loop stays free.
+
+    With ``tagged`` set, ``predict_fn`` returns ``(tag, outputs)`` and each
+    caller gets ``(tag, rows)``; the image services tag every batch with the
+    model version that ran it.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=16, max_wait_ms=5.0, executor=None, tagged=False):
+        self.predict_fn = predict_fn
+        self.tagged = tagged
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.executor = executor
+        self._queue = None
+        self._task = None
+        self._carry = None
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    def start(self):
+        """Start the scheduling task on the running event loop"""
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.get_event_loop().create_task(self._run())
+
+    async def stop(self):
+        """Stop scheduling and fail any requests still waiting"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        waiting = [self._carry] if self._carry is not None else []
+        self._carry = None
+        while not self._queue.empty():
+            waiting.append(self._queue.get_nowait())
+        for _, future, _ in waiting:
+            if not future.done():
+                future.set_exception(RuntimeError("Batcher stopped"))
+
+    async def submit(self, inputs):
+        """Queue ``inputs`` for the next batch and wait for its output rows"""
+        if self._task is None:
+            raise RuntimeError("Batcher is not running")
+        future = asyncio.get_event_loop().create_future()
+        self._queue.put_nowait((inputs, future, time.perf_counter()))
+        return await future
+
+    def _drain(self, batch, rows):
+        """Move queued requests into ``batch`` while they fit"""
+        while rows < self.max_batch_size and not self._queue.empty():
+            item = self._queue.get_nowait()
+            if rows + len(item[0]) > self.max_batch_size:
+                # Hold it back as the first request of the next batch
+                self._carry = item
+                break
+            batch.append(item)
+            rows += len(item[0])
+        return rows
+
+    async def _run(self):
+        while True:
+            if self._carry is not None:
+                first, self._carry = self._carry, None
+            else:
+                first = await self._queue.get()
+            batch = [first]
+            rows = self._drain(batch, len(first[0]))
+            if rows < self.max_batch_size and self._carry is None and self.max_wait > 0:
+                await asyncio.sleep(self.max_wait)
+                rows = self._drain(batch, rows)
+            await self._dispatch(batch)
+
+    async def _dispatch(self, batch):
+        # Skip requests whose caller has already gone away
+        live = [(inputs, future) for inputs, future, _ in batch if not future.done()]
+        if not live:
+            return
+
+        dispatched = time.perf_counter()
+        for inputs, future, queued in batch:
+            if not future.done():
+                metrics.observe("inference_stage_seconds", dispatched - queued, stage="queue_wait")
+
+        if len(live) == 1:
+            stacked = live[0][0]
+        else:
+            stacked = np.concatenate([inputs for inputs, _ in live], axis=0)
+        metrics.observe("inference_batch_size", len(stacked))
+
+        loop = asyncio.get_event_loop()
+        try:
+            outputs = await loop.run_in_executor(self.executor, self.predict_fn, stacked)
+        except Exception as e:
+            logger.error(f"Batched prediction failed: {e}")
+            for _, future in live:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            metrics.observe("inference_stage_seconds", time.perf_counter() - dispatched, stage="model_forward")
+
+        tag = None
+        if self.tagged:
+            tag, outputs = outputs
+        offset = 0
+        for inputs, future in live:
+            count = len(inputs)
+            if not future.done():
+                rows = outputs[offset:offset + count]
+                future.set_result((tag, rows) if self.tagged else rows)
+            offset += count
+
+
+class PoolSaturated(Exception):
+    """Raised when the inference pool cannot admit another request"""
+
+    def __init__(self, retry_after):
+        super().__init__("Server is busy, please retry later")
+        self.retry_after = retry_after
+
+
+async def pool_saturated_handler(request, exc):
+    """Answer saturated requests with 503 and a Retry-After hint"""
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(int(math.ceil(exc.retry_after)))}
+    )
+
+
+class InferencePool:
+    """
+    Bounded executor for blocking inference work.
+
+    At most ``max_pending`` requests are admitted at once (running plus
+    waiting for a worker); beyond that ``admit`` raises PoolSaturated rather
+    than letting requests pile up. Threads suit TensorFlow and XGBoost, which
+    release the GIL; processes suit the pure scikit-learn models.
+    """
+
+    # Set by the gateway so every app it mounts runs on one executor
+    shared = None
+
+    def __init__(self, max_workers=None, max_pending=None, use_processes=False, retry_after=1.0):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_pending = max_pending if max_pending is not None else self.max_workers * 4
+        self.retry_after = retry_after
+        self.use_processes = use_processes
+        if use_processes:
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="inference")
+        self._pending = 0
+
+    @classmethod
+    def from_env(cls, allow_processes=True):
+        """
+        Build a pool from INFERENCE_EXECUTOR (thread|process), INFERENCE_WORKERS,
+        INFERENCE_MAX_PENDING and INFERENCE_RETRY_AFTER. Returns the shared
+        pool instead when one is set.
+        """
+        if cls.shared is not None:
+            return cls.shared
+        use_processes = os.environ.get("INFERENCE_EXECUTOR", "thread").lower() == "process"
+        if use_processes and not allow_processes:
+            logger.warning("INFERENCE_EXECUTOR=process is not supported by this service, using threads")
+            use_processes = False
+
+        max_workers = os.environ.get("INFERENCE_WORKERS")
+        max_pending = os.environ.get("INFERENCE_MAX_PENDING")
+        return cls(
+            max_workers=int(max_workers) if max_workers else None,
+            max_pending=int(max_pending) if max_pending else None,
+            use_processes=use_processes,
+            retry_after=float(os.environ.get("INFERENCE_RETRY_AFTER", 1))
+        )
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def check(self):
+        """Raise PoolSaturated if a request would not be admitted right now"""
+        if self._pending >= self.max_pending:
+            raise PoolSaturated(self.retry_after)
+
+    def acquire(self):
+        """Take an admission slot or raise PoolSaturated; pair with ``release``"""
+        self.check()
+        self._pending += 1
+
+    def release(self):
+        self._pending -= 1
+
+    @contextlib.asynccontextmanager
+    async def admit(self):
+        """Hold one admission slot for the duration of a request"""
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def run(self, fn, *args, stage=None):
+        """
+        Run ``fn(*args)`` on a worker and await its result. With ``stage`` set,
+        the time spent waiting for a worker and running ``fn`` are recorded as
+        ``queue_wait`` and ``stage`` in inference_stage_seconds.
+        """
+        loop = asyncio.get_event_loop()
+        if stage is None:
+            return await loop.run_in_executor(self.executor, functools.partial(fn, *args))
+
+        submitted = time.monotonic()
+        started, finished, result = await loop.run_in_executor(
+            self.executor, functools.partial(_timed_call, fn, *args)
+        )
+        metrics.observe("inference_stage_seconds", started - submitted, stage="queue_wait")
+        metrics.observe("inference_stage_seconds", finished - started, stage=stage)
+        return result
+
+    def recycle(self):
+        """
+        Replace process workers with fresh ones forked from the current state
+        of the service (e.g. after a model swap). Threads already share it.
+        """
+        if self.use_processes:
+            previous = self.executor
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            previous.shutdown(wait=False)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+class AdmittedStreamingResponse(StreamingResponse):
+    """
+    A StreamingResponse that holds an admission slot of ``pool`` until it has
+    been sent. The handler takes the slot with ``pool.acquire()`` before
+    building the response, so a saturated pool answers 503 before any headers
+    go out; the slot is returned however the response ends, including when
+    the client disconnects before the stream starts.
+    """
+
+    def __init__(self, pool, content, **kwargs):
+        super().__init__(content, **kwargs)
+        self.pool = pool
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.pool.release()
+
+
+def _timed_call(fn, *args):
+    # Module level so it pickles for process pools; CLOCK_MONOTONIC is system-wide on Linux
+    started = time.monotonic()
+    result = fn(*args)
+    return started, time.monotonic(), result
+
+
+ARCHIVE_EXTENSIONS = (".zip", ".tar", ".tar.gz", ".tgz")
+
+
+def is_archive(filename):
+    return filename.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def read_archive(filename, data, allowed_extensions, max_member_bytes, max_members):
+    """
+    Return ``(name, bytes)`` for every file in a zip or tar archive whose
+    extension is in ``allowed_extensions``. Raises ValueError for unreadable
+    archives and for members over the size or count limits.
+    """
+    members = []
+
+    def wanted(name, size):
+        base = os.path.basename(name)
+        if base.startswith(".") or "__MACOSX" in name:
+            return False
+        if "." not in base or base.rsplit(".", 1)[1].lower() not in allowed_extensions:
+            return False
+        if size > max_member_bytes:
+            raise ValueError(f"{name} is larger than the per-file limit")
+        if len(members) >= max_members:
+            raise ValueError(f"archive has more than {max_members} images")
+        return True
+
+    buffer = io.BytesIO(data)
+    try:
+        if filename.lower().endswith(".zip"):
+            with zipfile.ZipFile(buffer) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir() and wanted(info.filename, info.file_size):
+                        members.append((info.filename, archive.read(info)))
+        else:
+            with tarfile.open(fileobj=buffer, mode="r:*") as archive:
+                for info in archive:
+                    if info.isfile() and wanted(info.name, info.size):
+                        members.append((info.name, archive.extractfile(info).read()))
+    except (zipfile.BadZipFile, tarfile.TarError) as e:
+        raise ValueError(f"could not read {filename}: {e}")
+    return members
+
+
+def file_sha256(path):
+    """Hex SHA-256 of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def resolve_model_version(path):
+    """
+    Version tag for the model at ``path``: MODEL_VERSION if set, otherwise the
+    file name plus a short hash of its contents.
+    """
+    if os.environ.get("MODEL_VERSION"):
+        return os.environ["MODEL_VERSION"]
+    name = os.path.basename(path)
+    try:
+        return f"{name}@{file_sha256(path)[:12]}"
+    except OSError:
+        return name
+
+
+class ReloadInProgress(Exception):
+    """Raised when a model reload is requested while another one is running"""
+
+
+class ModelVersion:
+    """
+    One loaded model version. ``model`` and whatever else the service's loader
+    returned (backends, compiled pipelines, caches) are attributes, so a
+    request that reads ``ModelManager.current`` once sees a consistent set.
+    """
+
+    def __init__(self, path, version, **parts):
+        self.path = path
+        self.version = version
+        self.loaded_at = time.time()
+        self.__dict__.update(parts)
+
+
+class ModelManager:
+    """
+    Holds the model version a service is serving and swaps in new ones without
+    a restart.
+
+    ``loader(path)`` returns a dict of parts (at least ``model``) and
+    ``warmup(version)`` runs a few dummy inputs through them, raising if the
+    model is unusable. A reload does both on a background thread while the
+    current version keeps serving, then replaces ``current`` in one assignment;
+    a reload that fails leaves the old version in place. ``on_swap(new, old)``
+    runs after each swap. ``watch_files(path)`` lists the files whose changes
+    trigger a reload when watching.
+
+    With ``lazy`` set (the gateway does this) ``preload`` does nothing and the
+    model is loaded on first use instead; ``unload`` drops it again.
+    """
+
+    lazy = False
+
+    def __init__(self, path, loader, warmup=None, on_swap=None, watch_files=None):
+        self.path = path
+        self.loader = loader
+        self.warmup = warmup
+        self.on_swap = on_swap
+        self.watch_files = watch_files or (lambda path: [path])
+        self.current = None
+        self.reloads = 0
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._signature = None
+        self._watch_task = None
+
+    @property
+    def version(self):
+        current = self.current
+        return current.version if current is not None else None
+
+    def _file_signature(self, path):
+        signature = []
+        for name in self.watch_files(path):
+            try:
+                stat = os.stat(name)
+            except OSError:
+                continue
+            signature.append((name, stat.st_mtime_ns, stat.st_size))
+        return tuple(signature)
+
+    def load(self, path=None):
+        """Load, warm up and activate ``path`` (default: the current path); returns the new version"""
+        path = path or self.path
+        if not self._lock.acquire(blocking=False):
+            raise ReloadInProgress("A model reload is already in progress")
+        try:
+            signature = self._file_signature(path)
+            start = time.perf_counter()
+            try:
+                candidate = ModelVersion(path, resolve_model_version(path), **self.loader(path))
+                if self.warmup is not None:
+                    self.warmup(candidate)
+            except Exception as e:
+                self.last_error = f"{path}: {e}"
+                metrics.inc("model_reloads_total", "Model loads by result", result="failed")
+                raise
+
+            previous, self.current = self.current, candidate
+            self.path = path
+            self._signature = signature
+            self.last_error = None
+            if previous is not None:
+                self.reloads += 1
+            metrics.inc("model_reloads_total", "Model loads by result", result="ok")
+            metrics.set("model_load_seconds", "Time taken to load and warm up the current model version",
+                        time.perf_counter() - start)
+            logger.info(f"Serving model {candidate.version} from {path}")
+            if self.on_swap is not None:
+                self.on_swap(candidate, previous)
+            return candidate.version
+        finally:
+            self._lock.release()
+
+    def preload(self):
+        """Load the model at startup, unless loading is deferred to first use"""
+        if not self.lazy:
+            self.load()
+
+    def unload(self):
+        """Stop serving the current version so its memory can be freed; ``load`` brings it back"""
+        if not self._lock.acquire(blocking=False):
+            raise ReloadInProgress("A model reload is in progress")
+        try:
+            previous, self.current = self.current, None
+        finally:
+            self._lock.release()
+        if previous is not None:
+            logger.info(f"Unloaded model {previous.version}")
+
+    async def reload(self, path=None):
+        """``load`` on a background thread, so requests keep being served meanwhile"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.load, path)
+
+    def info(self):
+        current = self.current
+        return {
+            "version": current.version if current is not None else None,
+            "path": current.path if current is not None else self.path,
+            "loaded_at": current.loaded_at if current is not None else None,
+            "reloads": self.reloads,
+            "last_reload_error": self.last_error,
+            "watching": self._watch_task is not None,
+        }
+
+    def start_watching(self, interval=None):
+        """
+        Reload whenever the model files change, polling every ``interval``
+        seconds (default MODEL_WATCH_INTERVAL; 0 disables watching). A change
+        is only picked up once the files look the same on two polls in a row,
+        so a file still being copied is not loaded half-written.
+        """
+        if interval is None:
+            interval = float(os.environ.get("MODEL_WATCH_INTERVAL", 0))
+        if interval > 0 and self._watch_task is None:
+            self._watch_task = asyncio.get_event_loop().create_task(self._watch(interval))
+
+    async def stop_watching(self):
+        if self._watch_task is None:
+            return
+        self._watch_task.cancel()
+        try:
+            await self._watch_task
+        except asyncio.CancelledError:
+            pass
+        self._watch_task = None
+
+    async def _watch(self, interval):
+        pending = None
+        while True:
+            await asyncio.sleep(interval)
+            signature = self._file_signature(self.path)
+            # An unloaded lazy model picks up the new files when it is next used
+            if self.lazy and self.current is None:
+                continue
+            if not signature or signature == self._signature:
+                pending = None
+                continue
+            if signature != pending:
+                pending = signature
+                continue
+            pending = None
+            try:
+                await self.reload()
+            except Exception as e:
+                logger.error(f"Reloading {self.path} failed, still serving {self.version}: {e}")
+                # Wait for the files to change again instead of retrying the same ones
+                self._signature = signature
+
+    def install(self, app):
+        """
+        Add ``POST /admin/reload`` (optionally ``?path=``) and an X-Model-Version
+        header on every response. The endpoint is only enabled when ADMIN_TOKEN
+        is set, and then requires it in the X-Admin-Token header.
+        """
+
+        @app.middleware("http")
+        async def add_model_version(request, call_next):
+            response = await call_next(request)
+            version = self.version
+            if version is not None:
+                response.headers["X-Model-Version"] = version
+            return response
+
+        @app.post("/admin/reload", include_in_schema=False)
+        async def reload_model(request: Request):
+            token = os.environ.get("ADMIN_TOKEN")
+            if not token:
+                return JSONResponse(status_code=403, content={"detail": "Set ADMIN_TOKEN to enable model reloads"})
+            if not hmac.compare_digest(request.headers.get("x-admin-token", ""), token):
+                return JSONResponse(status_code=401, content={"detail": "Invalid admin token"})
+
+            path = request.query_params.get("path") or None
+            if path is not None and not os.path.exists(path):
+                return JSONResponse(status_code=400, content={"detail": f"{path} does not exist"})
+            previous = self.version
+            try:
+                await self.reload(path)
+            except ReloadInProgress as e:
+                return JSONResponse(status_code=409, content={"detail": str(e)})
+            except Exception as e:
+                return JSONResponse(status_code=500, content={"detail": f"Reload failed, still serving "
+                                                                        f"{previous}: {e}"})
+            return {"previous_version": previous, **self.info()}
+
+
+def rss_mb():
+    """Current resident set size of this process in MB (peak RSS where /proc is unavailable)"""
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB (0 where unsupported)"""
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class PredictionCache:
+    """
+    LRU cache of JSON-serializable prediction results with a TTL and a memory
+    budget in MB. With ``disk_dir`` set, entries are also written to disk and
+    read back on a memory miss, so the cache survives restarts; the disk tier
+    has its own MB budget and drops its oldest files first.
+    """
+
+    # Set by the gateway so the apps it mounts share one memory budget; keys carry the model version
+    shared = None
+
+    def __init__(self, max_mb=64, ttl_seconds=3600, disk_dir=None, disk_max_mb=512):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.ttl = ttl_seconds
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = int(disk_max_mb * 1024 * 1024)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._disk_bytes = 0
+        # Disk writes run in order on one background thread, off the event loop
+        self._disk_writer = None
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._disk_bytes = sum(size for _, size, _ in self._disk_files())
+            self._disk_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cache-disk")
+
+    @classmethod
+    def from_env(cls):
+        """
+        Build a cache from PREDICTION_CACHE_MB (0 disables it), PREDICTION_CACHE_TTL,
+        PREDICTION_CACHE_DIR and PREDICTION_CACHE_DISK_MB. Returns the shared
+        cache instead when one is set.
+        """
+        if cls.shared is not None:
+            return cls.shared
+        return cls(
+            max_mb=float(os.environ.get("PREDICTION_CACHE_MB", 64)),
+            ttl_seconds=float(os.environ.get("PREDICTION_CACHE_TTL", 3600)),
+            disk_dir=os.environ.get("PREDICTION_CACHE_DIR") or None,
+            disk_max_mb=float(os.environ.get("PREDICTION_CACHE_DISK_MB", 512))
+        )
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @staticmethod
+    def make_key(*parts):
+        """Hash the given str/bytes parts into a cache key"""
+        digest = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode("utf-8")
+            digest.update(len(part).to_bytes(8, "little"))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Look ``key`` up in memory, then on disk. Request handlers use ``get_async``"""
+        if not self.enabled:
+            return None
+        value = self._get_memory(key)
+        if value is not None:
+            return value
+        return self._disk_result(key, self._read_disk(key))
+
+    async def get_async(self, key):
+        """``get`` with the disk read on a worker thread, so it doesn't block the event loop"""
+        if not self.enabled:
+            return None
+        value = self._get_memory(key)
+        if value is not None:
+            return value
+        disk_value = await asyncio.to_thread(self._read_disk, key) if self.disk_dir else None
+        return self._disk_result(key, disk_value)
+
+    def put(self, key, value):
+        """Store ``value`` in memory now and on disk in the background"""
+        if not self.enabled:
+            return
+        self._store(key, value)
+        if self._disk_writer is not None:
+            self._disk_writer.submit(self._write_disk, key, value)
+
+    def _get_memory(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, _, value = entry
+            if expires_at > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self._remove(key)
+        return None
+
+    def _disk_result(self, key, value):
+        if value is None:
+            self.misses += 1
+            return None
+        self.disk_hits += 1
+        self._store(key, value)
+        return value
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "size_mb": round(self._bytes / (1024 * 1024), 3),
+            "max_mb": round(self.max_bytes / (1024 * 1024), 3),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0
+        }
+
+    def _store(self, key, value):
+        size = len(json.dumps(value))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.time() + self.ttl, size, value)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            if os.path.getmtime(path) + self.ttl <= time.time():
+                os.remove(path)
+                return None
+            with open(path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_disk(self, key, value):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        try:
+            # Write then rename so readers never see a partial file
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(value, f)
+            os.replace(tmp_path, path)
+            self._disk_bytes += os.path.getsize(path)
+        except OSError as e:
+            logger.warning(f"Could not write cache entry to disk: {e}")
+            return
+        if self._disk_bytes > self.disk_max_bytes:
+            self._trim_disk()
+
+    def _disk_files(self):
+        files = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        return files
+
+    def _trim_disk(self):
+        # Drop the oldest files until the disk tier is back to 90% of its budget
+        files = sorted(self._disk_files())
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= self.disk_max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        self._disk_bytes = total
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent requests for the same input. The first request for a
+    key starts ``fn(*args)`` as a task of its own; identical requests arriving
+    while it runs await that task instead of running the model again, and all
+    of them get its result or its exception. The task is not tied to any one
+    request, so a client that disconnects doesn't cancel it for the others.
+    Keys must include the model version.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._tasks = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def run(self, key, fn, *args):
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn(*args))
+            self._tasks[key] = task
+            task.add_done_callback(functools.partial(self._done, key))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _done(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        # Marks the exception as retrieved when every waiter went away before it was raised
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self):
+        return {"in_flight": len(self._tasks), "leaders": self.leaders, "coalesced": self.coalesced}
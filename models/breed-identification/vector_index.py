@@ -0,0 +1,345 @@
+"""
+On-disk vector index for re-identifying individual animals from image
+embeddings.
+
+An index lives in one directory:
+
+    index.json      dimension, the model version the embeddings came from, IVF state
+    vectors.npy     float32 embeddings, L2-normalised, one row per enrolled image
+    lists.npy       int32 IVF list of each row
+    centroids.npy   IVF centroids, once the index has been partitioned
+    ids.txt         animal id of each row, one per line
+
+vectors.npy and lists.npy are preallocated and memory-mapped: the index opens
+without reading the embeddings into memory, an enrollment writes one row in
+place, and the files double in size when they are full. ids.txt is appended
+last, so a row only exists once its id line is complete.
+
+Similarity is the cosine of two embeddings. Up to IVF_MIN_ROWS rows every
+search is an exact scan. Larger indexes are partitioned around about sqrt(n)
+spherical k-means centroids, and a search scans only the ``nprobe`` lists
+whose centroids are closest to the query, plus the rows added since the lists
+were last grouped. The centroids are retrained whenever the index has doubled
+since they were trained. Training runs in a background thread on the rows
+enrolled so far while enrollments and searches carry on, and only touches the
+index, never the model; searches keep to the exact scan, or the previous
+lists, until the new centroids are swapped in.
+"""
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Below this many rows every search is an exact scan
+IVF_MIN_ROWS = int(os.environ.get("IVF_MIN_ROWS", 10000))
+INITIAL_CAPACITY = 1024
+# Rows added since the lists were grouped are scanned exactly until there are this many
+MAX_UNGROUPED_ROWS = 1024
+KMEANS_ITERATIONS = 8
+KMEANS_SAMPLES_PER_LIST = 32
+ASSIGN_CHUNK_ROWS = 8192
+MAX_ANIMAL_ID_LENGTH = 128
+
+
+def normalize(vectors):
+    """Rows of ``vectors`` scaled to unit length, as float32"""
+    vectors = np.array(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    vectors /= norms
+    return vectors
+
+
+def nearest_centroids(vectors, centroids):
+    """Index of the most similar centroid for every row of ``vectors``"""
+    return np.concatenate([
+        (np.asarray(vectors[i:i + ASSIGN_CHUNK_ROWS]) @ centroids.T).argmax(axis=1)
+        for i in range(0, len(vectors), ASSIGN_CHUNK_ROWS)
+    ]).astype(np.int32)
+
+
+def spherical_kmeans(sample, n_clusters, rng, iterations=KMEANS_ITERATIONS):
+    """Unit-length centroids of ``n_clusters`` clusters of the normalised rows in ``sample``"""
+    centroids = sample[rng.choice(len(sample), n_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = nearest_centroids(sample, centroids)
+        order = np.argsort(assignment, kind="stable")
+        clusters, starts = np.unique(assignment[order], return_index=True)
+        # Empty clusters keep their previous centroid
+        centroids[clusters] = np.add.reduceat(sample[order], starts, axis=0)
+        centroids = normalize(centroids)
+    return centroids
+
+
+class _Snapshot:
+    """What a search reads; replaced as a whole whenever the index changes"""
+
+    def __init__(self, vectors=None, count=0, centroids=None, order=None, offsets=None, grouped=0):
+        self.vectors = vectors
+        self.count = count
+        self.centroids = centroids
+        # Rows sorted by IVF list, and where each list starts in ``order``
+        self.order = order
+        self.offsets = offsets
+        # Rows below this are in ``order``; later ones are scanned exactly
+        self.grouped = grouped
+
+
+class VectorIndex:
+    """
+    Cosine-similarity index of animal embeddings persisted in ``directory``,
+    which is created on the first enrollment. An animal may be enrolled with
+    several images; searches rank animals by their best-matching image.
+    Enrollments are serialised, searches run concurrently with them.
+    """
+
+    def __init__(self, directory, nprobe=8):
+        self.directory = directory
+        self.nprobe = nprobe
+        self.dim = None
+        self.model_version = None
+        self.trained_rows = 0
+        self.ids = []
+        # Animal id -> enrolled images
+        self.images = {}
+        self._vectors = None
+        self._lists = None
+        self._centroids = None
+        self._snapshot = _Snapshot()
+        self._lock = threading.Lock()
+        self._trainer = None
+        if os.path.exists(self._path("index.json")):
+            self._open()
+
+    def __len__(self):
+        return self._snapshot.count
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _open(self):
+        with open(self._path("index.json")) as f:
+            meta = json.load(f)
+        self.dim = meta["dimension"]
+        self.model_version = meta.get("model_version")
+        self.trained_rows = meta.get("trained_rows", 0)
+        self._vectors = np.load(self._path("vectors.npy"), mmap_mode="r+")
+        self._lists = np.load(self._path("lists.npy"), mmap_mode="r+")
+        if self.trained_rows and os.path.exists(self._path("centroids.npy")):
+            self._centroids = np.load(self._path("centroids.npy"))
+        else:
+            self.trained_rows = 0
+
+        with open(self._path("ids.txt"), encoding="utf-8") as f:
+            content = f.read()
+        lines = content.split("\n")
+        # A line without its newline, or without its vector, was never committed
+        ids = lines[:-1][:min(len(self._vectors), len(self._lists))]
+        if len(ids) != len(lines) - 1 or lines[-1]:
+            logger.warning(f"Dropping an incomplete enrollment from {self._path('ids.txt')}")
+            self._write_ids(ids)
+        self.ids = ids
+        for animal_id in ids:
+            self.images[animal_id] = self.images.get(animal_id, 0) + 1
+        self._publish(regroup=True)
+        logger.info(f"Opened the identity index at {self.directory}: {len(ids)} images of "
+                    f"{len(self.images)} animals, {0 if self._centroids is None else len(self._centroids)} IVF lists")
+
+    def _write_ids(self, ids):
+        with open(self._path("ids.txt.tmp"), "w", encoding="utf-8") as f:
+            f.write("".join(animal_id + "\n" for animal_id in ids))
+        os.replace(self._path("ids.txt.tmp"), self._path("ids.txt"))
+
+    def _write_meta(self):
+        meta = {
+            "dimension": self.dim,
+            "metric": "cosine",
+            "model_version": self.model_version,
+            "trained_rows": self.trained_rows,
+            "lists": 0 if self._centroids is None else len(self._centroids),
+        }
+        with open(self._path("index.json.tmp"), "w") as f:
+            json.dump(meta, f, indent=2)
+        os.replace(self._path("index.json.tmp"), self._path("index.json"))
+
+    def _create(self, dim, model_version):
+        os.makedirs(self.directory, exist_ok=True)
+        self.dim = dim
+        self.model_version = model_version
+        self._vectors = np.lib.format.open_memmap(
+            self._path("vectors.npy"), mode="w+", dtype=np.float32, shape=(INITIAL_CAPACITY, dim))
+        self._lists = np.lib.format.open_memmap(
+            self._path("lists.npy"), mode="w+", dtype=np.int32, shape=(INITIAL_CAPACITY,))
+        self._write_ids([])
+        self._write_meta()
+
+    def _resize(self, name, array, capacity):
+        # Copied into a new file that replaces the old one; searches holding the old map keep reading it
+        grown = np.lib.format.open_memmap(
+            self._path(name + ".tmp"), mode="w+", dtype=array.dtype, shape=(capacity,) + array.shape[1:])
+        grown[:len(array)] = array
+        grown.flush()
+        os.replace(self._path(name + ".tmp"), self._path(name))
+        return grown
+
+    def _publish(self, regroup=False):
+        count = len(self.ids)
+        previous = self._snapshot
+        if self._centroids is None:
+            self._snapshot = _Snapshot(self._vectors, count)
+        elif regroup or previous.order is None or count - previous.grouped > MAX_UNGROUPED_ROWS:
+            lists = np.asarray(self._lists[:count])
+            offsets = np.zeros(len(self._centroids) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(lists, minlength=len(self._centroids)), out=offsets[1:])
+            self._snapshot = _Snapshot(self._vectors, count, self._centroids,
+                                       np.argsort(lists, kind="stable"), offsets, count)
+        else:
+            self._snapshot = _Snapshot(self._vectors, count, previous.centroids,
+                                       previous.order, previous.offsets, previous.grouped)
+
+    def _train(self, vectors, count):
+        """
+        Train centroids on the first ``count`` rows of ``vectors`` without the
+        lock (those rows never change), then swap them in under it, assigning
+        the rows enrolled in the meantime as well
+        """
+        try:
+            n_lists = max(1, int(round(np.sqrt(count))))
+            rng = np.random.default_rng(count)
+            sample_rows = np.sort(rng.choice(count, min(count, KMEANS_SAMPLES_PER_LIST * n_lists), replace=False))
+            centroids = spherical_kmeans(np.asarray(vectors[sample_rows]), n_lists, rng)
+            lists = nearest_centroids(vectors[:count], centroids)
+
+            with self._lock:
+                total = len(self.ids)
+                self._lists[:count] = lists
+                if total > count:
+                    self._lists[count:total] = nearest_centroids(self._vectors[count:total], centroids)
+                self._lists.flush()
+                np.save(self._path("centroids.tmp.npy"), centroids)
+                os.replace(self._path("centroids.tmp.npy"), self._path("centroids.npy"))
+                self._centroids = centroids
+                self.trained_rows = count
+                self._write_meta()
+                self._publish(regroup=True)
+            logger.info(f"Partitioned {total} embeddings into {n_lists} IVF lists")
+        except Exception:
+            logger.exception(f"Training the IVF lists of {self.directory} failed")
+
+    def accepts(self, model_version):
+        """Whether embeddings from ``model_version`` can be enrolled and searched"""
+        return len(self) == 0 or self.model_version == model_version
+
+    def add(self, animal_id, embedding, model_version=None):
+        """Enroll one image embedding of ``animal_id``; returns how many images that animal has"""
+        animal_id = str(animal_id).strip()
+        if not animal_id or len(animal_id) > MAX_ANIMAL_ID_LENGTH or "\n" in animal_id or "\r" in animal_id:
+            raise ValueError(f"Animal ids must be a single line of 1 to {MAX_ANIMAL_ID_LENGTH} characters")
+        vector = normalize(np.asarray(embedding).reshape(-1))
+
+        with self._lock:
+            if self.dim is None:
+                self._create(len(vector), model_version)
+            elif not self.ids and (self.dim != len(vector) or self.model_version != model_version):
+                # Nothing enrolled yet, so the index simply follows the model
+                self._vectors = self._lists = self._centroids = None
+                self.trained_rows = 0
+                self._create(len(vector), model_version)
+            elif len(vector) != self.dim:
+                raise ValueError(f"Embedding has {len(vector)} dimensions, the index has {self.dim}")
+
+            row = len(self.ids)
+            if row >= min(len(self._vectors), len(self._lists)):
+                self._vectors = self._resize("vectors.npy", self._vectors, 2 * row)
+                self._lists = self._resize("lists.npy", self._lists, 2 * row)
+            self._vectors[row] = vector
+            if self._centroids is not None:
+                self._lists[row] = nearest_centroids(vector[None], self._centroids)[0]
+            self._vectors.flush()
+            self._lists.flush()
+            with open(self._path("ids.txt"), "a", encoding="utf-8") as f:
+                f.write(animal_id + "\n")
+            self.ids.append(animal_id)
+            self.images[animal_id] = self.images.get(animal_id, 0) + 1
+
+            count = row + 1
+            training = self._trainer is not None and self._trainer.is_alive()
+            if not training and ((self._centroids is None and count >= IVF_MIN_ROWS)
+                                 or (self.trained_rows and count >= 2 * self.trained_rows)):
+                self._trainer = threading.Thread(
+                    target=self._train, args=(self._vectors, count), name="ivf-training", daemon=True)
+                self._trainer.start()
+            self._publish()
+            return self.images[animal_id]
+
+    def wait_for_training(self, timeout=None):
+        """Wait for a running IVF training to finish; returns whether none is left running"""
+        trainer = self._trainer
+        if trainer is not None:
+            trainer.join(timeout)
+        return trainer is None or not trainer.is_alive()
+
+    def search(self, embedding, k=5, nprobe=None, exact=False):
+        """
+        The ``k`` animals whose enrolled images are most similar to
+        ``embedding``, best first, as dicts of animal id, cosine similarity
+        and enrolled images, plus how the search ran.
+        """
+        snapshot = self._snapshot
+        query = normalize(np.asarray(embedding).reshape(-1))
+        if snapshot.count == 0:
+            return [], {"exact": True, "rows_scanned": 0}
+        if len(query) != self.dim:
+            raise ValueError(f"Embedding has {len(query)} dimensions, the index has {self.dim}")
+
+        if snapshot.centroids is None or exact:
+            rows = None
+            scores = snapshot.vectors[:snapshot.count] @ query
+        else:
+            nprobe = min(nprobe or self.nprobe, len(snapshot.centroids))
+            probe = np.argpartition(-(snapshot.centroids @ query), nprobe - 1)[:nprobe]
+            rows = np.concatenate(
+                [snapshot.order[snapshot.offsets[l]:snapshot.offsets[l + 1]] for l in probe]
+                + [np.arange(snapshot.grouped, snapshot.count)]
+            )
+            # In file order, so the gather reads the map front to back
+            rows.sort()
+            scores = snapshot.vectors[rows] @ query
+        scores = np.asarray(scores)
+
+        matches = {}
+        candidates = min(len(scores), 4 * k)
+        while True:
+            top = np.argpartition(-scores, candidates - 1)[:candidates]
+            for i in top[np.argsort(-scores[top], kind="stable")]:
+                animal_id = self.ids[i if rows is None else rows[i]]
+                if animal_id not in matches:
+                    matches[animal_id] = float(scores[i])
+                    if len(matches) == k:
+                        break
+            if len(matches) == k or candidates == len(scores):
+                break
+            matches.clear()
+            candidates = min(len(scores), 4 * candidates)
+
+        results = [
+            {"animal_id": animal_id, "similarity": similarity, "images": self.images[animal_id]}
+            for animal_id, similarity in matches.items()
+        ]
+        return results, {"exact": rows is None, "rows_scanned": len(scores)}
+
+    def stats(self):
+        snapshot = self._snapshot
+        return {
+            "directory": self.directory,
+            "dimension": self.dim,
+            "model_version": self.model_version,
+            "images": snapshot.count,
+            "animals": len(self.images),
+            "ivf_lists": 0 if snapshot.centroids is None else len(snapshot.centroids),
+            "nprobe": self.nprobe,
+        }
@@ -0,0 +1,266 @@
+"""
+Model artifacts that load without running arbitrary pickle code.
+
+    python artifacts.py export model/cattle_predictor_v5.pkl
+    python artifacts.py verify model/cattle_predictor_v5.artifact
+
+``export`` turns a pickle/joblib bundle into a directory:
+
+    manifest.json   format version, library versions, SHA-256 of every file
+    object.pkl      the object graph, with every NumPy buffer stored out of band
+    buffers.bin     those buffers back to back, 64-byte aligned
+
+``load_artifact`` checks the checksums, maps buffers.bin read-only and
+unpickles object.pkl with an explicit allow-list of the sklearn, XGBoost,
+SciPy and NumPy classes the models are made of, so a tampered artifact cannot
+import or call anything else; a model made of other classes fails to load back
+when it is exported, and they need adding to SAFE_CLASSES. Arrays the
+estimators keep as they are (the KNN training matrix, encoder vocabularies,
+imputer and scaler statistics, forest class labels) are views of the mapping,
+so worker processes share their pages through the page cache instead of each
+holding a copy. sklearn's Cython Tree objects copy their node tables when they
+are rebuilt, so those stay per process.
+
+Exporting unpickles the source, so only export bundles you trust. The
+sklearn-based services keep an identical copy of this module. Change all
+copies together; tests/test_shared_copies.py fails when they differ.
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import mmap
+import os
+import pickle
+import shutil
+import sys
+
+import numpy as np
+
+FORMAT = "gaupal-artifact/1"
+ALIGNMENT = 64
+MANIFEST = "manifest.json"
+OBJECT_FILE = "object.pkl"
+BUFFERS_FILE = "buffers.bin"
+
+# Functions and non-class globals the pickles of fitted estimators refer to
+SAFE_GLOBALS = {
+    ("builtins", "slice"), ("builtins", "set"), ("builtins", "frozenset"), ("builtins", "dict"),
+    ("builtins", "list"), ("builtins", "tuple"), ("builtins", "complex"), ("builtins", "bytearray"),
+    ("copyreg", "_reconstructor"), ("builtins", "object"),
+    ("collections", "OrderedDict"), ("collections", "defaultdict"),
+    ("numpy", "dtype"), ("numpy", "ndarray"),
+    ("numpy.core.multiarray", "_reconstruct"), ("numpy._core.multiarray", "_reconstruct"),
+    ("numpy.core.multiarray", "scalar"), ("numpy._core.multiarray", "scalar"),
+    ("numpy.core.numeric", "_frombuffer"), ("numpy._core.numeric", "_frombuffer"),
+    ("numpy.random._pickle", "__randomstate_ctor"), ("numpy.random._pickle", "__bit_generator_ctor"),
+    ("numpy.random._pickle", "__generator_ctor"),
+}
+# What the pickles of the shipped models refer to, by the module that defines each
+# class: the breeding XGBoost models and their preprocessing, the symptom ensemble,
+# and the estimators the training notebooks may swap in
+SAFE_CLASSES = {
+    "sklearn.compose._column_transformer": ("ColumnTransformer",),
+    "sklearn.pipeline": ("Pipeline",),
+    "sklearn.impute._base": ("SimpleImputer",),
+    "sklearn.preprocessing._data": ("StandardScaler",),
+    "sklearn.preprocessing._encoders": ("OneHotEncoder",),
+    "sklearn.preprocessing._label": ("LabelEncoder",),
+    "sklearn.utils._bunch": ("Bunch",),
+    "sklearn.ensemble._voting": ("VotingClassifier",),
+    "sklearn.ensemble._forest": ("RandomForestClassifier", "RandomForestRegressor",
+                                 "ExtraTreesClassifier", "ExtraTreesRegressor"),
+    "sklearn.tree._classes": ("DecisionTreeClassifier", "DecisionTreeRegressor",
+                              "ExtraTreeClassifier", "ExtraTreeRegressor"),
+    "sklearn.tree._tree": ("Tree",),
+    "sklearn.naive_bayes": ("GaussianNB",),
+    "sklearn.neighbors._classification": ("KNeighborsClassifier",),
+    # KNN with algorithm="kd_tree"/"ball_tree"; newObj is the constructor their pickles call
+    "sklearn.neighbors._kd_tree": ("KDTree", "newObj"),
+    "sklearn.neighbors._ball_tree": ("BallTree", "newObj"),
+    "sklearn.metrics._dist_metrics": ("EuclideanDistance64", "ManhattanDistance64", "ChebyshevDistance64",
+                                      "MinkowskiDistance64", "HammingDistance64", "newObj"),
+    "scipy.sparse._csr": ("csr_matrix", "csr_array"),
+    "scipy.sparse._csc": ("csc_matrix", "csc_array"),
+    "scipy.sparse._coo": ("coo_matrix", "coo_array"),
+    "xgboost.sklearn": ("XGBClassifier", "XGBRegressor"),
+    "xgboost.core": ("Booster",),
+}
+SAFE_GLOBALS |= {(module, name) for module, names in SAFE_CLASSES.items() for name in names}
+
+
+class RestrictedUnpickler(pickle.Unpickler):
+    """Unpickler that only resolves the globals fitted estimators need"""
+
+    def find_class(self, module, name):
+        if (module, name) in SAFE_GLOBALS:
+            return super().find_class(module, name)
+        # NumPy scalar types (numpy.float64, ...), but not memmap & co.
+        if module == "numpy":
+            obj = getattr(np, name, None)
+            if isinstance(obj, type) and issubclass(obj, np.generic):
+                return obj
+        raise pickle.UnpicklingError(f"{module}.{name} is not allowed in a model artifact")
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _dumps(obj):
+    buffers = []
+    data = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+    return data, [buffer.raw() for buffer in buffers]
+
+
+def export_artifact(obj, path, source=None):
+    """Write ``obj`` as an artifact directory at ``path``, replacing any existing one"""
+    data, buffers = _dumps(obj)
+    staging = path.rstrip("/") + ".tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+
+    segments = []
+    with open(os.path.join(staging, BUFFERS_FILE), "wb") as f:
+        for buffer in buffers:
+            f.write(b"\0" * (-f.tell() % ALIGNMENT))
+            segments.append([f.tell(), buffer.nbytes])
+            f.write(buffer)
+    with open(os.path.join(staging, OBJECT_FILE), "wb") as f:
+        f.write(data)
+
+    import sklearn
+
+    manifest = {
+        "format": FORMAT,
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "source": os.path.basename(source) if source else None,
+        "source_sha256": _sha256(source) if source else None,
+        "python": ".".join(map(str, sys.version_info[:3])),
+        "numpy": np.__version__,
+        "sklearn": sklearn.__version__,
+        "files": {name: _sha256(os.path.join(staging, name)) for name in (OBJECT_FILE, BUFFERS_FILE)},
+        "segments": segments,
+    }
+    with open(os.path.join(staging, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(staging, path)
+    return manifest
+
+
+def read_manifest(path):
+    with open(os.path.join(path, MANIFEST)) as f:
+        manifest = json.load(f)
+    if manifest.get("format") != FORMAT:
+        raise ValueError(f"{path} is not a {FORMAT} artifact")
+    return manifest
+
+
+def verify_artifact(path, manifest=None):
+    """Raise ValueError if any file differs from the checksums in the manifest"""
+    manifest = manifest or read_manifest(path)
+    for name, expected in manifest["files"].items():
+        if _sha256(os.path.join(path, name)) != expected:
+            raise ValueError(f"{os.path.join(path, name)} does not match its manifest checksum")
+
+
+def load_artifact(path, verify=None):
+    """
+    ``(object, manifest)`` from an artifact directory. Checksums are checked
+    unless ``verify`` is False (default: ARTIFACT_VERIFY, on).
+    """
+    manifest = read_manifest(path)
+    if verify is None:
+        verify = os.environ.get("ARTIFACT_VERIFY", "1") != "0"
+    if verify:
+        verify_artifact(path, manifest)
+
+    buffers = []
+    if manifest["segments"]:
+        with open(os.path.join(path, BUFFERS_FILE), "rb") as f:
+            # The mapping stays alive as long as any array still views it
+            mapped = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        buffers = [mapped[offset:offset + length] for offset, length in manifest["segments"]]
+    with open(os.path.join(path, OBJECT_FILE), "rb") as f:
+        obj = RestrictedUnpickler(f, buffers=buffers).load()
+    return obj, manifest
+
+
+def artifact_path(model_path):
+    """The artifact directory exported from ``model_path``: same name, .artifact suffix"""
+    return os.path.splitext(model_path)[0] + ".artifact"
+
+
+def load_model(model_path, legacy_loader):
+    """
+    Load the artifact next to ``model_path`` when there is one, otherwise call
+    ``legacy_loader(model_path)``. Returns ``(object, manifest or None)``.
+    """
+    path = artifact_path(model_path)
+    if os.path.isdir(path):
+        return load_artifact(path)
+    return legacy_loader(model_path), None
+
+
+def _same_object(a, b):
+    """Structural equality of two object graphs, down to array contents"""
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, np.ndarray):
+        if a.dtype != b.dtype or a.shape != b.shape:
+            return False
+        if a.dtype.hasobject:
+            return all(_same_object(x, y) for x, y in zip(a.flat, b.flat))
+        return np.array_equal(a, b, equal_nan=a.dtype.kind in "fc")
+    if isinstance(a, (float, np.floating)):
+        return a == b or (a != a and b != b)
+    if a is None or isinstance(a, (bool, int, complex, str, bytes, type, np.generic, np.dtype)) or callable(a):
+        return a == b
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(_same_object(a[k], b[k]) for k in a)
+    if isinstance(a, (list, tuple)):
+        return len(a) == len(b) and all(_same_object(x, y) for x, y in zip(a, b))
+    if isinstance(a, (set, frozenset)):
+        return a == b
+    # Estimators, Cython trees, slices: compare what pickle would store
+    reduced_a = [list(part) if hasattr(part, "__next__") else part for part in a.__reduce_ex__(5)]
+    reduced_b = [list(part) if hasattr(part, "__next__") else part for part in b.__reduce_ex__(5)]
+    return _same_object(reduced_a, reduced_b)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="convert a pickle/joblib file into an artifact directory")
+    export.add_argument("source")
+    export.add_argument("--output", help="artifact directory (default: SOURCE with an .artifact suffix)")
+    verify = commands.add_parser("verify", help="check an artifact's checksums and load it")
+    verify.add_argument("path")
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        import joblib
+
+        output = args.output or artifact_path(args.source)
+        obj = joblib.load(args.source)
+        manifest = export_artifact(obj, output, source=args.source)
+        loaded, _ = load_artifact(output)
+        if not _same_object(obj, loaded):
+            shutil.rmtree(output)
+            sys.exit(f"{output} does not load back to the same object; removed it")
+        size = sum(length for _, length in manifest["segments"])
+        print(f"Wrote {output}: {len(manifest['segments'])} arrays, {size / 1e6:.1f} MB mapped")
+    else:
+        loaded, manifest = load_artifact(args.path, verify=True)
+        print(f"{args.path}: OK ({type(loaded).__name__}, exported {manifest['created_at']} "
+              f"with sklearn {manifest['sklearn']})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+Compiled replacement for the fitted ColumnTransformer in the breeding model.
+
+At load time the imputers, scalers and one-hot encoders of
+``model['preprocessor']`` are read into NumPy lookup tables, keeping only the
+output columns listed in ``model['selected_feature_indices']``. Scoring a pair
+then needs no DataFrame and no sklearn input validation.
+
+Only the pipeline shapes the training notebook produces are supported
+(SimpleImputer, StandardScaler, OneHotEncoder, passthrough/drop); anything
+else raises NotImplementedError and the caller keeps using sklearn.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+from sklearn.impute import SimpleImputer
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+
+def _steps(transformer):
+    if transformer == "passthrough":
+        return []
+    if isinstance(transformer, Pipeline):
+        return [step for _, step in transformer.steps if step != "passthrough"]
+    return [transformer]
+
+
+def _is_missing(value):
+    return value is None or (isinstance(value, float) and value != value)
+
+
+class CompiledFeatures:
+    """
+    Produces ``preprocessor.transform(X)[:, selected_indices]`` from a mapping
+    of column name to scalar or 1-D array (a dict of request fields or a
+    DataFrame).
+    """
+
+    def __init__(self, preprocessor, selected_indices):
+        if getattr(preprocessor, "remainder", "drop") != "drop":
+            raise NotImplementedError("only remainder='drop' is supported")
+
+        # Every output column of the full transform: ("num", column, fill, mean, scale)
+        # or ("cat", column, fill, category)
+        outputs = {}
+        for name, transformer, columns in preprocessor.transformers_:
+            if transformer == "drop" or name == "remainder":
+                continue
+            if not all(isinstance(column, str) for column in columns):
+                raise NotImplementedError("columns must be selected by name")
+            start = preprocessor.output_indices_[name].start
+            for offset, output in enumerate(self._column_outputs(transformer, list(columns))):
+                outputs[start + offset] = output
+
+        selected = [int(i) for i in selected_indices]
+        missing = [i for i in selected if i not in outputs]
+        if missing:
+            raise NotImplementedError(f"selected outputs {missing[:5]} have no compiled equivalent")
+        self.n_features = len(selected)
+        self.input_columns = list(getattr(preprocessor, "feature_names_in_", []))
+
+        numeric = [(position, outputs[i]) for position, i in enumerate(selected) if outputs[i][0] == "num"]
+        self.numeric_columns = list(dict.fromkeys(output[1] for _, output in numeric))
+        self.numeric_positions = np.array([position for position, _ in numeric], dtype=np.intp)
+        self.numeric_sources = np.array([self.numeric_columns.index(output[1]) for _, output in numeric], dtype=np.intp)
+        self.numeric_fill = np.array([output[2] for _, output in numeric], dtype=np.float64)
+        self.numeric_mean = np.array([output[3] for _, output in numeric], dtype=np.float64)
+        self.numeric_scale = np.array([output[4] for _, output in numeric], dtype=np.float64)
+
+        # column -> (fill value, [(category, position), ...])
+        self.categorical = {}
+        for position, i in enumerate(selected):
+            kind, column, fill, *rest = outputs[i]
+            if kind == "cat":
+                self.categorical.setdefault(column, (fill, []))[1].append((rest[0], position))
+
+    @staticmethod
+    def _column_outputs(transformer, columns):
+        steps = _steps(transformer)
+        fill = [None] * len(columns)
+        mean = [0.0] * len(columns)
+        scale = [1.0] * len(columns)
+
+        for step in steps:
+            if isinstance(step, SimpleImputer):
+                if not _is_missing(step.missing_values) or step.add_indicator:
+                    raise NotImplementedError("imputers must fill NaN without indicators")
+                statistics = list(step.statistics_)
+                if any(isinstance(value, float) and np.isnan(value) for value in statistics):
+                    raise NotImplementedError("imputer dropped an all-missing column")
+                fill = statistics
+            elif isinstance(step, StandardScaler):
+                if step.mean_ is not None:
+                    mean = list(step.mean_)
+                if step.scale_ is not None:
+                    scale = list(step.scale_)
+            elif isinstance(step, OneHotEncoder):
+                if step is not steps[-1]:
+                    raise NotImplementedError("one-hot encoding must be the last step")
+                if step.drop_idx_ is not None or getattr(step, "_infrequent_enabled", False):
+                    raise NotImplementedError("dropped or infrequent categories are not supported")
+                return [
+                    ("cat", column, fill[k], category)
+                    for k, column in enumerate(columns)
+                    for category in step.categories_[k]
+                ]
+            else:
+                raise NotImplementedError(f"unsupported step {type(step).__name__}")
+
+        return [
+            ("num", column, np.nan if fill[k] is None else float(fill[k]), float(mean[k]), float(scale[k]))
+            for k, column in enumerate(columns)
+        ]
+
+    def transform(self, columns, n_rows=1):
+        """Selected model inputs for ``n_rows`` rows, as a float64 array"""
+        out = np.zeros((n_rows, self.n_features), dtype=np.float64)
+
+        if len(self.numeric_positions):
+            values = np.empty((n_rows, len(self.numeric_columns)), dtype=np.float64)
+            for k, column in enumerate(self.numeric_columns):
+                values[:, k] = np.asarray(columns[column], dtype=np.float64)
+            values = values[:, self.numeric_sources]
+            values = np.where(np.isnan(values), self.numeric_fill, values)
+            values -= self.numeric_mean
+            values /= self.numeric_scale
+            out[:, self.numeric_positions] = values
+
+        for column, (fill, categories) in self.categorical.items():
+            values = np.asarray(columns[column], dtype=object).reshape(-1)
+            if fill is not None:
+                values = np.array([fill if _is_missing(value) else value for value in values], dtype=object)
+            for category, position in categories:
+                out[:, position] = values == category
+
+        return out
+
+
+def parity_rows(compiled, n_rows=64, seed=0):
+    """Synthetic rows covering every input column, with known and unknown categories"""
+    rng = np.random.default_rng(seed)
+    data = {column: np.zeros(n_rows) for column in compiled.input_columns}
+    for source, column in enumerate(compiled.numeric_columns):
+        k = int(np.flatnonzero(compiled.numeric_sources == source)[0])
+        center = compiled.numeric_mean[k] if np.isfinite(compiled.numeric_fill[k]) else 0.0
+        data[column] = center + compiled.numeric_scale[k] * rng.normal(0, 1.5, n_rows)
+    for column, (_, categories) in compiled.categorical.items():
+        choices = [category for category, _ in categories] + ["Unknown"]
+        data[column] = rng.choice(np.array(choices, dtype=object), n_rows)
+    return pd.DataFrame(data)
+
+
+def check_parity(compiled, model, n_rows=64):
+    """Largest difference between compiled and sklearn features, and whether predictions match"""
+    frame = parity_rows(compiled, n_rows)
+    expected = model['preprocessor'].transform(frame)[:, model['selected_feature_indices']]
+    actual = compiled.transform(frame, n_rows)
+    max_diff = float(np.max(np.abs(expected - actual))) if expected.size else 0.0
+    same_predictions = (
+        np.array_equal(model['classifier'].predict(expected), model['classifier'].predict(actual))
+        and np.allclose(model['regressor'].predict(expected), model['regressor'].predict(actual))
+    )
+    return max_diff, same_predictions
+
+
+def build_feature_pipeline(model):
+    """
+    CompiledFeatures for ``model`` if FEATURE_PIPELINE is not "sklearn", the
+    preprocessor is supported and the parity check passes; otherwise None.
+    """
+    if model is None or os.environ.get("FEATURE_PIPELINE", "compiled").lower() == "sklearn":
+        return None
+    try:
+        compiled = CompiledFeatures(model['preprocessor'], model['selected_feature_indices'])
+        max_diff, same_predictions = check_parity(compiled, model)
+    except Exception as e:
+        print(f"Compiled feature pipeline unavailable, using sklearn: {e}")
+        return None
+    if max_diff > 1e-9 or not same_predictions:
+        print(f"Compiled feature pipeline failed its parity check (max diff {max_diff:.3g}), using sklearn")
+        return None
+    return compiled
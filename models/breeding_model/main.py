@@ -3,10 +3,17 @@ from pydantic import BaseModel
 import pandas as pd
 import numpy as np
 import pickle
+import json
 import os
+import time
 import uvicorn
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Dict, Optional
+from typing import Dict, List, Optional
+
+from artifacts import artifact_path, load_model
+from features import build_feature_pipeline
+from trees import build_tree_engine
+from serving import InferencePool, ModelManager, PoolSaturated, SingleFlight, metrics, pool_saturated_handler
 
 # Define the FastAPI app
 app = FastAPI()
@@ -20,16 +27,66 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Model path
-MODEL_PATH = "model/cattle_predictor_v5.pkl"
+# Bounded executor for model calls; INFERENCE_EXECUTOR=process runs scoring in worker processes
+pool = InferencePool.from_env()
+app.add_exception_handler(PoolSaturated, pool_saturated_handler)
+metrics.track_pool(pool)
 
-# Load model at startup
-try:
-    with open(MODEL_PATH, 'rb') as f:
-        model = pickle.load(f)
-except FileNotFoundError:
-    print(f"Model file not found at {MODEL_PATH}")
-    model = None
+# Stage latency histograms on /metrics
+metrics.install(app)
+
+# Identical pairs submitted while one is being scored share its result
+predict_flight = SingleFlight("breeding_predict")
+metrics.track_flight(predict_flight)
+
+# Paths resolve against this directory so the service can start from anywhere
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Model path; MODEL_PATH points the service at another model file
+MODEL_PATH = os.environ.get("MODEL_PATH", os.path.join(BASE_DIR, "model", "cattle_predictor_v5.pkl"))
+
+# Optional catalogue of bulls ranked by /rank when the request has no bulls
+BULL_CATALOGUE_PATH = os.environ.get("BULL_CATALOGUE_PATH", os.path.join(BASE_DIR, "model", "bull_catalogue.json"))
+
+# Pair used to warm up a newly loaded model before it serves traffic
+SAMPLE_DATA_PATH = os.path.join(BASE_DIR, "sample_data.json")
+
+def load_pickle(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+def load_breeding_model(path: str) -> Dict:
+    """
+    The model dict from ``path`` (or the artifact exported next to it with
+    python artifacts.py export) plus the compiled feature pipeline and tree
+    engine built from it. Both are checked against sklearn on load; None means
+    scoring goes through sklearn (FEATURE_PIPELINE/TREE_ENGINE=sklearn force this).
+    """
+    model, _ = load_model(path, load_pickle)
+    return {
+        'model': model,
+        'feature_pipeline': build_feature_pipeline(model),
+        'tree_engine': build_tree_engine(model, len(model['selected_feature_indices'])),
+    }
+
+def warm_up_breeding_model(candidate):
+    """Score the sample pair with a newly loaded model before it is swapped in"""
+    with open(SAMPLE_DATA_PATH, 'r') as f:
+        sample = BreedingInput(**json.load(f)).dict()
+    class_predictions, ccs_predictions = score_pairs(candidate, calculate_derived_features(sample))
+    if not np.isfinite(ccs_predictions[0]):
+        raise ValueError("model produced a non-finite CCS score")
+
+def model_files(path: str) -> List[str]:
+    return [path, os.path.join(artifact_path(path), "manifest.json")]
+
+# The active model version, replaced atomically by POST /admin/reload or, with
+# MODEL_WATCH_INTERVAL set, when the model files change
+models = ModelManager(
+    MODEL_PATH, load_breeding_model, warmup=warm_up_breeding_model,
+    on_swap=lambda new, old: pool.recycle(), watch_files=model_files
+)
+models.install(app)
 
 def calculate_derived_features(data: Dict) -> Dict:
     """Calculate feature engineered columns with safety checks for zero values"""
@@ -65,6 +122,32 @@ def calculate_derived_features(data: Dict) -> Dict:
     
     return derived
 
+def calculate_derived_features_frame(data: pd.DataFrame) -> pd.DataFrame:
+    """Vectorized calculate_derived_features for a frame of cow/bull pairs"""
+    derived = data.copy()
+
+    derived['FE_Age_Diff'] = (data['Bull_Age'] - data['Cow_Age']).abs()
+
+    # Zero weights/heights divide by NaN and fall back to 0 like the scalar version
+    cow_weight = data['Cow_Weight'].replace(0, np.nan)
+    derived['FE_Weight_Diff_Pct'] = ((data['Bull_Weight'] - cow_weight).abs() / cow_weight * 100).fillna(0)
+    cow_height = data['Cow_Height'].replace(0, np.nan)
+    derived['FE_Height_Diff_Pct'] = ((data['Bull_Height'] - cow_height).abs() / cow_height * 100).fillna(0)
+
+    derived['FE_Drought_Diff'] = (data['Bull_Drought_Resistance'] - data['Cow_Drought_Resistance']).abs()
+    derived['FE_Milk_Sum'] = data['Cow_Milk_Yield'] + data['Bull_Mother_Milk_Yield']
+    derived['FE_Combined_Health'] = data['Bull_Health_Status'] + data['Cow_Health_Status']
+    derived['FE_Temperament_Combo'] = (data['Bull_Temperament'] == data['Cow_Temperament']).astype(int)
+
+    derived['Bull_Disease_Resistance_Score'] = data['Disease_Resistance_Score']
+    derived['Cow_Disease_Resistance_Score'] = data['Disease_Resistance_Score']
+    derived['Bull_Disease'] = data['Bull_Health_Status']
+    derived['Cow_Disease'] = data['Cow_Health_Status']
+    derived['Bull_Past_Breeding_Success'] = data['Past_Breeding_Success']
+    derived['Cow_Past_Breeding_Success'] = data['Past_Breeding_Success']
+
+    return derived
+
 class BreedingInput(BaseModel):
     Cow_Breed: str
     Cow_Age: int
@@ -109,6 +192,76 @@ class BreedingInput(BaseModel):
     Bull_Milk_Yield: float = 0.0
     Cow_Mother_Milk_Yield: float
 
+# Column order of a single /predict row, reused when building /rank frames
+BREEDING_COLUMNS = list(BreedingInput.__fields__)
+
+class CowProfile(BaseModel):
+    Cow_Breed: str
+    Cow_Age: int
+    Cow_Weight: float
+    Cow_Height: float
+    Cow_Milk_Yield: float
+    Cow_Health_Status: int
+    Cow_Drought_Resistance: float
+    Cow_Temperament: str
+    Cow_Disease_Resistance_Score: float = 0.0
+    Cow_Genetic_Diversity_Score: float = 0.0
+    Cow_Disease: int = 0
+    Cow_Same_Parents: int = 0
+    Cow_Fertility_Rate: float
+    Cow_Breeding_Success_Rate: float
+    Cow_Past_Breeding_Success: str
+    Cow_Market_Value: float
+    Cow_Mother_Milk_Yield: float
+
+class BullCandidate(BaseModel):
+    """A bull together with the pair-level fields for mating it with the cow"""
+    bull_id: Optional[str] = None
+    Bull_Breed: str
+    Bull_Age: int
+    Bull_Weight: float
+    Bull_Height: float
+    Bull_Health_Status: int
+    Bull_Mother_Milk_Yield: float
+    Bull_Drought_Resistance: float
+    Bull_Temperament: str
+    Bull_Disease_Resistance_Score: float = 0.0
+    Bull_Genetic_Diversity_Score: float = 0.0
+    Bull_Disease: int = 0
+    Bull_Same_Parents: int = 0
+    Bull_Fertility_Rate: float
+    Bull_Breeding_Success_Rate: float
+    Bull_Past_Breeding_Success: str
+    Bull_Market_Value: float
+    Bull_Milk_Yield: float = 0.0
+    Same_Parents: int
+    Trait_Difference: float
+    Genetic_Diversity: float
+    Fertility_Rate: float
+    Breeding_Success_Rate: float
+    Disease_Resistance_Score: float
+    Market_Value: float
+    Past_Breeding_Success: str
+
+class RankInput(BaseModel):
+    cow: CowProfile
+    bulls: Optional[List[BullCandidate]] = None  # Falls back to the stored catalogue
+    top_k: int = 3
+
+def load_bull_catalogue(path: str) -> List[Dict]:
+    """Load and validate the stored bull catalogue, if there is one"""
+    if not os.path.exists(path):
+        return []
+    try:
+        with open(path, 'r') as f:
+            entries = json.load(f)
+        return [BullCandidate(**entry).dict() for entry in entries]
+    except Exception as e:
+        print(f"Could not load bull catalogue from {path}: {e}")
+        return []
+
+bull_catalogue = load_bull_catalogue(BULL_CATALOGUE_PATH)
+
 def convert_ccs_to_percentage(ccs_score, min_ccs=-50, max_ccs=85):
     if max_ccs == min_ccs:
         return 50.0
@@ -116,52 +269,149 @@ def convert_ccs_to_percentage(ccs_score, min_ccs=-50, max_ccs=85):
     percentage = ((clipped_score - min_ccs) / (max_ccs - min_ccs)) * 100
     return percentage
 
+def select_features(current, data, n_rows: int = 1) -> np.ndarray:
+    """Model input matrix from one pair's derived fields (a dict) or a frame of pairs"""
+    if current.feature_pipeline is not None:
+        return current.feature_pipeline.transform(data, n_rows)
+    data_df = data if isinstance(data, pd.DataFrame) else pd.DataFrame([data])
+    X_new_processed = current.model['preprocessor'].transform(data_df)
+    return X_new_processed[:, current.model['selected_feature_indices']]
+
+def score_pairs(current, data, n_rows: int = 1):
+    """Run both models of the ``current`` version over every row of ``data`` at once"""
+    X_new_selected = select_features(current, data, n_rows)
+    if current.tree_engine is not None:
+        return current.tree_engine.predict(X_new_selected)
+    return current.model['classifier'].predict(X_new_selected), current.model['regressor'].predict(X_new_selected)
+
+def ccs_percentages(current, ccs_predictions):
+    return convert_ccs_to_percentage(ccs_predictions, current.model['min_ccs'], current.model['max_ccs'])
+
+# Worker functions run on the inference pool, so they must stay at module level;
+# each reads the active model once and also converts the CCS with that version's
+# range, so a reload never mixes two versions
+def predict_pair(data_dict: Dict):
+    """Score a single cow/bull pair: (class, CCS, CCS percentage)"""
+    current = models.current
+    derived_data = calculate_derived_features(data_dict)
+    class_predictions, ccs_predictions = score_pairs(current, derived_data)
+    return class_predictions[0], ccs_predictions[0], ccs_percentages(current, ccs_predictions[0])
+
+def score_candidates(cow: Dict, bulls: List[Dict]):
+    """Score one cow against every bull in a single batch, with each bull's CCS percentage"""
+    current = models.current
+    # One row per candidate bull, with the cow's fields broadcast across rows. The ids
+    # come from the dicts: a frame column would turn omitted ones into NaN
+    bull_ids = [bull.get('bull_id') for bull in bulls]
+    data_df = pd.DataFrame(bulls).drop(columns='bull_id', errors='ignore')
+    for field, value in cow.items():
+        data_df[field] = value
+    derived_df = calculate_derived_features_frame(data_df[BREEDING_COLUMNS])
+
+    class_predictions, ccs_predictions = score_pairs(current, derived_df, len(derived_df))
+    return bull_ids, class_predictions, ccs_predictions, ccs_percentages(current, ccs_predictions)
+
+# Load the model at startup
+try:
+    models.preload()
+except FileNotFoundError:
+    print(f"Model file not found at {MODEL_PATH}")
+
 @app.post("/predict")
 async def predict_breeding(input_data: BreedingInput):
-    if model is None:
+    current = models.current
+    if current is None:
         return {"error": "Model not loaded"}
     
-    try:
-        # Convert input to dict and calculate derived features
-        data_dict = input_data.dict()
-        derived_data = calculate_derived_features(data_dict)
-        
-        # Convert to DataFrame
-        data_df = pd.DataFrame([derived_data])
-        
-        # Extract components
-        preprocessor = model['preprocessor']
-        selected_indices = model['selected_feature_indices']
-        classifier = model['classifier']
-        regressor = model['regressor']
-        min_ccs = model['min_ccs']
-        max_ccs = model['max_ccs']
-
-        # Preprocess data
-        X_new_processed = preprocessor.transform(data_df)
-        X_new_selected = X_new_processed[:, selected_indices]
-
-        # Make predictions
-        class_prediction = classifier.predict(X_new_selected)[0]
-        ccs_prediction = regressor.predict(X_new_selected)[0]
-        
-        # Format results
-        prediction_label = "Yes" if class_prediction == 1 else "No"
-        percentage = convert_ccs_to_percentage(ccs_prediction, min_ccs, max_ccs)
+    # Retried or duplicate submissions of a pair that is still being scored wait for that score
+    data_dict = input_data.dict()
+    key = (current.version, json.dumps(data_dict, sort_keys=True))
+    return await predict_flight.run(key, predict_input, data_dict)
+
+async def predict_input(data_dict: Dict):
+    async with pool.admit():
+        try:
+            # Make predictions; feature engineering runs in the same worker call
+            class_prediction, ccs_prediction, percentage = await pool.run(
+                predict_pair, data_dict, stage="model_forward"
+            )
+            
+            # Format results
+            prediction_label = "Yes" if class_prediction == 1 else "No"
+            
+            return {
+                "compatible": prediction_label,
+                "confidence_score": round(percentage, 2),
+                "raw_ccs_score": round(ccs_prediction, 2)
+            }
         
-        return {
-            "compatible": prediction_label,
-            "confidence_score": round(percentage, 2),
-            "raw_ccs_score": round(ccs_prediction, 2)
-        }
-    
-    except Exception as e:
-        return {"error": str(e)}
+        except Exception as e:
+            return {"error": str(e)}
+
+@app.post("/rank")
+async def rank_bulls(input_data: RankInput):
+    """Score one cow against many bulls in a single batch and return the top-k by CCS"""
+    current = models.current
+    if current is None:
+        return {"error": "Model not loaded"}
+
+    if input_data.bulls is not None:
+        bulls = [bull.dict() for bull in input_data.bulls]
+    else:
+        bulls = bull_catalogue
+    if not bulls:
+        return {"error": "No bulls provided and no bull catalogue loaded"}
+
+    metrics.observe("inference_batch_size", len(bulls))
+    async with pool.admit():
+        try:
+            bull_ids, class_predictions, ccs_predictions, percentages = await pool.run(
+                score_candidates, input_data.cow.dict(), bulls, stage="model_forward"
+            )
+            postprocess_start = time.perf_counter()
+
+            top_k = max(1, min(input_data.top_k, len(bulls)))
+            order = np.argsort(-ccs_predictions, kind='stable')[:top_k]
+
+            ranked = []
+            for rank, idx in enumerate(order, start=1):
+                idx = int(idx)
+                ranked.append({
+                    "rank": rank,
+                    "bull_id": bull_ids[idx] if bull_ids[idx] is not None else str(idx),
+                    "compatible": "Yes" if class_predictions[idx] == 1 else "No",
+                    "confidence_score": round(float(percentages[idx]), 2),
+                    "raw_ccs_score": round(float(ccs_predictions[idx]), 2)
+                })
+
+            metrics.observe("inference_stage_seconds", time.perf_counter() - postprocess_start, stage="postprocess")
+            return {"candidates": len(bulls), "top_bulls": ranked}
+
+        except Exception as e:
+            return {"error": str(e)}
+
+@app.on_event("startup")
+async def startup_event():
+    models.start_watching()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await models.stop_watching()
+    pool.shutdown()
 
 @app.get("/")
 async def read_root():
     return {"status": "Breeding Prediction API is running"}
 
+@app.get("/model-info")
+async def model_info():
+    current = models.current
+    return {
+        **models.info(),
+        "feature_pipeline": "compiled" if current is not None and current.feature_pipeline is not None else "sklearn",
+        "tree_engine": current.tree_engine.name if current is not None and current.tree_engine is not None else "sklearn",
+    }
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8000))
     uvicorn.run("main:app", host="0.0.0.0", port=port)
@@ -0,0 +1,195 @@
+"""
+Fast inference for the breeding classifier and regressor.
+
+sklearn tree ensembles (random forests, extra trees, single decision trees)
+are packed into flat NumPy node arrays and traversed together, so the
+classifier and regressor are evaluated in one vectorized pass over all of
+their trees without sklearn's per-call validation and thread dispatch. That
+wins for the small batches of /predict and /rank; large batches go back to
+sklearn's compiled traversal, which is faster once its overhead is amortized.
+XGBoost models are run through ``Booster.inplace_predict``. TREE_THREADS pins
+the thread count of both. Anything else stays on its own ``predict``.
+"""
+import os
+
+import numpy as np
+from sklearn.ensemble import ExtraTreesClassifier, ExtraTreesRegressor, RandomForestClassifier, RandomForestRegressor
+from sklearn.tree import DecisionTreeClassifier, DecisionTreeRegressor
+
+FOREST_TYPES = (RandomForestClassifier, RandomForestRegressor, ExtraTreesClassifier, ExtraTreesRegressor,
+                DecisionTreeClassifier, DecisionTreeRegressor)
+CLASSIFIER_TYPES = (RandomForestClassifier, ExtraTreesClassifier, DecisionTreeClassifier)
+
+# Upper bound on trees x rows per traversal chunk, to cap temporary arrays
+MAX_CHUNK_NODES = 1 << 20
+# Above this many trees x rows, sklearn's own predict is faster than the packed traversal
+MAX_PACKED_WORK = 1 << 13
+
+
+def _is_xgboost(model):
+    return type(model).__module__.startswith("xgboost") and hasattr(model, "get_booster")
+
+
+class PackedForests:
+    """
+    Several fitted sklearn tree ensembles flattened into shared node arrays.
+    ``predict`` returns one output array per model: class labels for
+    classifiers, values for regressors.
+    """
+
+    def __init__(self, models):
+        left, right, feature, threshold, roots = [], [], [], [], []
+        self._models = []
+        offset = 0
+        for model in models:
+            if getattr(model, "n_outputs_", 1) != 1:
+                raise NotImplementedError("multi-output trees are not supported")
+            estimators = getattr(model, "estimators_", None) or [model]
+            first_tree = len(roots)
+            node_offset = offset
+            values = []
+            for estimator in estimators:
+                tree = estimator.tree_
+                is_leaf = tree.children_left == -1
+                left.append(np.where(is_leaf, -1, tree.children_left + offset))
+                right.append(np.where(is_leaf, -1, tree.children_right + offset))
+                # Leaves keep feature 0 so the gather below stays in bounds
+                feature.append(np.where(is_leaf, 0, tree.feature))
+                threshold.append(tree.threshold)
+                roots.append(offset)
+                value = tree.value[:, 0, :]
+                if isinstance(model, CLASSIFIER_TYPES):
+                    # Same normalization as predict_proba
+                    value = value / value.sum(axis=1, keepdims=True)
+                values.append(value)
+                offset += tree.node_count
+            self._models.append({
+                "trees": slice(first_tree, len(roots)),
+                "node_offset": node_offset,
+                "values": np.concatenate(values),
+                "classes": model.classes_ if isinstance(model, CLASSIFIER_TYPES) else None,
+            })
+
+        self.left = np.concatenate(left)
+        self.right = np.concatenate(right)
+        self.feature = np.concatenate(feature).astype(np.intp)
+        self.threshold = np.concatenate(threshold)
+        self.is_leaf = self.left == -1
+        self.roots = np.array(roots, dtype=np.intp)
+
+    def _leaves(self, X):
+        # sklearn compares float32 features against float64 thresholds
+        X = np.asarray(X, dtype=np.float32)
+        rows = np.arange(len(X))[None, :]
+        node = np.repeat(self.roots[:, None], len(X), axis=1)
+        active = ~self.is_leaf[node]
+        while active.any():
+            go_left = X[rows, self.feature[node]] <= self.threshold[node]
+            node = np.where(active, np.where(go_left, self.left[node], self.right[node]), node)
+            active = ~self.is_leaf[node]
+        return node
+
+    def predict_values(self, X):
+        """Leaf values averaged over each model's trees: ``predict_proba`` for classifiers"""
+        X = np.asarray(X)
+        chunk = max(1, MAX_CHUNK_NODES // len(self.roots))
+        parts = [[] for _ in self._models]
+        for start in range(0, len(X), chunk):
+            leaves = self._leaves(X[start:start + chunk])
+            for k, model in enumerate(self._models):
+                values = model["values"][leaves[model["trees"]] - model["node_offset"]]
+                parts[k].append(values.mean(axis=0))
+        return [np.concatenate(part) if part else np.empty((0, model["values"].shape[1]))
+                for model, part in zip(self._models, parts)]
+
+    def predict(self, X):
+        outputs = []
+        for model, result in zip(self._models, self.predict_values(X)):
+            if model["classes"] is not None:
+                outputs.append(model["classes"][result.argmax(axis=1)])
+            else:
+                outputs.append(result[:, 0])
+        return outputs
+
+
+class XGBoostPredictor:
+    """``inplace_predict`` on the underlying booster, skipping DMatrix construction"""
+
+    def __init__(self, model, nthread=None):
+        self.booster = model.get_booster()
+        if nthread:
+            self.booster.set_param({"nthread": int(nthread)})
+        self.classes = getattr(model, "classes_", None)
+
+    def predict(self, X):
+        output = self.booster.inplace_predict(np.asarray(X, dtype=np.float32))
+        if self.classes is None:
+            return output
+        if output.ndim == 1:
+            return self.classes[(output > 0.5).astype(int)]
+        return self.classes[output.argmax(axis=1)]
+
+
+class TreeEngine:
+    """Runs the classifier and regressor over one feature matrix"""
+
+    def __init__(self, classifier, regressor, nthread=None):
+        self.classifier = classifier
+        self.regressor = regressor
+        self.forests = None
+        forests = [m for m in (classifier, regressor) if isinstance(m, FOREST_TYPES)]
+        if forests:
+            self.forests = PackedForests(forests)
+        for forest in forests:
+            if nthread and hasattr(forest, "n_jobs"):
+                forest.n_jobs = int(nthread)
+        self._slots = {}
+        for name, model in (("classifier", classifier), ("regressor", regressor)):
+            if isinstance(model, FOREST_TYPES):
+                self._slots[name] = ("forest", forests.index(model))
+            elif _is_xgboost(model):
+                self._slots[name] = ("xgboost", XGBoostPredictor(model, nthread))
+            else:
+                self._slots[name] = ("sklearn", model)
+        self.name = "+".join(kind for kind, _ in self._slots.values())
+
+    def predict(self, X, packed=None):
+        """(class labels, regression values); ``packed`` forces or skips the packed traversal"""
+        if packed is None:
+            packed = len(X) * len(self.forests.roots) <= MAX_PACKED_WORK if self.forests is not None else False
+        packed = packed and self.forests is not None
+        forest_outputs = self.forests.predict(X) if packed else None
+        results = []
+        for name, model in (("classifier", self.classifier), ("regressor", self.regressor)):
+            kind, target = self._slots[name]
+            if kind == "forest":
+                results.append(forest_outputs[target] if packed else model.predict(X))
+            else:
+                results.append(target.predict(X))
+        return results[0], results[1]
+
+
+def build_tree_engine(model, n_features, n_rows=256, seed=0):
+    """
+    TreeEngine for ``model`` unless TREE_ENGINE=sklearn, checked against the
+    sklearn predictions on random inputs; None if unsupported or mismatched.
+    TREE_THREADS pins the thread count of XGBoost and of sklearn forests.
+    """
+    if model is None or os.environ.get("TREE_ENGINE", "auto").lower() == "sklearn":
+        return None
+    nthread = os.environ.get("TREE_THREADS")
+    try:
+        engine = TreeEngine(model['classifier'], model['regressor'], nthread)
+        X = np.random.default_rng(seed).normal(0, 1.5, (n_rows, n_features))
+        classes, values = engine.predict(X, packed=True)
+        same = (
+            np.array_equal(classes, model['classifier'].predict(X))
+            and np.allclose(values, model['regressor'].predict(X), rtol=1e-6, atol=1e-9)
+        )
+    except Exception as e:
+        print(f"Tree engine unavailable, using sklearn predict: {e}")
+        return None
+    if not same:
+        print("Tree engine predictions differ from sklearn, using sklearn predict")
+        return None
+    return engine
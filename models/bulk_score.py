@@ -0,0 +1,343 @@
+"""
+Score images and records offline with the services' own model code, without
+HTTP.
+
+    cd models
+    python bulk_score.py breed-identification /data/audit/photos --output runs/breed-q3
+    python bulk_score.py disease-identify /data/audit/photos --output runs/disease-q3
+    python bulk_score.py breeding pairs.csv more_pairs.parquet --output runs/breeding-q3
+    python bulk_score.py disease-qna symptoms.csv --output runs/qna-q3
+
+Inputs are split into shards of --shard-size items that --workers processes
+(default: one per core, each with one native thread) score in parallel. Every
+worker imports the service's main.py and loads its model once, then calls its
+preprocessing, model and formatting functions directly:
+
+    breed-identification, disease-identify  image files, or directories searched recursively
+    breeding                                CSV/Parquet rows with the /predict fields
+    disease-qna                             CSV/Parquet rows with a ``symptoms`` column
+                                            (names separated by ``;``, ``,`` or ``|``) or
+                                            one 0/1 column per symptom
+
+Each finished shard is written to <output>/shards/ in one atomic rename, so
+rerunning the same command after an interruption only scores the shards that
+are missing. The run refuses to resume when the inputs or shard size changed;
+--restart discards the finished shards instead. When every shard is done their
+lines are joined, in input order, into <output>/results.jsonl. Every line names
+its input (``path``, or ``input`` and ``row``, plus ``id`` when the rows have an
+--id-column) and holds the service's response fields or an ``error``.
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+logger = logging.getLogger("bulk_score")
+
+MODELS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Service name -> (directory, input kind)
+SERVICES = {
+    "breed-identification": ("breed-identification", "images"),
+    "breeding": ("breeding_model", "records"),
+    "disease-identify": ("disease_identify", "images"),
+    "disease-qna": ("disease-qna", "records"),
+}
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+TABLE_EXTENSIONS = (".csv", ".parquet", ".pq")
+DEFAULT_SHARD_SIZE = {"images": 256, "records": 4096}
+
+# Set in each worker process by init_worker
+_service = None
+_module = None
+
+
+# ---------------------------------------------------------------------------
+# Inputs and shards
+# ---------------------------------------------------------------------------
+
+def list_images(inputs):
+    """Image files under ``inputs`` (files or directories), sorted per input"""
+    paths = []
+    for path in inputs:
+        if os.path.isdir(path):
+            found = [
+                os.path.join(directory, name)
+                for directory, _, names in os.walk(path)
+                for name in names if name.lower().endswith(IMAGE_EXTENSIONS)
+            ]
+            paths.extend(sorted(found))
+        elif os.path.isfile(path):
+            paths.append(path)
+        else:
+            raise SystemExit(f"No such file or directory: {path}")
+    return [os.path.abspath(path) for path in paths]
+
+
+def read_table(path):
+    if path.lower().endswith(".csv"):
+        frame = pd.read_csv(path)
+    else:
+        frame = pd.read_parquet(path)
+    # Plain Python values with None for missing cells, so rows pickle small and serialise to JSON
+    return frame.astype(object).where(frame.notna(), None).to_dict("records")
+
+
+def list_records(inputs, id_column):
+    """One item per table row: input path, row number, id and the row's fields"""
+    items = []
+    for path in inputs:
+        if not path.lower().endswith(TABLE_EXTENSIONS):
+            raise SystemExit(f"Expected a CSV or Parquet file: {path}")
+        path = os.path.abspath(path)
+        for row, fields in enumerate(read_table(path)):
+            items.append({"input": path, "row": row, "id": fields.get(id_column), "fields": fields})
+    return items
+
+
+def fingerprint(service, inputs, shard_size):
+    """Identifies a run plan; the inputs count by name, size and modification time"""
+    files = []
+    for path in inputs:
+        paths = list_images([path]) if os.path.isdir(path) else [os.path.abspath(path)]
+        for name in paths:
+            stat = os.stat(name)
+            files.append([name, stat.st_size, stat.st_mtime_ns])
+    plan = json.dumps({"service": service, "shard_size": shard_size, "files": files}, sort_keys=True)
+    return hashlib.sha256(plan.encode("utf-8")).hexdigest()
+
+
+def shard_path(output, index):
+    return os.path.join(output, "shards", f"{index:06d}.jsonl")
+
+
+# ---------------------------------------------------------------------------
+# Worker processes
+# ---------------------------------------------------------------------------
+
+def init_worker(service, threads):
+    """Cap native threads, then import the service and load its model"""
+    global _service, _module
+    directory = os.path.join(MODELS_DIR, SERVICES[service][0])
+    sys.path.insert(0, directory)
+    from serve import limit_threads
+
+    limit_threads(threads)
+    os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "2")
+    import importlib.util
+
+    spec = importlib.util.spec_from_file_location("service_main", os.path.join(directory, "main.py"))
+    _module = importlib.util.module_from_spec(spec)
+    sys.modules["service_main"] = _module
+    spec.loader.exec_module(_module)
+    if _module.models.current is None:
+        _module.models.load()
+    _service = service
+
+
+def score_images(items):
+    width, height = _module.IMAGE_SIZE
+    batch = np.empty((len(items), height, width, 3), dtype=np.float32)
+    errors = {}
+    for i, path in enumerate(items):
+        try:
+            with open(path, "rb") as f:
+                _module.load_image(f.read(), batch[i:i + 1])
+        except Exception as e:
+            errors[i] = f"Error processing image: {e}"
+
+    decoded = [i for i in range(len(items)) if i not in errors]
+    predictions = _module.models.current.backend.predict(batch[decoded]) if decoded else []
+    outputs = dict(zip(decoded, predictions))
+    return [
+        {"error": errors[i]} if i in errors else _module.format_predictions(outputs[i])
+        for i in range(len(items))
+    ]
+
+
+def score_breeding(items):
+    current = _module.models.current
+    results = [None] * len(items)
+    valid, rows = [], []
+    for i, item in enumerate(items):
+        try:
+            # Missing optional fields take the same defaults as /predict
+            fields = {name: value for name, value in item["fields"].items() if value is not None}
+            rows.append(_module.BreedingInput(**fields).dict())
+            valid.append(i)
+        except Exception as e:
+            results[i] = {"error": f"Invalid record: {e}"}
+
+    if rows:
+        derived = _module.calculate_derived_features_frame(pd.DataFrame(rows)[_module.BREEDING_COLUMNS])
+        class_predictions, ccs_predictions = _module.score_pairs(current, derived, len(derived))
+        for i, class_prediction, ccs_prediction in zip(valid, class_predictions, ccs_predictions):
+            percentage = _module.convert_ccs_to_percentage(
+                ccs_prediction, current.model['min_ccs'], current.model['max_ccs'])
+            results[i] = {
+                "compatible": "Yes" if class_prediction == 1 else "No",
+                "confidence_score": round(float(percentage), 2),
+                "raw_ccs_score": round(float(ccs_prediction), 2),
+            }
+    return results
+
+
+def symptoms_of(fields):
+    if fields.get("symptoms") is not None:
+        return [name.strip() for name in re.split(r"[;,|]", str(fields["symptoms"])) if name.strip()]
+    return [name for name, value in fields.items()
+            if name in _module.symptom_index and value not in (None, 0, "0", False, "")]
+
+
+def score_symptoms(items):
+    keys = [_module.canonical_symptoms(symptoms_of(item["fields"])) for item in items]
+    # Audit files repeat symptom sets a lot; each distinct set goes through the model once
+    distinct = sorted(set(keys))
+    predictions = _module.models.current.model.predict(_module.encode_symptom_keys(distinct)) if distinct else []
+    by_key = dict(zip(distinct, (int(p) for p in predictions)))
+    return [{"prediction": by_key[key]} for key in keys]
+
+
+SCORERS = {
+    "breed-identification": score_images,
+    "breeding": score_breeding,
+    "disease-identify": score_images,
+    "disease-qna": score_symptoms,
+}
+
+
+def score_shard(index, items, output):
+    """Score one shard and write its lines atomically; returns (index, items, errors, seconds)"""
+    start = time.perf_counter()
+    results = SCORERS[_service](items)
+    version = _module.models.current.version
+
+    path = shard_path(output, index)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        for item, result in zip(items, results):
+            if isinstance(item, str):
+                source = {"path": item}
+            else:
+                source = {"input": item["input"], "row": item["row"]}
+                if item["id"] is not None:
+                    source["id"] = item["id"]
+            f.write(json.dumps({**source, **result, "model_version": version}, default=str) + "\n")
+    os.replace(path + ".tmp", path)
+    errors = sum(1 for result in results if "error" in result)
+    return index, len(items), errors, time.perf_counter() - start
+
+
+# ---------------------------------------------------------------------------
+# Driver
+# ---------------------------------------------------------------------------
+
+def prepare_output(output, plan, restart):
+    """Create or check ``output`` for ``plan``; returns the shards already finished"""
+    manifest_path = os.path.join(output, "manifest.json")
+    if restart and os.path.exists(output):
+        shutil.rmtree(os.path.join(output, "shards"), ignore_errors=True)
+        for name in ("manifest.json", "results.jsonl"):
+            if os.path.exists(os.path.join(output, name)):
+                os.remove(os.path.join(output, name))
+
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            previous = json.load(f)
+        if previous["fingerprint"] != plan["fingerprint"]:
+            raise SystemExit(f"{output} holds a run with different inputs or shard size; "
+                             f"use another --output or --restart")
+    os.makedirs(os.path.join(output, "shards"), exist_ok=True)
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(plan, f, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    return {index for index in range(plan["shards"]) if os.path.exists(shard_path(output, index))}
+
+
+def merge_shards(output, n_shards):
+    path = os.path.join(output, "results.jsonl")
+    with open(path + ".tmp", "wb") as merged:
+        for index in range(n_shards):
+            with open(shard_path(output, index), "rb") as f:
+                shutil.copyfileobj(f, merged)
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("service", choices=sorted(SERVICES))
+    parser.add_argument("inputs", nargs="+", help="image files/directories, or CSV/Parquet files")
+    parser.add_argument("--output", required=True, help="run directory; rerun with the same one to resume")
+    parser.add_argument("--workers", type=int, default=0, help="worker processes (default: one per core)")
+    parser.add_argument("--threads", type=int, default=0,
+                        help="native threads per worker (default: cores / workers)")
+    parser.add_argument("--shard-size", type=int, default=0,
+                        help="items per shard (default: 256 images or 4096 records)")
+    parser.add_argument("--id-column", default="id", help="record column copied to the output as id")
+    parser.add_argument("--restart", action="store_true", help="discard finished shards and start over")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    directory, kind = SERVICES[args.service]
+    sys.path.insert(0, os.path.join(MODELS_DIR, directory))
+    from serve import available_cpus
+
+    shard_size = args.shard_size or DEFAULT_SHARD_SIZE[kind]
+    items = list_images(args.inputs) if kind == "images" else list_records(args.inputs, args.id_column)
+    shards = [items[i:i + shard_size] for i in range(0, len(items), shard_size)]
+    plan = {
+        "service": args.service,
+        "inputs": [os.path.abspath(path) for path in args.inputs],
+        "shard_size": shard_size,
+        "items": len(items),
+        "shards": len(shards),
+        "fingerprint": fingerprint(args.service, args.inputs, shard_size),
+    }
+    done = prepare_output(args.output, plan, args.restart)
+    pending = [index for index in range(len(shards)) if index not in done]
+    logger.info(f"{len(items)} items in {len(shards)} shards, {len(done)} already scored")
+
+    if pending:
+        cpus = available_cpus()
+        workers = min(args.workers or cpus, len(pending))
+        threads = args.threads or max(1, cpus // workers)
+        logger.info(f"Scoring {len(pending)} shards with {workers} workers x {threads} threads")
+        # Spawned, not forked: TensorFlow does not survive a fork
+        context = multiprocessing.get_context("spawn")
+        start = time.perf_counter()
+        scored = errors = 0
+        with concurrent.futures.ProcessPoolExecutor(
+                workers, mp_context=context, initializer=init_worker, initargs=(args.service, threads)
+        ) as executor:
+            futures = [executor.submit(score_shard, index, shards[index], args.output) for index in pending]
+            try:
+                for n, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                    index, count, shard_errors, seconds = future.result()
+                    scored += count
+                    errors += shard_errors
+                    logger.info(f"[{n}/{len(pending)}] shard {index}: {count} items, {shard_errors} errors "
+                                f"in {seconds:.1f}s ({scored / (time.perf_counter() - start):.1f} items/s)")
+            except BaseException:
+                # Finished shards are kept; the rest are scored when the run is resumed
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise
+        logger.info(f"Scored {scored} items ({errors} errors) in {time.perf_counter() - start:.1f}s")
+
+    logger.info(f"Results in {merge_shards(args.output, len(shards))}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,23 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
-from typing import List
+from typing import Dict, List, Tuple
+from collections import Counter, OrderedDict
 import joblib
+import json
 import numpy as np
 import uvicorn
 import os
 from fastapi.middleware.cors import CORSMiddleware  # Import the CORS middleware
 
-# Load the trained model from the .pkl file
-model = joblib.load("model/ensemble_model_cattle_disease_prediction.pkl")
+from artifacts import artifact_path, load_model
+from neighbors import build_hamming_ensemble
+from serving import InferencePool, ModelManager, PoolSaturated, SingleFlight, metrics, pool_saturated_handler
+
+# Paths resolve against this directory so the service can start from anywhere
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Trained model; MODEL_PATH points the service at another model file
+MODEL_PATH = os.environ.get("MODEL_PATH", os.path.join(BASE_DIR, "model", "ensemble_model_cattle_disease_prediction.pkl"))
 
 # Define a FastAPI app
 app = FastAPI()
@@ -22,6 +31,25 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Bounded executor for model calls; INFERENCE_EXECUTOR=process runs the ensemble in worker processes
+pool = InferencePool.from_env()
+app.add_exception_handler(PoolSaturated, pool_saturated_handler)
+metrics.track_pool(pool)
+
+# Stage latency histograms and cache counters on /metrics
+metrics.install(app)
+
+# Identical symptom sets waiting on the model share one prediction
+predict_flight = SingleFlight("symptom_predict")
+metrics.track_flight(predict_flight)
+
+# Predictions for recently seen symptom sets; 0 disables the cache
+SYMPTOM_CACHE_SIZE = int(os.environ.get("SYMPTOM_CACHE_SIZE", 4096))
+# Optional query log (one JSON list or comma-separated symptom set per line) used
+# to precompute the SYMPTOM_WARMUP_TOP most frequent symptom sets at startup
+SYMPTOM_LOG_PATH = os.environ.get("SYMPTOM_LOG_PATH")
+SYMPTOM_WARMUP_TOP = int(os.environ.get("SYMPTOM_WARMUP_TOP", 1000))
+
 # Define the symptom list (same order as used during model training)
 symptom_list = ['anorexia', 'abdominal_pain', 'anaemia', 'abortions', 'acetone', 'aggression', 'arthrogyposis',
     'ankylosis', 'anxiety', 'bellowing', 'blood_loss', 'blood_poisoning', 'blisters', 'colic', 'Condemnation_of_livers',
@@ -38,31 +66,278 @@ symptom_list = ['anorexia', 'abdominal_pain', 'anaemia', 'abortions', 'acetone',
     'torticollis', 'udder_swelling', 'udder_heat', 'udder_hardeness', 'udder_redness', 'udder_pain', 'unwillingness_to_move',
     'ulcers', 'vomiting', 'weight_loss', 'weakness']
 
+# Column of each symptom in the input vector
+symptom_index = {symptom: i for i, symptom in enumerate(symptom_list)}
+
 # Create a Pydantic model to handle incoming data
 class SymptomInput(BaseModel):
     symptoms: List[str]
 
+class BatchSymptomInput(BaseModel):
+    symptom_sets: List[List[str]]
+    include_probabilities: bool = False
+
+def canonical_symptoms(symptoms: List[str]) -> Tuple[int, ...]:
+    """Sorted, de-duplicated input columns of a symptom list; unknown symptoms are ignored"""
+    return tuple(sorted({symptom_index[symptom] for symptom in symptoms if symptom in symptom_index}))
+
+def encode_symptom_keys(keys: List[Tuple[int, ...]]) -> np.ndarray:
+    """Build the binary input matrix from canonical symptom sets, one row each"""
+    input_matrix = np.zeros((len(keys), len(symptom_list)))
+    for row, key in enumerate(keys):
+        input_matrix[row, list(key)] = 1
+    return input_matrix
+
+def encode_symptoms(symptom_sets: List[List[str]]) -> np.ndarray:
+    """Build the binary input matrix, one row per symptom list"""
+    return encode_symptom_keys([canonical_symptoms(symptoms) for symptoms in symptom_sets])
+
+class SymptomCache:
+    """
+    LRU map from canonical symptom sets to predicted diseases. Entries added
+    with ``pin`` (the warm-up table) are never evicted.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._pinned: Dict[Tuple[int, ...], int] = {}
+        self._recent: "OrderedDict[Tuple[int, ...], int]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        if key in self._pinned:
+            self.hits += 1
+            return self._pinned[key]
+        if key in self._recent:
+            self._recent.move_to_end(key)
+            self.hits += 1
+            return self._recent[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, disease: int):
+        if self.max_entries <= 0 or key in self._pinned:
+            return
+        self._recent[key] = disease
+        self._recent.move_to_end(key)
+        while len(self._recent) > self.max_entries:
+            self._recent.popitem(last=False)
+            self.evictions += 1
+
+    def pin(self, key, disease: int):
+        self._recent.pop(key, None)
+        self._pinned[key] = disease
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._recent),
+            "pinned_entries": len(self._pinned),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+
+def read_symptom_log(path: str) -> Counter:
+    """Count canonical symptom sets in a query log"""
+    counts = Counter()
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('['):
+                symptoms = json.loads(line)
+            else:
+                symptoms = [symptom.strip() for symptom in line.split(',')]
+            counts[canonical_symptoms(symptoms)] += 1
+    return counts
+
+def build_symptom_cache(model) -> SymptomCache:
+    """
+    A symptom cache for ``model``, with the SYMPTOM_WARMUP_TOP most frequent
+    symptom sets of the query log precomputed when SYMPTOM_LOG_PATH is set
+    """
+    cache = SymptomCache(SYMPTOM_CACHE_SIZE)
+    if not SYMPTOM_LOG_PATH:
+        return cache
+    try:
+        counts = read_symptom_log(SYMPTOM_LOG_PATH)
+    except (OSError, ValueError) as e:
+        print(f"Could not read symptom log {SYMPTOM_LOG_PATH}: {e}")
+        return cache
+
+    keys = [key for key, _ in counts.most_common(SYMPTOM_WARMUP_TOP)]
+    if keys:
+        predictions = model.predict(encode_symptom_keys(keys))
+        for key, disease in zip(keys, predictions.astype(int).tolist()):
+            cache.pin(key, disease)
+        print(f"Precomputed {len(keys)} symptom sets from {SYMPTOM_LOG_PATH}")
+    return cache
+
+def load_disease_model(path: str) -> Dict:
+    """
+    The ensemble from ``path`` (or the artifact exported next to it with
+    python artifacts.py export) and its own symptom cache, so cached
+    predictions never outlive the model version that made them. KNN members
+    answer through a bit-packed Hamming index when it matches sklearn.
+    """
+    model, _ = load_model(path, joblib.load)
+    fast_model = build_hamming_ensemble(model, len(symptom_list))
+    return {
+        "model": fast_model or model,
+        "knn_engine": "hamming" if fast_model is not None else "sklearn",
+        "symptom_cache": build_symptom_cache(fast_model or model)
+    }
+
+def warm_up_disease_model(candidate):
+    """Predict a few symptom sets with a newly loaded model before it is swapped in"""
+    predictions = candidate.model.predict(encode_symptom_keys([(), (0,), tuple(range(len(symptom_list)))]))
+    if len(predictions) != 3:
+        raise ValueError("model returned the wrong number of predictions")
+
+def model_files(path: str) -> List[str]:
+    return [path, os.path.join(artifact_path(path), "manifest.json")]
+
+# The active model version, replaced atomically by POST /admin/reload or, with
+# MODEL_WATCH_INTERVAL set, when the model files change
+models = ModelManager(
+    MODEL_PATH, load_disease_model, warmup=warm_up_disease_model,
+    on_swap=lambda new, old: pool.recycle(), watch_files=model_files
+)
+models.install(app)
+models.preload()
+
+def symptom_cache_series(*fields):
+    # Nothing to report while no model is loaded (the gateway loads models on first use)
+    current = models.current
+    if current is None:
+        return []
+    return [(labels, getattr(current.symptom_cache, field)) for labels, field in fields]
+
+metrics.collect("symptom_cache_lookups_total", "counter", "Symptom cache lookups by result",
+                lambda: symptom_cache_series(({"result": "hit"}, "hits"), ({"result": "miss"}, "misses")))
+metrics.collect("symptom_cache_evictions_total", "counter", "Entries evicted from the symptom cache",
+                lambda: symptom_cache_series(({}, "evictions")))
+
+# Worker functions run on the inference pool, so they must stay at module level;
+# each reads the active model once and reports which version it used
+def worker_model():
+    current = models.current
+    if current is None:
+        raise RuntimeError("Model not loaded")
+    return current
+
+def predict_symptom_keys(keys: List[Tuple[int, ...]]) -> Tuple[str, np.ndarray]:
+    current = worker_model()
+    return current.version, current.model.predict(encode_symptom_keys(keys))
+
+def predict_symptom_probabilities(symptom_sets: List[List[str]]) -> Tuple[str, np.ndarray, np.ndarray]:
+    current = worker_model()
+    probabilities = current.model.predict_proba(encode_symptoms(symptom_sets))
+    return current.version, current.model.classes_[probabilities.argmax(axis=1)], probabilities.max(axis=1)
+
+
+def loaded_model():
+    """The active model version, or 503 while none is loaded"""
+    current = models.current
+    if current is None:
+        raise HTTPException(status_code=503, detail="Model not loaded")
+    return current
+
+
+async def predict_cached(current, keys: List[Tuple[int, ...]]) -> List[int]:
+    """Predict canonical symptom sets with ``current``, running the model only for uncached, distinct sets"""
+    results = [current.symptom_cache.get(key) for key in keys]
+    missing = sorted({key for key, result in zip(keys, results) if result is None})
+    if not missing:
+        return results
+
+    # Identical requests (a retried symptom set, a resent batch) share one model call
+    computed = await predict_flight.run((current.version, tuple(missing)), predict_missing, current, missing)
+    return [result if result is not None else computed[key] for key, result in zip(keys, results)]
+
+
+async def predict_missing(current, missing: List[Tuple[int, ...]]) -> Dict[Tuple[int, ...], int]:
+    """Run the model on uncached symptom sets and cache its predictions"""
+    metrics.observe("inference_batch_size", len(missing))
+    async with pool.admit():
+        version, predictions = await pool.run(predict_symptom_keys, missing, stage="model_forward")
+    computed = dict(zip(missing, predictions.astype(int).tolist()))
+    # A reload may have swapped the model meanwhile; only cache what this version predicted
+    if version == current.version:
+        for key, disease in computed.items():
+            current.symptom_cache.put(key, disease)
+    return computed
 
 
 @app.post("/predict")
-def predict_disease(input_data: SymptomInput):
-    symptoms = input_data.symptoms
-    
-    # Initialize an input vector for prediction (all zeros)
-    input_vector = np.zeros(len(symptom_list))
-    
-    # Fill the input vector based on the symptoms provided
-    for symptom in symptoms:
-        if symptom in symptom_list:
-            input_vector[symptom_list.index(symptom)] = 1
-    
+async def predict_disease(input_data: SymptomInput):
     # Predict the disease (using the trained model)
-    prediction = model.predict([input_vector])
+    current = loaded_model()
+    with metrics.time("inference_stage_seconds", stage="preprocess"):
+        key = canonical_symptoms(input_data.symptoms)
+    prediction = await predict_cached(current, [key])
     disease = int(prediction[0])  # Convert numpy.int64 to Python int
     
     return {"prediction": disease}
 
 
+@app.post("/predict/batch")
+async def predict_disease_batch(input_data: BatchSymptomInput):
+    """Predict diseases for many symptom lists with a single model call"""
+    current = loaded_model()
+    if not input_data.symptom_sets:
+        return {"predictions": []}
+
+    if input_data.include_probabilities:
+        # Only soft-voting ensembles expose predict_proba
+        if not hasattr(current.model, "predict_proba"):
+            raise HTTPException(status_code=400, detail="Model does not provide probabilities")
+        metrics.observe("inference_batch_size", len(input_data.symptom_sets))
+        async with pool.admit():
+            version, predictions, probabilities = await pool.run(
+                predict_symptom_probabilities, input_data.symptom_sets, stage="model_forward"
+            )
+        # Probabilities differ between versions, so say which one produced them
+        return {
+            "predictions": predictions.astype(int).tolist(),
+            "probabilities": probabilities.round(4).tolist(),
+            "model_version": version
+        }
+
+    with metrics.time("inference_stage_seconds", stage="preprocess"):
+        keys = [canonical_symptoms(symptoms) for symptoms in input_data.symptom_sets]
+    return {"predictions": await predict_cached(current, keys)}
+
+
+@app.get("/cache-stats")
+def cache_stats():
+    return {**loaded_model().symptom_cache.stats(), "singleflight": predict_flight.stats()}
+
+
+@app.get("/model-info")
+def model_info():
+    current = models.current
+    return {**models.info(), "knn_engine": current.knn_engine if current is not None else None}
+
+
+@app.on_event("startup")
+def startup_event():
+    models.start_watching()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await models.stop_watching()
+    pool.shutdown()
+
+
 # Health check endpoint
 @app.get("/")
 def read_root():
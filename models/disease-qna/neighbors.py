@@ -0,0 +1,222 @@
+"""
+Exact nearest-neighbour search for the symptom ensemble's KNN member.
+
+The inputs are binary symptom vectors, so every distance the KNN may use
+(Minkowski for any p, Euclidean, Manhattan, Hamming) is a monotone function of
+the number of symptoms two vectors differ in. At load time the training
+matrix is reduced to its distinct symptom patterns, each packed into 64-bit
+words with a count of the training rows per class that share it. A query is
+an XOR and a popcount per word against every pattern, and the votes follow
+from the pattern counts, so the cost grows with the number of distinct
+patterns rather than with the number of training rows.
+
+sklearn breaks ties at the k-th distance in whatever order its chunked search
+visits the rows, so a query where rows of different classes tie for the last
+neighbour slots is answered by sklearn; every other query gets the same
+votes from the index. The index is checked against sklearn before it is
+used. KNN_ENGINE=sklearn keeps sklearn's own search.
+"""
+import copy
+import os
+
+import numpy as np
+from sklearn.ensemble import VotingClassifier
+from sklearn.neighbors import KNeighborsClassifier
+
+# Distances that only depend on the Hamming distance of binary vectors
+HAMMING_METRICS = {"euclidean", "l2", "manhattan", "l1", "cityblock", "minkowski", "hamming"}
+# Upper bound on queries x patterns per distance chunk, to cap temporary arrays
+MAX_CHUNK_PAIRS = 1 << 20
+
+# Set bits of every byte value, for NumPy versions without bitwise_count
+_BYTE_POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint8)
+
+
+def _is_binary(X):
+    return bool(np.all((X == 0) | (X == 1)))
+
+
+def pack_rows(X):
+    """Binary rows as uint64 words, one bit per column"""
+    packed = np.packbits(np.asarray(X) != 0, axis=1)
+    padding = -packed.shape[1] % 8
+    if padding:
+        packed = np.pad(packed, ((0, 0), (0, padding)))
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+
+def hamming_distances(queries, words):
+    """Differing bits between every packed query and every packed pattern"""
+    differing = queries[:, None, :] ^ words[None, :, :]
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(differing).sum(axis=2, dtype=np.intp)
+    return _BYTE_POPCOUNT[differing.view(np.uint8)].sum(axis=2, dtype=np.intp)
+
+
+class HammingKNeighbors:
+    """
+    Drop-in ``predict``/``predict_proba`` for a KNeighborsClassifier fitted on
+    binary vectors. Non-binary inputs go to the original estimator.
+    """
+
+    def __init__(self, knn):
+        if not isinstance(knn, KNeighborsClassifier):
+            raise TypeError(f"{type(knn).__name__} is not a KNeighborsClassifier")
+        params = {name: value for name, value in knn.effective_metric_params_.items() if value is not None}
+        if knn.effective_metric_ not in HAMMING_METRICS or set(params) - {"p"}:
+            raise NotImplementedError(f"metric {knn.effective_metric_} is not supported")
+        if knn.weights not in ("uniform", "distance") or knn.outputs_2d_:
+            raise NotImplementedError("only single-output, uniform or distance weighted KNN is supported")
+        X = knn._fit_X
+        if not isinstance(X, np.ndarray) or not _is_binary(X):
+            raise NotImplementedError("the training matrix is not binary")
+        if knn.n_neighbors > len(X):
+            raise NotImplementedError("n_neighbors is larger than the training set")
+
+        self.knn = knn
+        self.classes_ = knn.classes_
+        self.n_features_in_ = X.shape[1]
+        self.n_neighbors = knn.n_neighbors
+        self.weights = knn.weights
+        self.metric = knn.effective_metric_
+        self.p = params.get("p", 2)
+
+        words = pack_rows(X)
+        self.words, rows = np.unique(words, axis=0, return_inverse=True)
+        rows = rows.reshape(-1)
+        # Training rows per (pattern, class)
+        self.class_counts = np.zeros((len(self.words), len(self.classes_)))
+        np.add.at(self.class_counts, (rows, np.asarray(knn._y, dtype=np.intp)), 1)
+        self.pattern_rows = self.class_counts.sum(axis=1)
+
+    def _weight(self, hamming):
+        # Neighbour weight at a Hamming distance, before sklearn's exact-match rule
+        if self.weights == "uniform":
+            return np.ones(np.shape(hamming))
+        if self.metric in ("manhattan", "l1", "cityblock"):
+            distance = np.asarray(hamming, dtype=np.float64)
+        elif self.metric == "hamming":
+            distance = np.asarray(hamming) / self.n_features_in_
+        elif self.metric in ("euclidean", "l2"):
+            distance = np.sqrt(hamming)
+        else:
+            distance = np.asarray(hamming, dtype=np.float64) ** (1.0 / self.p)
+        with np.errstate(divide="ignore"):
+            return 1.0 / distance
+
+    def _chunk_votes(self, hamming):
+        k = self.n_neighbors
+        n_queries = len(hamming)
+        n_distances = self.n_features_in_ + 1
+        # Training rows at each distance, to find the k-th neighbour's distance
+        per_distance = np.bincount(
+            (np.arange(n_queries)[:, None] * n_distances + hamming).ravel(),
+            np.broadcast_to(self.pattern_rows, hamming.shape).ravel(),
+            minlength=n_queries * n_distances
+        ).reshape(n_queries, n_distances)
+        kth = (per_distance.cumsum(axis=1) >= k).argmax(axis=1)
+        below = hamming < kth[:, None]
+        at_kth = hamming == kth[:, None]
+
+        weights = self._weight(hamming)
+        kth_weight = self._weight(kth)
+        if self.weights == "distance":
+            # Same as sklearn: exact matches, when there are any, get all the weight
+            exact_rows = hamming.min(axis=1) == 0
+            weights[exact_rows] = hamming[exact_rows] == 0
+            kth_weight[exact_rows] = kth[exact_rows] == 0
+        votes = (below * weights) @ self.class_counts
+        below_rows = below.astype(np.float64) @ self.pattern_rows
+
+        # The rest of the k neighbours come from the patterns at the k-th distance
+        at_kth_counts = at_kth.astype(np.float64) @ self.class_counts
+        at_kth_rows = at_kth_counts.sum(axis=1)
+        needed = k - below_rows
+        votes += at_kth_counts * (needed / at_kth_rows * kth_weight)[:, None]
+        ambiguous = (needed < at_kth_rows) & ((at_kth_counts > 0).sum(axis=1) > 1)
+        return votes, ambiguous
+
+    def _votes(self, X):
+        """Class votes per query, and which queries sklearn has to answer"""
+        queries = pack_rows(X)
+        chunk = max(1, MAX_CHUNK_PAIRS // len(self.words))
+        votes, ambiguous = [], []
+        for start in range(0, len(queries), chunk):
+            hamming = hamming_distances(queries[start:start + chunk], self.words)
+            chunk_votes, chunk_ambiguous = self._chunk_votes(hamming)
+            votes.append(chunk_votes)
+            ambiguous.append(chunk_ambiguous)
+        if not votes:
+            return np.empty((0, len(self.classes_))), np.empty(0, dtype=bool)
+        return np.concatenate(votes), np.concatenate(ambiguous)
+
+    def predict(self, X):
+        X = np.asarray(X)
+        if not _is_binary(X):
+            return self.knn.predict(X)
+        votes, ambiguous = self._votes(X)
+        predictions = self.classes_[votes.argmax(axis=1)]
+        if ambiguous.any():
+            predictions[ambiguous] = self.knn.predict(X[ambiguous])
+        return predictions
+
+    def predict_proba(self, X):
+        X = np.asarray(X)
+        if not _is_binary(X):
+            return self.knn.predict_proba(X)
+        votes, ambiguous = self._votes(X)
+        totals = votes.sum(axis=1, keepdims=True)
+        totals[totals == 0] = 1.0
+        probabilities = votes / totals
+        if ambiguous.any():
+            probabilities[ambiguous] = self.knn.predict_proba(X[ambiguous])
+        return probabilities
+
+
+def _with_hamming_members(model):
+    # A shallow copy of the ensemble whose KNN members are swapped; the others are shared
+    if isinstance(model, KNeighborsClassifier):
+        return HammingKNeighbors(model)
+    if isinstance(model, VotingClassifier):
+        members = [HammingKNeighbors(m) if isinstance(m, KNeighborsClassifier) else m for m in model.estimators_]
+        if not any(isinstance(m, HammingKNeighbors) for m in members):
+            return None
+        fast = copy.copy(model)
+        fast.estimators_ = members
+        return fast
+    return None
+
+
+def build_hamming_ensemble(model, n_features, n_rows=256, seed=0):
+    """
+    ``model`` with its KNN members served by HammingKNeighbors unless
+    KNN_ENGINE=sklearn, checked against the sklearn predictions on training
+    rows and random symptom sets; None if unsupported or mismatched.
+    """
+    if model is None or os.environ.get("KNN_ENGINE", "auto").lower() == "sklearn":
+        return None
+    try:
+        fast = _with_hamming_members(model)
+        if fast is None:
+            return None
+        knn = fast if isinstance(fast, HammingKNeighbors) else next(
+            m for m in fast.estimators_ if isinstance(m, HammingKNeighbors))
+        rng = np.random.default_rng(seed)
+        training = knn.knn._fit_X[rng.permutation(len(knn.knn._fit_X))[:n_rows]]
+        # Sparse random sets, and dense ones far from everything where ties are most likely
+        density = max(float(training.mean()), 1.0 / n_features)
+        X = np.concatenate([
+            training,
+            (rng.random((n_rows, n_features)) < density).astype(np.float64),
+            (rng.random((n_rows // 4, n_features)) < 0.5).astype(np.float64),
+        ])
+        same = np.array_equal(fast.predict(X), model.predict(X))
+        if same and getattr(model, "voting", "soft") == "soft":
+            same = np.allclose(fast.predict_proba(X), model.predict_proba(X), rtol=1e-9, atol=1e-12)
+    except Exception as e:
+        print(f"Hamming KNN index unavailable, using sklearn: {e}")
+        return None
+    if not same:
+        print("Hamming KNN predictions differ from sklearn, using sklearn")
+        return None
+    return fast
@@ -1,13 +1,22 @@
 import os
 import io
+import json
+import asyncio
 import numpy as np
 import tensorflow as tf
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from PIL import Image
 import uvicorn
 from typing import List
 
+from backends import select_backend
+from serving import (
+    AdmittedStreamingResponse, InferencePool, MicroBatcher, PoolSaturated, PredictionCache, is_archive, metrics,
+    read_archive, ModelManager, SingleFlight, pool_saturated_handler
+)
+
 # Create FastAPI app
 app = FastAPI(title="MobileNet Model API", 
               description="API for image classification using MobileNet",
@@ -22,26 +31,67 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Configure these variables
-MODEL_PATH = 'model/cow_health_efficientnetb3_tuned.h5'
-UPLOAD_FOLDER = 'uploads'
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    """Reject bodies whose declared size is over the upload limit before they are parsed"""
+    content_length = request.headers.get("content-length")
+    limit_mb = MAX_BATCH_UPLOAD_MB if request.url.path.startswith("/predict/batch") else MAX_UPLOAD_MB
+    # Allow some room for multipart boundaries and headers
+    if content_length and content_length.isdigit() and int(content_length) > (limit_mb + 1) * 1024 * 1024:
+        return JSONResponse(
+            status_code=413,
+            content={"detail": f"File too large. Maximum size is {limit_mb:g} MB"}
+        )
+    return await call_next(request)
+
+# Bounded executor for decoding and inference; when full, requests get 503 + Retry-After
+pool = InferencePool.from_env(allow_processes=False)
+app.add_exception_handler(PoolSaturated, pool_saturated_handler)
+metrics.track_pool(pool)
+
+# Results keyed by a hash of the uploaded bytes and the model version
+prediction_cache = PredictionCache.from_env()
+metrics.track_cache(prediction_cache)
+
+# Identical uploads that arrive while one is being predicted share its result
+predict_flight = SingleFlight("disease_predict")
+metrics.track_flight(predict_flight)
+
+# Stage latency histograms, batch sizes and cache counters on /metrics
+metrics.install(app)
+
+# Configure these variables; paths resolve against this directory and MODEL_PATH can point elsewhere
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MODEL_PATH = os.environ.get("MODEL_PATH", os.path.join(BASE_DIR, 'model', 'cow_health_efficientnetb3_tuned.h5'))
+UPLOAD_FOLDER = os.path.join(BASE_DIR, 'uploads')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+IMAGE_SIZE = (224, 224)  # Model input (width, height)
+# Uploads larger than this are rejected with 413 before they are fully read
+MAX_UPLOAD_MB = float(os.environ.get("MAX_UPLOAD_MB", 15))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# /predict/batch limits: image count and total request size (images or a zip/tar archive)
+MAX_BATCH_FILES = int(os.environ.get("MAX_BATCH_FILES", 500))
+MAX_BATCH_UPLOAD_MB = float(os.environ.get("MAX_BATCH_UPLOAD_MB", 500))
 CLASS_NAMES = []  # Replace with your model's class names if available
 
+# Micro-batching: concurrent uploads are stacked into a single forward pass
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", 16))
+BATCH_MAX_WAIT_MS = float(os.environ.get("BATCH_MAX_WAIT_MS", 5))
+
 # Setup upload folder
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-# Global model variable
-model = None
+# Shared by every model version; each batch runs on the version active when it is
+# dispatched and comes back tagged with it, so results are cached under that version
+batcher = None
 
-def load_model():
-    global model
-    model = tf.keras.models.load_model(MODEL_PATH)
+def load_model(model_path=MODEL_PATH):
+    model = tf.keras.models.load_model(model_path)
     print("Model loaded successfully")
     
     # If your model has custom layers, you might need this instead:
     # model = tf.keras.models.load_model(
-    #     MODEL_PATH,
+    #     model_path,
     #     custom_objects={'CustomLayer': CustomLayer}
     # )
     
@@ -49,35 +99,250 @@ def load_model():
     # global CLASS_NAMES
     # with open('class_names.txt', 'r') as f:
     #     CLASS_NAMES = [line.strip() for line in f.readlines()]
+    
+    return model
 
 def is_valid_file(filename: str) -> bool:
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def preprocess_image(image: Image.Image, target_size=(224, 224)):
+def run_model(batch):
+    # Run one forward pass over a stacked batch of preprocessed images, with the version that ran it
+    current = models.current
+    return current.version, current.backend.predict(batch)
+
+@metrics.time("inference_stage_seconds", stage="preprocess")
+def preprocess_image(image: Image.Image, target_size=IMAGE_SIZE, out=None):
     # Resize image
     image = image.resize(target_size)
     
-    # Convert to array and add batch dimension
-    image_array = np.array(image)
-    image_array = np.expand_dims(image_array, axis=0)
+    # Copy the pixels into a float32 batch of one (or the caller's buffer)
+    if out is None:
+        out = np.empty((1, target_size[1], target_size[0], 3), dtype=np.float32)
+    np.copyto(out[0], np.asarray(image), casting='unsafe')
     
     # Preprocess based on MobileNet requirements
-    # Convert to float and scale to [-1, 1]
-    image_array = image_array.astype(np.float32)
-    image_array = image_array / 127.5 - 1.0
+    # Scale to [-1, 1] in place
+    np.divide(out, 127.5, out=out)
+    np.subtract(out, 1.0, out=out)
+    
+    return out
+
+@metrics.time("inference_stage_seconds", stage="postprocess")
+def format_predictions(probabilities):
+    # Get top prediction
+    if len(CLASS_NAMES) > 0:
+        # If we have class names
+        predicted_class_idx = np.argmax(probabilities)
+        predicted_class = CLASS_NAMES[predicted_class_idx]
+        confidence = float(probabilities[predicted_class_idx])
+        
+        return {
+            "category": predicted_class,
+            "confidence": confidence
+        }
+
+    # Return raw predictions if no class names
+    # Get top 3 predictions
+    top_indices = probabilities.argsort()[-3:][::-1]
+    return {
+        "categories": [{"class_id": int(idx), "confidence": float(probabilities[idx])} 
+                      for idx in top_indices]
+    }
+
+def decode_image(contents: bytes, size=IMAGE_SIZE):
+    with metrics.time("inference_stage_seconds", stage="decode"):
+        image = Image.open(io.BytesIO(contents))
     
-    return image_array
+        # JPEGs are decoded at a reduced scale (up to 8x) that still covers
+        # ``size``, instead of decoding full 4000x3000 phone photos
+        image.draft("RGB", size)
+    
+        # Convert grayscale to RGB if needed
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        
+        # Decode now so decode and resize show up as separate stages
+        image.load()
+    return image
+
+def load_image(contents: bytes, out=None):
+    return preprocess_image(decode_image(contents), out=out)
+
+@metrics.time("inference_stage_seconds", stage="preprocess")
+def tta_views(image: Image.Image):
+    # Test-time augmentation: the full image and its mirror, center and corner
+    # crops at 8/7 scale, and a 9/7 zoom and its mirror, as one float32 batch
+    width, height = IMAGE_SIZE
+    full = np.asarray(image.resize(IMAGE_SIZE))
+    crops = np.asarray(image.resize((width * 8 // 7, height * 8 // 7)))
+    zoom = np.asarray(image.resize((width * 9 // 7, height * 9 // 7)))
+    
+    def center(array):
+        top = (array.shape[0] - height) // 2
+        left = (array.shape[1] - width) // 2
+        return array[top:top + height, left:left + width]
+    
+    views = np.stack([
+        full, full[:, ::-1],
+        center(crops), crops[:height, :width], crops[:height, -width:], crops[-height:, :width], crops[-height:, -width:],
+        center(zoom), center(zoom)[:, ::-1]
+    ]).astype(np.float32)
+    np.divide(views, 127.5, out=views)
+    np.subtract(views, 1.0, out=views)
+    return views
+
+def load_tta_views(contents: bytes):
+    width, height = IMAGE_SIZE
+    return tta_views(decode_image(contents, (width * 9 // 7, height * 9 // 7)))
+
+def format_tta_predictions(view_probabilities):
+    # Average the views; their variance is returned as an uncertainty signal
+    mean = view_probabilities.mean(axis=0)
+    variance = view_probabilities.var(axis=0)
+    result = format_predictions(mean)
+    for category in result.get("categories", []):
+        category["variance"] = float(variance[category["class_id"]])
+    
+    predicted = int(mean.argmax())
+    result["tta"] = {
+        "views": len(view_probabilities),
+        "variance": float(variance[predicted]),
+        # Share of views whose own top class matches the averaged prediction
+        "agreement": float(np.mean(view_probabilities.argmax(axis=1) == predicted))
+    }
+    return result
+
+async def read_upload(file: UploadFile, max_mb: float = MAX_UPLOAD_MB) -> bytes:
+    """Read an upload in chunks, stopping as soon as it exceeds ``max_mb``"""
+    max_bytes = int(max_mb * 1024 * 1024)
+    chunks = []
+    size = 0
+    with metrics.time("inference_stage_seconds", stage="upload_read"):
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_bytes:
+                raise HTTPException(status_code=413, detail=f"File too large. Maximum size is {max_mb:g} MB")
+            chunks.append(chunk)
+    return b"".join(chunks)
+
+async def decode_chunk(chunk):
+    # Decode a chunk of uploads in parallel into one float32 batch
+    batch = np.empty((len(chunk), IMAGE_SIZE[1], IMAGE_SIZE[0], 3), dtype=np.float32)
+    results = await asyncio.gather(
+        *[pool.run(load_image, contents, batch[i:i + 1]) for i, (_, _, contents) in enumerate(chunk)],
+        return_exceptions=True
+    )
+    errors = {i: str(result) for i, result in enumerate(results) if isinstance(result, Exception)}
+    return batch, errors
+
+async def stream_batch_predictions(cached_lines, pending):
+    # Yield NDJSON result lines, one model batch at a time
+    # The handler holds an admission slot for the whole response
+    next_decode = None
+    try:
+        if cached_lines:
+            yield "".join(cached_lines)
+        
+        chunks = [pending[i:i + BATCH_MAX_SIZE] for i in range(0, len(pending), BATCH_MAX_SIZE)]
+        if chunks:
+            next_decode = asyncio.ensure_future(decode_chunk(chunks[0]))
+        for n, chunk in enumerate(chunks):
+            batch, errors = await next_decode
+            # Decode the next chunk while this one is in the model
+            next_decode = asyncio.ensure_future(decode_chunk(chunks[n + 1])) if n + 1 < len(chunks) else None
+            
+            decoded = [i for i in range(len(chunk)) if i not in errors]
+            predictions = []
+            if decoded:
+                try:
+                    inputs = batch if len(decoded) == len(chunk) else batch[decoded]
+                    version, predictions = await batcher.submit(inputs)
+                except Exception as e:
+                    errors.update({i: f"Prediction failed: {e}" for i in decoded})
+                    decoded = []
+            
+            lines = []
+            for i, (index, filename, contents) in enumerate(chunk):
+                if i in errors:
+                    result = {"error": f"Error processing image: {errors[i]}"}
+                else:
+                    result = format_predictions(predictions[decoded.index(i)])
+                    prediction_cache.put(PredictionCache.make_key(version, contents), result)
+                lines.append(json.dumps({"index": index, "filename": filename, **result}) + "\n")
+            yield "".join(lines)
+    finally:
+        if next_decode is not None:
+            next_decode.cancel()
+
+def load_model_version(path):
+    # Model and inference backend for one version of the model file
+    model = load_model(path)
+    # Traced tf.functions by default, or INFERENCE_BACKEND=keras|tflite|tflite-fp16|tflite-int8|onnx
+    backend, backend_parity = select_backend(model, load_image, max_batch_size=BATCH_MAX_SIZE)
+    print(f"Inference backend: {backend.name}")
+    return {"model": model, "backend": backend, "backend_parity": backend_parity}
+
+def warm_up_model_version(candidate):
+    # Check a newly loaded model takes our input size and run a batch through its backend
+    input_shape = tuple(candidate.model.input_shape[1:])
+    if input_shape != (IMAGE_SIZE[1], IMAGE_SIZE[0], 3):
+        raise ValueError(f"model expects inputs of shape {input_shape}, the service produces "
+                         f"{(IMAGE_SIZE[1], IMAGE_SIZE[0], 3)}")
+    outputs = candidate.backend.predict(np.zeros((1,) + input_shape, dtype=np.float32))
+    if not np.all(np.isfinite(outputs)):
+        raise ValueError("model produced non-finite outputs")
+
+# The active model version, replaced atomically by POST /admin/reload or, with
+# MODEL_WATCH_INTERVAL set, when the model file changes
+models = ModelManager(MODEL_PATH, load_model_version, warmup=warm_up_model_version)
+models.install(app)
 
 @app.on_event("startup")
 async def startup_event():
-    load_model()
+    global batcher
+    models.preload()
+    batcher = MicroBatcher(run_model, BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS, executor=pool.executor, tagged=True)
+    batcher.start()
+    models.start_watching()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await models.stop_watching()
+    if batcher is not None:
+        await batcher.stop()
+    pool.shutdown()
 
 @app.get("/")
 def read_root():
     return {"message": "MobileNet Image Classification API"}
 
+@app.get("/cache-stats")
+def cache_stats():
+    return {**prediction_cache.stats(), "singleflight": predict_flight.stats()}
+
+@app.get("/model-info")
+def model_info():
+    current = models.current
+    if current is None:
+        raise HTTPException(status_code=503, detail="Model not loaded")
+    return {
+        **models.info(),
+        "backend": current.backend.name,
+        "backend_parity": current.backend_parity,
+        "input_shape": str(current.model.input_shape),
+        "output_shape": str(current.model.output_shape)
+    }
+
 @app.post("/predict/")
-async def predict_image(file: UploadFile = File(...)):
+async def predict_image(file: UploadFile = File(...), tta: bool = False):
+    # ?tta=true averages augmented views of the image in one batched forward pass
+    current = models.current
+    if current is None or batcher is None:
+        raise HTTPException(status_code=503, detail="Model not loaded")
+    
     # Validate file
     if not file:
         raise HTTPException(status_code=400, detail="No file provided")
@@ -85,44 +350,92 @@ async def predict_image(file: UploadFile = File(...)):
     if not is_valid_file(file.filename):
         raise HTTPException(status_code=400, detail="Invalid file format. Supported formats: PNG, JPG, JPEG")
     
-    # Read and preprocess the image
-    try:
-        contents = await file.read()
-        image = Image.open(io.BytesIO(contents))
-        
-        # Convert grayscale to RGB if needed
-        if image.mode != "RGB":
-            image = image.convert("RGB")
+    contents = await read_upload(file)
+    version = current.version
+    
+    # Resubmitted photos are answered from the cache without touching the model
+    if tta:
+        cache_key = PredictionCache.make_key(version, "tta", contents)
+    else:
+        cache_key = PredictionCache.make_key(version, contents)
+    cached = await prediction_cache.get_async(cache_key)
+    if cached is not None:
+        return cached
+    
+    # Retries and duplicate uploads of a photo still being predicted wait for that prediction
+    return await predict_flight.run(cache_key, predict_contents, contents, tta)
+
+async def predict_contents(contents: bytes, tta: bool):
+    # Decode and predict one upload, and cache the result under the version that predicted it
+    async with pool.admit():
+        try:
+            if tta:
+                views = await pool.run(load_tta_views, contents)
+                version, predictions = await batcher.submit(views)
+                result = format_tta_predictions(predictions)
+                prediction_cache.put(PredictionCache.make_key(version, "tta", contents), result)
+                return result
             
-        processed_image = preprocess_image(image)
-        
-        # Make prediction
-        predictions = model.predict(processed_image)
-        
-        # Get top prediction
-        if len(CLASS_NAMES) > 0:
-            # If we have class names
-            predicted_class_idx = np.argmax(predictions[0])
-            predicted_class = CLASS_NAMES[predicted_class_idx]
-            confidence = float(predictions[0][predicted_class_idx])
+            # Preprocess the image
+            processed_image = await pool.run(load_image, contents)
             
-            result = {
-                "category": predicted_class,
-                "confidence": confidence
-            }
-        else:
-            # Return raw predictions if no class names
-            # Get top 3 predictions
-            top_indices = predictions[0].argsort()[-3:][::-1]
-            result = {
-                "categories": [{"class_id": int(idx), "confidence": float(predictions[0][idx])} 
-                              for idx in top_indices]
-            }
+            # Make prediction as part of the next batch
+            version, predictions = await batcher.submit(processed_image)
+            
+            result = format_predictions(predictions[0])
+            prediction_cache.put(PredictionCache.make_key(version, contents), result)
+            return result
             
-        return result
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
+
+@app.post("/predict/batch")
+async def predict_batch(files: List[UploadFile] = File(...)):
+    # Many images per request (files or zip/tar archives), streamed back as NDJSON
+    current = models.current
+    if current is None or batcher is None:
+        raise HTTPException(status_code=503, detail="Model not loaded")
+    if not files:
+        raise HTTPException(status_code=400, detail="No file provided")
+    
+    # (index, filename, contents); contents is None for unsupported files
+    entries = []
+    for file in files:
+        if is_archive(file.filename):
+            data = await read_upload(file, MAX_BATCH_UPLOAD_MB)
+            try:
+                members = await pool.run(
+                    read_archive, file.filename, data, ALLOWED_EXTENSIONS,
+                    int(MAX_UPLOAD_MB * 1024 * 1024), MAX_BATCH_FILES
+                )
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=f"Invalid archive: {str(e)}")
+            for name, contents in members:
+                entries.append((len(entries), name, contents))
+        elif is_valid_file(file.filename):
+            entries.append((len(entries), file.filename, await read_upload(file)))
+        else:
+            entries.append((len(entries), file.filename, None))
         
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
+        if len(entries) > MAX_BATCH_FILES:
+            raise HTTPException(status_code=413, detail=f"Too many images. Maximum is {MAX_BATCH_FILES} per request")
+    
+    version = current.version
+    cached_lines = []
+    pending = []
+    for index, filename, contents in entries:
+        if contents is None:
+            result = {"error": "Invalid file format. Supported formats: PNG, JPG, JPEG"}
+        else:
+            result = await prediction_cache.get_async(PredictionCache.make_key(version, contents))
+            if result is None:
+                pending.append((index, filename, contents))
+                continue
+        cached_lines.append(json.dumps({"index": index, "filename": filename, **result}) + "\n")
+    
+    # Answer 503 before any headers go out; the response returns the slot once sent
+    pool.acquire()
+    return AdmittedStreamingResponse(pool, stream_batch_predictions(cached_lines, pending), media_type="application/x-ndjson")
 
 # For local development only
 if __name__ == "__main__":
@@ -0,0 +1,202 @@
+"""
+Pre-fork launcher for the model services.
+
+    python serve.py --preload --workers 4
+    python serve.py --workers 2 --threads 2
+
+One master process binds the port and forks ``--workers`` uvicorn workers
+that accept on the shared socket; workers that die are replaced. Every worker
+gets its BLAS/OpenMP/TensorFlow thread pools capped at ``--threads`` so the
+workers together use the cores once instead of each trying to use all of
+them.
+
+With ``--preload`` the master imports the app, so the model is loaded once
+before forking and the workers share its memory copy-on-write (gc.freeze
+keeps the garbage collector from writing to those pages). TensorFlow cannot
+run in a process forked after its runtime started, so the image services run
+without ``--preload``: each worker loads its own copy of the model.
+
+Metrics, caches and batchers are per worker. All services keep an identical
+copy of this module, which imports nothing heavy at the top so the thread
+limits are in place before NumPy or TensorFlow load. Change all copies
+together; tests/test_shared_copies.py fails when they differ.
+"""
+import argparse
+import gc
+import importlib
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+logger = logging.getLogger("serve")
+
+# Read by OpenBLAS/MKL/OpenMP when NumPy loads and by TensorFlow when its runtime starts
+THREAD_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "NUMEXPR_NUM_THREADS",
+               "TF_NUM_INTRAOP_THREADS")
+# The services' own thread settings (inference pool, TFLite/ONNX backends, tree engine)
+SERVICE_THREAD_VARS = ("INFERENCE_WORKERS", "BACKEND_THREADS", "TREE_THREADS")
+# A worker that dies sooner than this after starting is restarted with a delay
+MIN_WORKER_LIFETIME = 5.0
+
+
+def available_cpus():
+    """Cores this process may use: CPU affinity, further capped by a cgroup v2 CPU quota"""
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+def limit_threads(threads):
+    """Cap native thread pools at ``threads``, keeping any limit already set in the environment"""
+    for name in THREAD_VARS + SERVICE_THREAD_VARS:
+        os.environ.setdefault(name, str(threads))
+    os.environ.setdefault("TF_NUM_INTEROP_THREADS", "1" if threads <= 2 else "2")
+
+
+def load_app(reference):
+    """Import ``module:attribute`` from the working directory"""
+    module_name, _, attribute = reference.partition(":")
+    sys.path.insert(0, os.getcwd())
+    return getattr(importlib.import_module(module_name), attribute or "app")
+
+
+def bind(host, port, backlog=2048):
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(sock, app, args):
+    """Serve on the inherited socket until uvicorn shuts down; never returns"""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    status = 0
+    try:
+        import uvicorn
+
+        if app is None:
+            app = load_app(args.app)
+        config = uvicorn.Config(app, log_level=args.log_level, timeout_keep_alive=args.keep_alive)
+        uvicorn.Server(config).run(sockets=[sock])
+    except BaseException as e:
+        if not isinstance(e, (KeyboardInterrupt, SystemExit)):
+            logger.exception(f"Worker {os.getpid()} failed")
+            status = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+
+
+class Master:
+    """Forks the workers, replaces the ones that exit and stops them all on SIGTERM/SIGINT"""
+
+    def __init__(self, sock, app, args):
+        self.sock = sock
+        self.app = app
+        self.args = args
+        self.workers = {}
+        self.stopping = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            run_worker(self.sock, self.app, self.args)
+        self.workers[pid] = time.monotonic()
+        logger.info(f"Started worker {pid}")
+
+    def stop(self, signum, frame):
+        self.stopping = True
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for _ in range(self.args.workers):
+            self.spawn()
+
+        deadline = None
+        while self.workers:
+            if self.stopping and deadline is None:
+                deadline = time.monotonic() + self.args.graceful_timeout
+            if deadline is not None and time.monotonic() > deadline:
+                for pid in list(self.workers):
+                    logger.warning(f"Worker {pid} did not stop in time, killing it")
+                    os.kill(pid, signal.SIGKILL)
+                deadline = float("inf")
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                time.sleep(0.2)
+                continue
+            started = self.workers.pop(pid, None)
+            if started is None or self.stopping:
+                continue
+            logger.warning(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, restarting it")
+            if time.monotonic() - started < MIN_WORKER_LIFETIME:
+                time.sleep(MIN_WORKER_LIFETIME)
+            self.spawn()
+        self.sock.close()
+
+
+def main(argv=None):
+    cpus = available_cpus()
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--app", default="main:app", help="module:attribute of the ASGI app")
+    parser.add_argument("--host", default=os.environ.get("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8080)))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WEB_WORKERS", 0)),
+                        help="worker processes (WEB_WORKERS; default: one per core with --preload, else 1)")
+    parser.add_argument("--threads", type=int, default=int(os.environ.get("WORKER_THREADS", 0)),
+                        help="native threads per worker (WORKER_THREADS; default: cores / workers)")
+    parser.add_argument("--preload", action="store_true", default=os.environ.get("PREFORK_PRELOAD") == "1",
+                        help="load the app in the master and fork workers from it (PREFORK_PRELOAD=1)")
+    parser.add_argument("--graceful-timeout", type=float, default=30.0,
+                        help="seconds workers get to finish in-flight requests on shutdown")
+    parser.add_argument("--keep-alive", type=int, default=5, help="HTTP keep-alive timeout in seconds")
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args(argv)
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(levelname)s:     [serve] %(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(args.log_level.upper())
+    logger.propagate = False
+    if args.workers <= 0:
+        args.workers = cpus if args.preload else 1
+    threads = args.threads if args.threads > 0 else max(1, cpus // args.workers)
+    limit_threads(threads)
+
+    sock = bind(args.host, args.port)
+    app = None
+    if args.preload:
+        start = time.perf_counter()
+        app = load_app(args.app)
+        # Keep the collector away from everything loaded so far, so those pages stay shared
+        gc.collect()
+        gc.freeze()
+        logger.info(f"Loaded {args.app} in {time.perf_counter() - start:.1f}s")
+    logger.info(f"Serving on {args.host}:{args.port} with {args.workers} worker(s), {threads} thread(s) each")
+    Master(sock, app, args).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,360 @@
+"""
+Single-process gateway for the model services.
+
+    cd models
+    GATEWAY_MEMORY_BUDGET_MB=1500 GATEWAY_PINNED=disease-qna python gateway.py
+
+Mounts every service's FastAPI app under its own path prefix in one uvicorn
+process, so the suite pays for the interpreter, FastAPI and TensorFlow once:
+
+    /breed-identification/...   breed-identification
+    /breeding/...               breeding_model
+    /disease-identify/...       disease_identify
+    /disease-qna/...            disease-qna
+
+All apps share one inference pool and one prediction cache. Models are loaded
+on the first request that needs them. When loading one would take the models
+in memory over GATEWAY_MEMORY_BUDGET_MB (0: no limit), the least recently used
+model that is neither pinned nor handling a request is unloaded first. A
+model's size is how much the process RSS grew while it loaded, the largest
+seen so far, since TensorFlow keeps part of its memory after a model is
+dropped. GATEWAY_PINNED lists services whose models are loaded at startup and
+never unloaded, GATEWAY_SERVICES limits which services are mounted, and
+/models shows what is loaded.
+
+With both image services mounted, POST /analyze answers the breed and disease
+questions for one photo: the upload is read and preprocessed once, and the two
+models run on the same input concurrently.
+
+The services still run on their own; this module only imports them. Their
+shared modules (serving.py, backends.py, artifacts.py) are identical copies,
+so the first copy on the path serves all of them. TensorFlow cannot be forked
+once started, so run the gateway as a single worker process.
+"""
+import asyncio
+import contextlib
+import gc
+import importlib.util
+import logging
+import os
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# URL prefix -> service directory
+SERVICES = {
+    "breed-identification": "breed-identification",
+    "breeding": "breeding_model",
+    "disease-identify": "disease_identify",
+    "disease-qna": "disease-qna",
+}
+# Routes that never touch the model, so they don't load it
+MODEL_FREE_PATHS = {"/", "/health", "/metrics", "/docs", "/redoc", "/openapi.json"}
+# /analyze result key -> service; these models take the same preprocessed image
+ANALYZE_SERVICES = {"breed": "breed-identification", "disease": "disease-identify"}
+
+
+def service_list(variable, default=""):
+    names = [name.strip() for name in os.environ.get(variable, default).split(",") if name.strip()]
+    unknown = set(names) - set(SERVICES)
+    if unknown:
+        sys.exit(f"Unknown services in {variable}: {sorted(unknown)}; choose from {sorted(SERVICES)}")
+    return names
+
+
+enabled = service_list("GATEWAY_SERVICES", ",".join(SERVICES))
+
+# The services import their sibling modules by name
+for name in reversed(enabled):
+    sys.path.insert(0, os.path.join(BASE_DIR, SERVICES[name]))
+
+import uvicorn
+from fastapi import FastAPI, File, HTTPException, UploadFile
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+from serving import InferencePool, ModelManager, PredictionCache, metrics, rss_mb
+
+logger = logging.getLogger(__name__)
+
+
+class Residency:
+    """
+    Loads the services' models on demand and unloads the least recently used
+    ones to stay within ``budget_mb`` (0: no limit). Pinned models and models
+    with requests in flight are never unloaded.
+    """
+
+    def __init__(self, budget_mb=0, pinned=()):
+        self.budget_mb = budget_mb
+        self.pinned = set(pinned)
+        self.managers = {}
+        self.in_flight = {}
+        self.last_used = {}
+        self.size_mb = {}
+        self.evictions = 0
+        self._lock = None
+
+    def add(self, name, manager):
+        self.managers[name] = manager
+        self.in_flight[name] = 0
+        self.last_used[name] = 0.0
+
+    def resident(self):
+        return [name for name, manager in self.managers.items() if manager.current is not None]
+
+    def resident_mb(self):
+        return sum(self.size_mb.get(name, 0.0) for name in self.resident())
+
+    async def acquire(self, name):
+        """Make sure ``name``'s model is loaded and keep it loaded until ``release``"""
+        # Counted before loading, so the model can't be picked for eviction while we wait
+        self.in_flight[name] += 1
+        try:
+            if self.managers[name].current is None:
+                if self._lock is None:
+                    self._lock = asyncio.Lock()
+                # One load at a time, so budget decisions see every model that is loaded
+                async with self._lock:
+                    if self.managers[name].current is None:
+                        await self._load(name)
+        except BaseException:
+            self.in_flight[name] -= 1
+            raise
+        self.last_used[name] = time.monotonic()
+
+    def release(self, name):
+        self.in_flight[name] -= 1
+        self.last_used[name] = time.monotonic()
+
+    async def _load(self, name):
+        # The first load of a model has no size yet; room is made for it afterwards
+        self._make_room(self.size_mb.get(name, 0.0), keep=name)
+        before = rss_mb()
+        start = time.perf_counter()
+        await self.managers[name].reload()
+        self.size_mb[name] = max(self.size_mb.get(name, 0.0), rss_mb() - before)
+        metrics.inc("gateway_model_loads_total", "Models loaded on demand by the gateway", service=name)
+        logger.warning(f"Loaded {name} in {time.perf_counter() - start:.1f}s "
+                       f"({self.size_mb[name]:.0f} MB, {self.resident_mb():.0f} MB resident)")
+        self._make_room(0.0, keep=name)
+
+    def _make_room(self, needed_mb, keep):
+        if self.budget_mb <= 0:
+            return
+        idle = sorted(
+            (name for name in self.resident()
+             if name != keep and name not in self.pinned and self.in_flight[name] == 0),
+            key=lambda name: self.last_used[name]
+        )
+        for name in idle:
+            if self.resident_mb() + needed_mb <= self.budget_mb:
+                return
+            self.unload(name)
+        if self.resident_mb() + needed_mb > self.budget_mb:
+            logger.warning(f"Models in use need {self.resident_mb() + needed_mb:.0f} MB, "
+                           f"over the {self.budget_mb:.0f} MB budget")
+
+    def unload(self, name):
+        try:
+            self.managers[name].unload()
+        except Exception as e:
+            logger.warning(f"Could not unload {name}: {e}")
+            return
+        gc.collect()
+        self.evictions += 1
+        metrics.inc("gateway_model_evictions_total", "Models unloaded to stay within the memory budget",
+                    service=name)
+
+    def status(self):
+        return {
+            "budget_mb": self.budget_mb,
+            "resident_mb": round(self.resident_mb(), 1),
+            "rss_mb": round(rss_mb(), 1),
+            "evictions": self.evictions,
+            "models": {
+                name: {
+                    "loaded": manager.current is not None,
+                    "version": manager.version,
+                    "pinned": name in self.pinned,
+                    "in_flight": self.in_flight[name],
+                    "size_mb": round(self.size_mb[name], 1) if name in self.size_mb else None,
+                    "idle_seconds": round(time.monotonic() - self.last_used[name], 1)
+                    if self.last_used[name] else None,
+                }
+                for name, manager in self.managers.items()
+            },
+        }
+
+
+class ResidentApp:
+    """ASGI wrapper that keeps a service's model loaded while it handles a request"""
+
+    def __init__(self, name, app, residency):
+        self.name = name
+        self.app = app
+        self.residency = residency
+
+    def _route_path(self, scope):
+        # Newer Starlette keeps the full path in mounted apps and moves the prefix to root_path
+        path, root_path = scope["path"], scope.get("root_path", "")
+        if root_path and path.startswith(root_path):
+            return path[len(root_path):] or "/"
+        return path
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self._route_path(scope) in MODEL_FREE_PATHS:
+            await self.app(scope, receive, send)
+            return
+        try:
+            await self.residency.acquire(self.name)
+        except Exception as e:
+            response = JSONResponse(status_code=503, content={"detail": f"Model {self.name} is unavailable: {e}"})
+            await response(scope, receive, send)
+            return
+        try:
+            # Streaming responses finish sending before this returns
+            await self.app(scope, receive, send)
+        finally:
+            self.residency.release(self.name)
+
+
+def import_service(directory):
+    """Import ``directory/main.py`` under a module name of its own"""
+    module_name = directory.replace("-", "_") + "_main"
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(BASE_DIR, directory, "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+# Models load on first use, and every app runs on the same pool and cache.
+# Threads only: process workers would be forked from a process running TensorFlow
+ModelManager.lazy = True
+pool = InferencePool.shared = InferencePool.from_env(allow_processes=False)
+PredictionCache.shared = PredictionCache.from_env()
+
+residency = Residency(
+    budget_mb=float(os.environ.get("GATEWAY_MEMORY_BUDGET_MB", 0)),
+    pinned=[name for name in service_list("GATEWAY_PINNED") if name in enabled]
+)
+services = {}
+for name in enabled:
+    start = time.perf_counter()
+    services[name] = import_service(SERVICES[name])
+    residency.add(name, services[name].models)
+    logger.warning(f"Imported {name} in {time.perf_counter() - start:.1f}s")
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # Mounted apps get no lifespan events of their own
+    async with contextlib.AsyncExitStack() as stack:
+        for name, module in services.items():
+            await stack.enter_async_context(module.app.router.lifespan_context(module.app))
+        for name in residency.pinned:
+            await residency.acquire(name)
+            residency.release(name)
+        yield
+
+
+app = FastAPI(title="GauPal model gateway", lifespan=lifespan)
+
+for name, module in services.items():
+    app.mount(f"/{name}", ResidentApp(name, module.app, residency))
+
+
+@app.get("/")
+def read_root():
+    return {"services": {name: f"/{name}/" for name in services}}
+
+
+@app.get("/models")
+def model_residency():
+    return residency.status()
+
+
+async def analyze_contents(contents):
+    """Merged breed and disease results for one uploaded image"""
+    parts = {part: services[name] for part, name in ANALYZE_SERVICES.items()}
+    currents = {part: module.models.current for part, module in parts.items()}
+    if any(current is None for current in currents.values()):
+        raise HTTPException(status_code=503, detail="Model not loaded")
+    versions = {part: current.version for part, current in currents.items()}
+    results = {part: await module.prediction_cache.get_async(PredictionCache.make_key(versions[part], contents))
+               for part, module in parts.items()}
+    pending = [part for part, result in results.items() if result is None]
+
+    if pending:
+        async with pool.admit():
+            try:
+                # Both services preprocess identically, so one decoded batch feeds both models
+                processed = await pool.run(parts["breed"].load_image, contents)
+            except Exception as e:
+                raise HTTPException(status_code=400, detail=f"Error processing image: {e}")
+            outputs = await asyncio.gather(
+                *[parts[part].batcher.submit(processed) for part in pending], return_exceptions=True
+            )
+        for part, output in zip(pending, outputs):
+            if isinstance(output, Exception):
+                logger.error(f"{ANALYZE_SERVICES[part]} prediction failed: {output}")
+                results[part] = {"error": f"Prediction failed: {output}"}
+            else:
+                # The batch reports the version that ran it, which a reload may have changed
+                versions[part], predictions = output
+                results[part] = parts[part].format_predictions(predictions[0])
+                parts[part].prediction_cache.put(PredictionCache.make_key(versions[part], contents), results[part])
+
+    if all("error" in result for result in results.values()):
+        raise HTTPException(status_code=500, detail="Error processing image: every model failed")
+    return {
+        **results,
+        "model_versions": {ANALYZE_SERVICES[part]: version for part, version in versions.items()},
+    }
+
+
+async def analyze_image(file: UploadFile = File(...)):
+    """Breed and disease predictions for one photo, decoded once and run on both models concurrently"""
+    breed = services[ANALYZE_SERVICES["breed"]]
+    if not file:
+        raise HTTPException(status_code=400, detail="No file provided")
+    if not breed.is_valid_file(file.filename):
+        raise HTTPException(status_code=400, detail="Invalid file format. Supported formats: PNG, JPG, JPEG")
+    contents = await breed.read_upload(file)
+
+    held = []
+    try:
+        for name in ANALYZE_SERVICES.values():
+            try:
+                await residency.acquire(name)
+            except Exception as e:
+                raise HTTPException(status_code=503, detail=f"Model {name} is unavailable: {e}")
+            held.append(name)
+        return await analyze_contents(contents)
+    finally:
+        for name in held:
+            residency.release(name)
+
+
+if all(name in services for name in ANALYZE_SERVICES.values()):
+    if len({services[name].IMAGE_SIZE for name in ANALYZE_SERVICES.values()}) == 1:
+        app.post("/analyze")(analyze_image)
+    else:
+        logger.warning("The image services take different input sizes; /analyze is disabled")
+
+
+@app.get("/metrics", include_in_schema=False)
+def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+metrics.collect("gateway_resident_models", "gauge", "Models currently loaded by the gateway",
+                lambda: len(residency.resident()))
+metrics.collect("gateway_resident_mb", "gauge", "Estimated memory of the loaded models in MB",
+                residency.resident_mb)
+
+
+if __name__ == "__main__":
+    # One process: TensorFlow does not survive a fork, and the models would be loaded once per worker
+    uvicorn.run(app, host=os.environ.get("HOST", "0.0.0.0"), port=int(os.environ.get("PORT", 8080)))
@@ -0,0 +1,59 @@
+"""
+The services are standalone directories rather than packages, so their
+modules are imported by putting every service directory on the path. Modules
+shared between services are identical copies (test_shared_copies.py checks
+this), so whichever copy is found first stands for all of them.
+"""
+import importlib.util
+import os
+import sys
+
+import pytest
+
+MODELS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICE_DIRS = ("breed-identification", "breeding_model", "disease-qna", "disease_identify")
+
+for directory in (MODELS_DIR,) + tuple(os.path.join(MODELS_DIR, name) for name in SERVICE_DIRS):
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+
+# Quieter TensorFlow in the backend tests
+os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "2")
+
+
+def import_service(directory, **environ):
+    """
+    A fresh import of ``directory``/main.py under a module name of its own, with
+    ``environ`` set while the service reads its configuration
+    """
+    saved = {name: os.environ.get(name) for name in environ}
+    os.environ.update(environ)
+    try:
+        module_name = "test_" + directory.replace("-", "_") + "_main"
+        spec = importlib.util.spec_from_file_location(module_name, os.path.join(MODELS_DIR, directory, "main.py"))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        spec.loader.exec_module(module)
+        return module
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+@pytest.fixture(scope="session")
+def image_model_path(tmp_path_factory):
+    """A tiny Keras model taking the image services' 224x224 input, saved as .keras"""
+    tf = pytest.importorskip("tensorflow")
+    tf.keras.utils.set_random_seed(0)
+    model = tf.keras.Sequential([
+        tf.keras.Input((224, 224, 3)),
+        tf.keras.layers.Conv2D(4, 3, strides=4, activation="relu"),
+        tf.keras.layers.GlobalAveragePooling2D(),
+        tf.keras.layers.Dense(5, activation="softmax"),
+    ])
+    path = str(tmp_path_factory.mktemp("image_model") / "model.keras")
+    model.save(path)
+    return path
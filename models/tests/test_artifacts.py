@@ -0,0 +1,93 @@
+"""Model artifacts: round trip and the unpickling allow-list"""
+import io
+import os
+import pickle
+
+import numpy as np
+import pytest
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.neighbors import KNeighborsClassifier
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+
+from artifacts import OBJECT_FILE, RestrictedUnpickler, export_artifact, load_artifact
+
+
+def global_reference(module, name):
+    """A protocol 0 pickle that only looks up ``module.name``"""
+    return f"c{module}\n{name}\n.".encode()
+
+
+def restricted_load(data):
+    return RestrictedUnpickler(io.BytesIO(data)).load()
+
+
+def test_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    X, y = rng.normal(size=(60, 4)), rng.integers(0, 2, 60)
+    model = Pipeline([("scale", StandardScaler()), ("forest", RandomForestClassifier(n_estimators=5, random_state=0))])
+    model.fit(X, y)
+
+    path = str(tmp_path / "model.artifact")
+    export_artifact({"model": model}, path)
+    loaded, _ = load_artifact(path)
+    np.testing.assert_array_equal(loaded["model"].predict_proba(X), model.predict_proba(X))
+
+
+@pytest.mark.parametrize("algorithm", ["kd_tree", "ball_tree"])
+def test_tree_based_neighbours_round_trip(tmp_path, algorithm):
+    rng = np.random.default_rng(1)
+    X, y = rng.normal(size=(40, 3)), rng.integers(0, 2, 40)
+    knn = KNeighborsClassifier(n_neighbors=3, algorithm=algorithm, metric="manhattan").fit(X, y)
+
+    path = str(tmp_path / "knn.artifact")
+    export_artifact(knn, path)
+    loaded, _ = load_artifact(path)
+    np.testing.assert_array_equal(loaded.predict_proba(X), knn.predict_proba(X))
+
+
+@pytest.mark.parametrize("module, name", [
+    ("sklearn.pipeline", "Pipeline"),
+    ("sklearn.tree._tree", "Tree"),
+    ("scipy.sparse._csr", "csr_matrix"),
+    ("sklearn.neighbors._kd_tree", "newObj"),
+    ("numpy", "float64"),
+])
+def test_allowed_classes_resolve(module, name):
+    assert restricted_load(global_reference(module, name)).__name__ == name
+
+
+@pytest.mark.parametrize("module, name", [
+    # Classes from outside the allowed packages, imported into sklearn modules
+    ("sklearn.pipeline", "chain"),
+    ("sklearn.base", "defaultdict"),
+    ("sklearn.ensemble._forest", "ABCMeta"),
+    ("sklearn.utils.validation", "Parameter"),
+    # Functions and classes of the allowed packages that no shipped model is made of
+    ("sklearn.base", "clone"),
+    ("sklearn.utils.validation", "check_array"),
+    ("scipy.sparse", "load_npz"),
+    ("sklearn.preprocessing._function_transformer", "FunctionTransformer"),
+    # Allowed classes, but not under the module that defines them
+    ("sklearn.ensemble", "RandomForestClassifier"),
+    # Neither allowed nor re-exported
+    ("os", "system"),
+    ("builtins", "eval"),
+    ("numpy", "memmap"),
+    ("numpy", "load"),
+])
+def test_other_globals_are_rejected(module, name):
+    with pytest.raises(pickle.UnpicklingError, match="not allowed"):
+        restricted_load(global_reference(module, name))
+
+
+def test_tampered_artifact_is_rejected(tmp_path):
+    path = str(tmp_path / "model.artifact")
+    export_artifact({"scaler": StandardScaler().fit(np.eye(3))}, path)
+
+    # A pickle that calls a re-exported class; with checksums off only the allow-list stands in the way
+    with open(os.path.join(path, OBJECT_FILE), "wb") as f:
+        f.write(b"csklearn.pipeline\nchain\n(tR.")
+
+    with pytest.raises(pickle.UnpicklingError, match="sklearn.pipeline.chain"):
+        load_artifact(path, verify=False)
@@ -0,0 +1,96 @@
+"""Backend selection for the image services, on a tiny Keras model"""
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+tf = pytest.importorskip("tensorflow")
+
+from backends import CompiledBackend, KerasBackend, TFLiteBackend, create_backend, select_backend
+
+SIZE = 16
+
+
+def load_image(contents):
+    image = Image.open(io.BytesIO(contents)).convert("RGB").resize((SIZE, SIZE))
+    return np.asarray(image, dtype=np.float32)[None] / 255.0
+
+
+@pytest.fixture(scope="module")
+def model():
+    tf.keras.utils.set_random_seed(0)
+    model = tf.keras.Sequential([
+        tf.keras.Input((SIZE, SIZE, 3)),
+        tf.keras.layers.Conv2D(4, 3, activation="relu"),
+        tf.keras.layers.GlobalAveragePooling2D(),
+        tf.keras.layers.Dense(3, activation="softmax"),
+    ])
+    model(np.zeros((1, SIZE, SIZE, 3), dtype=np.float32))
+    return model
+
+
+@pytest.fixture(scope="module")
+def calibration_dir(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("calibration")
+    rng = np.random.default_rng(1)
+    for i in range(12):
+        # Smooth gradients with a colour cast, closer to photos than per-pixel noise
+        ramp = np.linspace(0, 1, 32)[None, :, None] * rng.uniform(0, 255, 3)
+        pixels = np.broadcast_to(ramp, (32, 32, 3)) + rng.normal(0, 8, (32, 32, 3))
+        Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(directory / f"{i}.png")
+    return str(directory)
+
+
+def test_keras_is_used_without_a_parity_check(model):
+    backend, parity = select_backend(model, load_image, kind="keras")
+    assert isinstance(backend, KerasBackend)
+    assert parity is None
+
+
+def test_compiled_backend_passes_parity(model):
+    backend, parity = select_backend(model, load_image, kind="compiled", max_batch_size=4)
+    assert isinstance(backend, CompiledBackend)
+    assert backend.buckets == [1, 2, 4]
+    assert parity["top1_agreement"] == 1.0
+    assert parity["synthetic_samples"] is True
+
+
+def test_backend_below_min_agreement_falls_back_to_keras(model, calibration_dir):
+    backend, parity = select_backend(model, load_image, kind="tflite", calibration_dir=calibration_dir,
+                                     min_agreement=1.01)
+    assert isinstance(backend, KerasBackend)
+    assert parity["top1_agreement"] <= 1.0
+    assert parity["synthetic_samples"] is False
+
+
+def test_unknown_backend_falls_back_to_keras(model):
+    with pytest.raises(ValueError):
+        create_backend(model, "tensorrt")
+    backend, parity = select_backend(model, load_image, kind="tensorrt")
+    assert isinstance(backend, KerasBackend)
+    assert parity is None
+
+
+def test_int8_needs_real_calibration_images(model, tmp_path):
+    backend, parity = select_backend(model, load_image, kind="tflite-int8", calibration_dir=str(tmp_path))
+    assert isinstance(backend, KerasBackend)
+    assert parity is None
+
+
+def test_int8_backend_runs_integer_only(model, calibration_dir):
+    backend, parity = select_backend(model, load_image, kind="tflite-int8", calibration_dir=calibration_dir,
+                                     min_agreement=0.0)
+    assert isinstance(backend, TFLiteBackend)
+    assert backend.name == "tflite-int8"
+    assert parity["synthetic_samples"] is False
+
+    interpreter = tf.lite.Interpreter(model_content=backend.model_content)
+    assert interpreter.get_input_details()[0]["dtype"] == np.int8
+    assert interpreter.get_output_details()[0]["dtype"] == np.int8
+
+    # Outputs come back dequantized, close to the float model's probabilities
+    batch = np.random.default_rng(2).uniform(0, 1, (3, SIZE, SIZE, 3)).astype(np.float32)
+    outputs = backend.predict(batch)
+    assert outputs.dtype == np.float32
+    np.testing.assert_allclose(outputs, model.predict(batch, verbose=0), atol=0.05)
@@ -0,0 +1,129 @@
+"""The breeding model's compiled features and packed forests against sklearn"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.compose import ColumnTransformer
+from sklearn.ensemble import ExtraTreesClassifier, RandomForestClassifier, RandomForestRegressor
+from sklearn.impute import SimpleImputer
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+from sklearn.tree import DecisionTreeRegressor
+
+from conftest import MODELS_DIR
+from features import CompiledFeatures
+from trees import PackedForests, TreeEngine
+
+with open(os.path.join(MODELS_DIR, "breeding_model", "sample_data.json")) as f:
+    SAMPLE = json.load(f)
+
+CATEGORICAL = [column for column, value in SAMPLE.items() if isinstance(value, str)]
+NUMERIC = [column for column in SAMPLE if column not in CATEGORICAL]
+CATEGORIES = {
+    "Breed": ["Gir", "Sahiwal", "Tharparkar", "Red Sindhi", "Ongole"],
+    "Temperament": ["Calm", "Aggressive", "Docile"],
+    "Success": ["High", "Medium", "Low"],
+}
+EXTREME_VALUES = np.array([0.0, -0.0, 1e12, -1e12, 1e-300, np.nan])
+
+
+def categories_for(column):
+    return next(values for suffix, values in CATEGORIES.items() if column.endswith(suffix))
+
+
+def random_rows(n_rows, seed, unknown=0.0, missing=0.0, extreme=0.0):
+    rng = np.random.default_rng(seed)
+    data = {}
+    for column in NUMERIC:
+        values = float(SAMPLE[column]) * rng.uniform(0.5, 1.5, n_rows)
+        unusual = rng.random(n_rows) < extreme
+        values[unusual] = rng.choice(EXTREME_VALUES, unusual.sum())
+        values[rng.random(n_rows) < missing] = np.nan
+        data[column] = values
+    for column in CATEGORICAL:
+        values = rng.choice(np.array(categories_for(column), dtype=object), n_rows)
+        values[rng.random(n_rows) < unknown] = "Unheard Of"
+        values[rng.random(n_rows) < missing] = None
+        data[column] = values
+    return pd.DataFrame(data)
+
+
+@pytest.fixture(scope="module")
+def model():
+    # Same preprocessor layout as the training notebook
+    preprocessor = ColumnTransformer([
+        ("num", Pipeline([("imputer", SimpleImputer()), ("scaler", StandardScaler())]), NUMERIC),
+        ("cat", Pipeline([("imputer", SimpleImputer(strategy="constant", fill_value="Missing")),
+                          ("onehot", OneHotEncoder(handle_unknown="ignore", sparse_output=False))]), CATEGORICAL),
+    ])
+    train = random_rows(400, seed=0, missing=0.05)
+    features = preprocessor.fit_transform(train)
+    selected = np.sort(np.random.default_rng(1).choice(features.shape[1], 20, replace=False))
+    X = features[:, selected]
+    rng = np.random.default_rng(2)
+    labels = (X[:, 0] + rng.normal(0, 0.5, len(X)) > 0).astype(int)
+    scores = X[:, :3].sum(axis=1) + rng.normal(0, 0.1, len(X))
+    return {
+        "preprocessor": preprocessor,
+        "selected_feature_indices": selected,
+        "classifier": RandomForestClassifier(n_estimators=15, max_depth=8, random_state=0).fit(X, labels),
+        "regressor": RandomForestRegressor(n_estimators=15, max_depth=8, random_state=0).fit(X, scores),
+    }
+
+
+def sklearn_features(model, frame):
+    return model["preprocessor"].transform(frame)[:, model["selected_feature_indices"]]
+
+
+@pytest.mark.parametrize("frame", [
+    pd.DataFrame([SAMPLE]),
+    random_rows(200, seed=10),
+    random_rows(200, seed=11, unknown=0.3),
+    random_rows(200, seed=12, missing=0.2),
+    random_rows(200, seed=13, extreme=0.3),
+    random_rows(200, seed=14, unknown=0.2, missing=0.2, extreme=0.2),
+], ids=["sample_data", "typical", "unknown_categories", "missing", "extreme_numerics", "everything"])
+def test_compiled_features_match_the_preprocessor(model, frame):
+    compiled = CompiledFeatures(model["preprocessor"], model["selected_feature_indices"])
+    np.testing.assert_allclose(compiled.transform(frame, len(frame)), sklearn_features(model, frame),
+                               rtol=1e-12, atol=0)
+
+
+def test_compiled_features_accept_a_request_dict(model):
+    compiled = CompiledFeatures(model["preprocessor"], model["selected_feature_indices"])
+    np.testing.assert_allclose(compiled.transform(SAMPLE), sklearn_features(model, pd.DataFrame([SAMPLE])),
+                               rtol=1e-12, atol=0)
+
+
+@pytest.mark.parametrize("frame", [
+    pd.DataFrame([SAMPLE]),
+    random_rows(300, seed=20),
+    random_rows(300, seed=21, unknown=0.3, missing=0.2, extreme=0.3),
+], ids=["sample_data", "typical", "unusual"])
+def test_packed_forests_match_sklearn(model, frame):
+    X = sklearn_features(model, frame)
+    classifier, regressor = model["classifier"], model["regressor"]
+    forests = PackedForests([classifier, regressor])
+
+    probabilities, values = forests.predict_values(X)
+    np.testing.assert_allclose(probabilities, classifier.predict_proba(X), rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(values[:, 0], regressor.predict(X), rtol=1e-12, atol=1e-12)
+
+    labels, predictions = forests.predict(X)
+    np.testing.assert_array_equal(labels, classifier.predict(X))
+    np.testing.assert_allclose(predictions, regressor.predict(X), rtol=1e-12, atol=1e-12)
+
+
+def test_packed_forests_handle_other_tree_types(model):
+    X = sklearn_features(model, random_rows(300, seed=30, extreme=0.3))
+    labels = np.array(["low", "mid", "high"])[np.random.default_rng(3).integers(0, 3, len(X))]
+    classifier = ExtraTreesClassifier(n_estimators=10, random_state=0).fit(X, labels)
+    regressor = DecisionTreeRegressor(max_depth=10, random_state=0).fit(X, X[:, 1])
+
+    packed_labels, packed_values = TreeEngine(classifier, regressor).predict(X, packed=True)
+    np.testing.assert_array_equal(packed_labels, classifier.predict(X))
+    np.testing.assert_allclose(packed_values, regressor.predict(X), rtol=1e-12, atol=1e-12)
+    probabilities, _ = PackedForests([classifier, regressor]).predict_values(X)
+    np.testing.assert_allclose(probabilities, classifier.predict_proba(X), rtol=1e-12, atol=1e-12)
@@ -0,0 +1,126 @@
+"""The breeding service's /rank against per-pair /predict"""
+import json
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+from fastapi.testclient import TestClient
+from sklearn.compose import ColumnTransformer
+from sklearn.ensemble import RandomForestClassifier, RandomForestRegressor
+from sklearn.impute import SimpleImputer
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+from conftest import MODELS_DIR, import_service
+
+with open(os.path.join(MODELS_DIR, "breeding_model", "sample_data.json")) as f:
+    SAMPLE = json.load(f)
+
+BREEDS = ["Gir", "Sahiwal", "Tharparkar"]
+
+
+def random_pairs(service, n_rows, seed):
+    rng = np.random.default_rng(seed)
+    sample = service.BreedingInput(**SAMPLE).dict()
+    rows = []
+    for _ in range(n_rows):
+        row = {}
+        for field, value in sample.items():
+            if isinstance(value, str):
+                row[field] = rng.choice(BREEDS) if field.endswith("Breed") else value
+            elif isinstance(value, int):
+                row[field] = value
+            else:
+                row[field] = round(float(value) * rng.uniform(0.5, 1.5), 2)
+        rows.append(row)
+    return rows
+
+
+def fit_model(service, seed=0):
+    derived = service.calculate_derived_features_frame(pd.DataFrame(random_pairs(service, 300, seed)))
+    categorical = [column for column in derived if not pd.api.types.is_numeric_dtype(derived[column])]
+    numeric = [column for column in derived if column not in categorical]
+    preprocessor = ColumnTransformer([
+        ("num", Pipeline([("imputer", SimpleImputer()), ("scaler", StandardScaler())]), numeric),
+        ("cat", Pipeline([("imputer", SimpleImputer(strategy="constant", fill_value="Missing")),
+                          ("onehot", OneHotEncoder(handle_unknown="ignore", sparse_output=False))]), categorical),
+    ])
+    X = preprocessor.fit_transform(derived)
+    selected = np.arange(min(12, X.shape[1]))
+    X = X[:, selected]
+    scores = X[:, :4].sum(axis=1) * 20
+    return {
+        "preprocessor": preprocessor,
+        "selected_feature_indices": selected,
+        "classifier": RandomForestClassifier(n_estimators=10, random_state=0).fit(X, (scores > 0).astype(int)),
+        "regressor": RandomForestRegressor(n_estimators=10, random_state=0).fit(X, scores),
+        "min_ccs": -50,
+        "max_ccs": 85,
+        "compatibility_threshold": 0,
+    }
+
+
+@pytest.fixture(scope="module")
+def service(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("breeding")
+    path = str(directory / "model.pkl")
+    # No model file yet: the service starts without one
+    service = import_service("breeding_model", MODEL_PATH=path,
+                             BULL_CATALOGUE_PATH=str(directory / "bull_catalogue.json"))
+    with open(path, "wb") as f:
+        pickle.dump(fit_model(service), f)
+    service.models.load(path)
+    return service
+
+
+@pytest.fixture(scope="module")
+def client(service):
+    # One client for the module: its shutdown stops the service's pool
+    with TestClient(service.app) as client:
+        yield client
+
+
+def split_pair(service, pair):
+    cow = {field: value for field, value in pair.items() if field in service.CowProfile.__fields__}
+    bull = {field: value for field, value in pair.items() if field not in cow}
+    return cow, bull
+
+
+def test_rank_matches_predict_with_mixed_and_missing_ids(service, client):
+    pairs = random_pairs(service, 6, seed=1)
+    cow, _ = split_pair(service, pairs[0])
+    bulls = []
+    for i, pair in enumerate(pairs):
+        _, bull = split_pair(service, pair)
+        # Every other bull comes without an id
+        if i % 2:
+            bull["bull_id"] = f"bull-{i}"
+        bulls.append(bull)
+
+    response = client.post("/rank", json={"cow": cow, "bulls": bulls, "top_k": len(bulls)})
+    assert response.status_code == 200
+    ranked = response.json()
+    assert ranked["candidates"] == len(bulls) and "error" not in ranked
+
+    expected_ids = [f"bull-{i}" if i % 2 else str(i) for i in range(len(bulls))]
+    assert sorted(entry["bull_id"] for entry in ranked["top_bulls"]) == sorted(expected_ids)
+    for entry in ranked["top_bulls"]:
+        i = expected_ids.index(entry["bull_id"])
+        bull = {field: value for field, value in bulls[i].items() if field != "bull_id"}
+        single = client.post("/predict", json={**cow, **bull}).json()
+        assert single == {field: entry[field] for field in ("compatible", "confidence_score", "raw_ccs_score")}
+
+    scores = [entry["raw_ccs_score"] for entry in ranked["top_bulls"]]
+    assert scores == sorted(scores, reverse=True)
+
+
+def test_rank_without_any_ids(service, client):
+    pairs = random_pairs(service, 3, seed=2)
+    cow, _ = split_pair(service, pairs[0])
+    bulls = [split_pair(service, pair)[1] for pair in pairs]
+
+    response = client.post("/rank", json={"cow": cow, "bulls": bulls, "top_k": 3})
+    assert response.status_code == 200
+    assert sorted(entry["bull_id"] for entry in response.json()["top_bulls"]) == ["0", "1", "2"]
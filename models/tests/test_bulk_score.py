@@ -0,0 +1,82 @@
+"""bulk_score: an interrupted run resumes where it stopped"""
+import concurrent.futures
+import json
+import types
+
+import pandas as pd
+import pytest
+
+import bulk_score
+
+N_ROWS = 10
+SHARD_SIZE = 3
+
+
+class Interrupted(Exception):
+    pass
+
+
+class InProcessExecutor(concurrent.futures.ThreadPoolExecutor):
+    """Stands in for the spawned worker pool: one thread running the same initializer"""
+
+    def __init__(self, max_workers, mp_context=None, initializer=None, initargs=()):
+        super().__init__(1, initializer=initializer, initargs=initargs)
+
+
+@pytest.fixture
+def run(tmp_path, monkeypatch):
+    table = tmp_path / "symptoms.csv"
+    pd.DataFrame({"id": [f"cow-{i}" for i in range(N_ROWS)], "symptoms": ["fever"] * N_ROWS}).to_csv(table,
+                                                                                                      index=False)
+    output = tmp_path / "run"
+    scored_rows = []
+    interrupt = {"enabled": False}
+
+    def init_worker(service, threads):
+        bulk_score._service = service
+        bulk_score._module = types.SimpleNamespace(models=types.SimpleNamespace(
+            current=types.SimpleNamespace(version="v1")))
+
+    def score(items):
+        # An interrupted run gets through the first shard only
+        if interrupt["enabled"] and items[0]["row"] != 0:
+            raise Interrupted()
+        scored_rows.extend(item["row"] for item in items)
+        return [{"prediction": item["row"]} for item in items]
+
+    monkeypatch.setattr(bulk_score.concurrent.futures, "ProcessPoolExecutor", InProcessExecutor)
+    monkeypatch.setattr(bulk_score, "init_worker", init_worker)
+    monkeypatch.setitem(bulk_score.SCORERS, "disease-qna", score)
+
+    def run_job(interrupted=False, shard_size=SHARD_SIZE):
+        interrupt["enabled"] = interrupted
+        bulk_score.main(["disease-qna", str(table), "--output", str(output), "--workers", "1",
+                         "--shard-size", str(shard_size)])
+
+    return types.SimpleNamespace(job=run_job, output=output, scored_rows=scored_rows)
+
+
+def test_resume_scores_only_missing_shards(run):
+    with pytest.raises(Interrupted):
+        run.job(interrupted=True)
+    assert run.scored_rows == [0, 1, 2]
+    assert sorted(path.name for path in (run.output / "shards").iterdir()) == ["000000.jsonl"]
+    assert not (run.output / "results.jsonl").exists()
+
+    run.job()
+    # The finished shard was kept, not scored again
+    assert sorted(run.scored_rows) == list(range(N_ROWS))
+
+    with open(run.output / "results.jsonl") as f:
+        lines = [json.loads(line) for line in f]
+    assert [line["row"] for line in lines] == list(range(N_ROWS))
+    assert [line["id"] for line in lines] == [f"cow-{i}" for i in range(N_ROWS)]
+    assert all(line["prediction"] == line["row"] and line["model_version"] == "v1" for line in lines)
+
+
+def test_resume_refuses_a_different_plan(run):
+    with pytest.raises(Interrupted):
+        run.job(interrupted=True)
+    with pytest.raises(SystemExit, match="different inputs or shard size"):
+        run.job(shard_size=SHARD_SIZE + 1)
+    assert run.scored_rows == [0, 1, 2]
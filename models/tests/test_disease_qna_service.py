@@ -0,0 +1,151 @@
+"""The symptom service on a small soft-voting ensemble"""
+import asyncio
+
+import joblib
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+from sklearn.ensemble import RandomForestClassifier, VotingClassifier
+from sklearn.neighbors import KNeighborsClassifier
+from sklearn.tree import DecisionTreeClassifier
+
+from conftest import import_service
+
+N_SYMPTOMS = 92
+
+
+def fit_ensemble(seed=0):
+    rng = np.random.default_rng(seed)
+    X = (rng.random((200, N_SYMPTOMS)) < 0.05).astype(np.float64)
+    y = X[:, :4].argmax(axis=1) + X[:, 4]
+    return VotingClassifier([
+        ("tree", DecisionTreeClassifier(random_state=0)),
+        ("forest", RandomForestClassifier(n_estimators=10, random_state=0)),
+        ("knn", KNeighborsClassifier(n_neighbors=5)),
+    ], voting="soft").fit(X, y)
+
+
+# Query log for the warm-up table: the two most frequent sets are pinned
+SYMPTOM_LOG = """["fever", "coughing"]
+fever, coughing
+coughing,fever
+["lameness"]
+lameness
+["ulcers"]
+"""
+
+
+@pytest.fixture(scope="module")
+def service(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("disease_qna")
+    joblib.dump(fit_ensemble(), directory / "model.pkl")
+    (directory / "symptoms.log").write_text(SYMPTOM_LOG)
+    service = import_service("disease-qna", MODEL_PATH=str(directory / "model.pkl"), INFERENCE_EXECUTOR="thread",
+                             SYMPTOM_LOG_PATH=str(directory / "symptoms.log"), SYMPTOM_WARMUP_TOP="2",
+                             SYMPTOM_CACHE_SIZE="4")
+    assert len(service.symptom_list) == N_SYMPTOMS
+    # One client for the module: its shutdown stops the service's pool
+    with TestClient(service.app) as client:
+        service.client = client
+        yield service
+
+
+def symptom_sets(service, n, seed):
+    rng = np.random.default_rng(seed)
+    return [list(rng.choice(service.symptom_list, rng.integers(0, 6), replace=False)) for _ in range(n)]
+
+
+def test_batch_matches_the_model(service):
+    sets = symptom_sets(service, 20, seed=1)
+    response = service.client.post("/predict/batch", json={"symptom_sets": sets})
+    assert response.status_code == 200
+    expected = service.models.current.model.predict(service.encode_symptoms(sets)).astype(int).tolist()
+    assert response.json()["predictions"] == expected
+    assert [service.client.post("/predict", json={"symptoms": symptoms}).json()["prediction"]
+            for symptoms in sets[:5]] == expected[:5]
+
+
+def test_probabilities_name_the_version_that_produced_them(service):
+    sets = symptom_sets(service, 5, seed=2)
+    response = service.client.post("/predict/batch", json={"symptom_sets": sets, "include_probabilities": True})
+    assert response.status_code == 200
+    body = response.json()
+    assert body["model_version"] == service.models.version
+    probabilities = service.models.current.model.predict_proba(service.encode_symptoms(sets)).max(axis=1)
+    np.testing.assert_allclose(body["probabilities"], probabilities.round(4))
+
+
+def test_no_model_answers_503(service, monkeypatch):
+    monkeypatch.setattr(service.models, "current", None)
+    assert service.client.post("/predict", json={"symptoms": ["fever"]}).status_code == 503
+    assert service.client.post("/predict/batch", json={"symptom_sets": [["fever"]]}).status_code == 503
+
+
+def test_symptom_cache_keeps_pinned_entries(service):
+    cache = service.SymptomCache(max_entries=2)
+    cache.pin((1,), 7)
+    for key in [(2,), (3,), (4,)]:
+        cache.put(key, 0)
+    # Putting a pinned set does not move it into the LRU part
+    cache.put((1,), 9)
+
+    assert cache.get((1,)) == 7
+    assert cache.get((2,)) is None and cache.get((4,)) == 0
+    assert cache.stats()["entries"] == 2 and cache.stats()["pinned_entries"] == 1
+    assert cache.stats()["evictions"] == 1
+
+
+def test_frequent_symptom_sets_are_pinned_at_load(service):
+    cache = service.models.current.symptom_cache
+    pinned = cache._pinned
+    keys = [service.canonical_symptoms(["fever", "coughing"]), service.canonical_symptoms(["lameness"])]
+    assert sorted(pinned) == sorted(keys)
+    predictions = service.models.current.model.predict(service.encode_symptom_keys(keys)).astype(int).tolist()
+    assert [pinned[key] for key in keys] == predictions
+
+
+@pytest.fixture
+def model_calls(service, monkeypatch):
+    calls = []
+    predict_symptom_keys = service.predict_symptom_keys
+
+    def recording_predict(keys):
+        calls.append(list(keys))
+        return predict_symptom_keys(keys)
+
+    monkeypatch.setattr(service, "predict_symptom_keys", recording_predict)
+    return calls
+
+
+def test_only_uncached_distinct_sets_reach_the_model(service, model_calls):
+    current = service.models.current
+    sets = [["coughing", "fever"], ["lameness"], ["anaemia", "jaundice"], ["jaundice", "anaemia", "jaundice"]]
+    first = service.client.post("/predict/batch", json={"symptom_sets": sets}).json()["predictions"]
+
+    new_key = service.canonical_symptoms(["anaemia", "jaundice"])
+    assert model_calls == [[new_key]]
+    assert current.symptom_cache.get(new_key) == first[2] == first[3]
+
+    # Answered from the cache the second time
+    assert service.client.post("/predict/batch", json={"symptom_sets": sets}).json()["predictions"] == first
+    assert model_calls == [[new_key]]
+
+    # Pinned sets outlast a full LRU part
+    for i in range(6):
+        current.symptom_cache.put((i, i + 1), 0)
+    assert current.symptom_cache.get(new_key) is None
+    assert service.client.post("/predict/batch", json={"symptom_sets": sets[:2]}).json()["predictions"] == first[:2]
+    assert model_calls == [[new_key]]
+
+
+def test_predictions_of_a_swapped_model_are_not_cached(service, monkeypatch):
+    current = service.models.current
+    key = service.canonical_symptoms(["salivation", "drooling", "fever"])
+
+    def other_version(keys):
+        return "other-version", current.model.predict(service.encode_symptom_keys(keys))
+
+    monkeypatch.setattr(service, "predict_symptom_keys", other_version)
+    computed = asyncio.run(service.predict_missing(current, [key]))
+    assert key in computed
+    assert current.symptom_cache.get(key) is None
@@ -0,0 +1,274 @@
+"""The gateway: on-demand loading within a memory budget, and /analyze"""
+import asyncio
+import importlib
+import io
+import shutil
+import sys
+import types
+
+import numpy as np
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from PIL import Image
+
+from serving import InferencePool, ModelManager, PredictionCache
+
+MODEL_MB = 100
+
+
+@pytest.fixture(scope="module")
+def gateway(image_model_path, tmp_path_factory):
+    environ = {
+        "GATEWAY_SERVICES": "breed-identification,disease-identify",
+        "MODEL_PATH": image_model_path,
+        "INFERENCE_BACKEND": "keras",
+        "EMBEDDING_INDEX_DIR": str(tmp_path_factory.mktemp("index")),
+    }
+    saved = ModelManager.lazy, InferencePool.shared, PredictionCache.shared
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        for name, value in environ.items():
+            monkeypatch.setenv(name, value)
+        sys.modules.pop("gateway", None)
+        gateway = importlib.import_module("gateway")
+    # The gateway sets these for every service it imports; later imports get the defaults back
+    ModelManager.lazy, InferencePool.shared, PredictionCache.shared = saved
+
+    # A model file per service, as deployed: the services share one prediction cache keyed by model version
+    directory = tmp_path_factory.mktemp("gateway_models")
+    for name, module in gateway.services.items():
+        path = directory / f"{name}.keras"
+        shutil.copyfile(image_model_path, path)
+        module.models.path = str(path)
+    return gateway
+
+
+class FakeManager:
+    """Stands in for a service's ModelManager; loading one adds MODEL_MB to the fake RSS"""
+
+    def __init__(self, name, memory, loads, fail=False):
+        self.name = name
+        self.memory = memory
+        self.loads = loads
+        self.fail = fail
+        self.current = None
+
+    @property
+    def version(self):
+        return self.current.version if self.current is not None else None
+
+    async def reload(self):
+        await asyncio.sleep(0.01)
+        if self.fail:
+            raise RuntimeError("model file is missing")
+        self.loads.append(self.name)
+        self.memory["mb"] += MODEL_MB
+        self.current = types.SimpleNamespace(version=f"{self.name}-v1")
+
+    def unload(self):
+        self.current = None
+        self.memory["mb"] -= MODEL_MB
+
+
+@pytest.fixture
+def residency(gateway, monkeypatch):
+    memory, loads = {"mb": 500.0}, []
+    monkeypatch.setattr(gateway, "rss_mb", lambda: memory["mb"])
+
+    def make(budget_mb, pinned=(), names=("a", "b", "c"), failing=()):
+        residency = gateway.Residency(budget_mb, pinned)
+        for name in names:
+            residency.add(name, FakeManager(name, memory, loads, fail=name in failing))
+        residency.loads = loads
+        return residency
+
+    return make
+
+
+def use(residency, *names):
+    async def main():
+        for name in names:
+            await residency.acquire(name)
+            residency.release(name)
+    asyncio.run(main())
+
+
+def test_least_recently_used_model_is_unloaded(residency):
+    residency = residency(budget_mb=2 * MODEL_MB)
+    use(residency, "a", "b", "a", "c")
+
+    # b was used least recently when c came in
+    assert sorted(residency.resident()) == ["a", "c"]
+    assert residency.evictions == 1
+    assert residency.size_mb == {"a": MODEL_MB, "b": MODEL_MB, "c": MODEL_MB}
+
+
+def test_an_unloaded_model_is_loaded_again_on_use(residency):
+    residency = residency(budget_mb=2 * MODEL_MB)
+    use(residency, "a", "b", "c", "a")
+
+    assert residency.loads == ["a", "b", "c", "a"]
+    assert sorted(residency.resident()) == ["a", "c"]
+    status = residency.status()
+    assert status["evictions"] == 2 and status["resident_mb"] == 2 * MODEL_MB
+    assert status["models"]["b"]["loaded"] is False and status["models"]["a"]["version"] == "a-v1"
+
+
+def test_pinned_and_busy_models_are_not_unloaded(residency):
+    residency = residency(budget_mb=MODEL_MB, pinned=["a"], names=("a", "b", "c", "d"))
+
+    async def main():
+        await residency.acquire("a")
+        residency.release("a")
+        await residency.acquire("b")
+        # b is still handling a request when c loads
+        await residency.acquire("c")
+        residency.release("c")
+        residency.release("b")
+
+    asyncio.run(main())
+    assert sorted(residency.resident()) == ["a", "b", "c"]
+    assert residency.evictions == 0
+
+    # Once idle, everything but the pinned model makes way for the next one
+    use(residency, "d")
+    assert sorted(residency.resident()) == ["a", "d"]
+    assert residency.evictions == 2
+
+
+def test_concurrent_first_requests_load_once(residency):
+    residency = residency(budget_mb=0)
+
+    async def main():
+        await asyncio.gather(*(residency.acquire("a") for _ in range(5)))
+        return dict(residency.in_flight)
+
+    in_flight = asyncio.run(main())
+    assert residency.loads == ["a"]
+    assert in_flight["a"] == 5
+
+
+def test_a_failed_load_is_not_counted_in_flight(residency):
+    residency = residency(budget_mb=0, failing=["b"])
+    with pytest.raises(RuntimeError):
+        use(residency, "b")
+    assert residency.in_flight["b"] == 0 and residency.resident() == []
+
+
+def test_resident_app_loads_the_model_only_for_model_routes(gateway, residency):
+    residency = residency(budget_mb=0, names=("svc", "broken"), failing=["broken"])
+    app = FastAPI()
+
+    @app.get("/")
+    def root():
+        return {"ok": True}
+
+    @app.get("/predict")
+    def predict():
+        return {"in_flight": residency.in_flight["svc"]}
+
+    gateway_app = FastAPI()
+    gateway_app.mount("/svc", gateway.ResidentApp("svc", app, residency))
+    gateway_app.mount("/broken", gateway.ResidentApp("broken", app, residency))
+    client = TestClient(gateway_app)
+
+    assert client.get("/svc/").json() == {"ok": True}
+    assert residency.loads == []
+    assert client.get("/svc/predict").json() == {"in_flight": 1}
+    assert residency.loads == ["svc"] and residency.in_flight["svc"] == 0
+
+    response = client.get("/broken/predict")
+    assert response.status_code == 503 and "model file is missing" in response.json()["detail"]
+
+
+@pytest.fixture(scope="module")
+def client(gateway):
+    with TestClient(gateway.app) as client:
+        yield client
+
+
+def png(seed):
+    pixels = np.random.default_rng(seed).integers(0, 256, (40, 40, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def analyze(client, contents):
+    return client.post("/analyze", files={"file": ("cow.png", contents, "image/png")})
+
+
+def expected_result(module, contents):
+    current = module.models.current
+    return module.format_predictions(current.backend.predict(module.load_image(contents))[0])
+
+
+@pytest.fixture
+def recorded(gateway, client, monkeypatch):
+    """Decodes and batcher submissions made while analyzing"""
+    calls = {"decodes": 0, "submitted": {}}
+    breed = gateway.services["breed-identification"]
+    load_image = breed.load_image
+
+    def counting_load_image(*args):
+        calls["decodes"] += 1
+        return load_image(*args)
+
+    monkeypatch.setattr(breed, "load_image", counting_load_image)
+    for part, name in gateway.ANALYZE_SERVICES.items():
+        batcher = gateway.services[name].batcher
+        submit = batcher.submit
+
+        async def recording_submit(inputs, part=part, submit=submit):
+            calls["submitted"][part] = inputs
+            return await submit(inputs)
+
+        monkeypatch.setattr(batcher, "submit", recording_submit)
+    return calls
+
+
+def test_analyze_decodes_once_for_both_models(gateway, client, recorded):
+    contents = png(1)
+    response = analyze(client, contents)
+    assert response.status_code == 200
+    body = response.json()
+
+    assert recorded["decodes"] == 1
+    assert recorded["submitted"]["breed"] is recorded["submitted"]["disease"]
+    # Answered from both caches the second time
+    assert analyze(client, contents).json() == body
+    assert recorded["decodes"] == 1
+
+    for part, name in gateway.ANALYZE_SERVICES.items():
+        module = gateway.services[name]
+        assert body[part] == expected_result(module, contents)
+        assert body["model_versions"][name] == module.models.version
+
+
+def test_analyze_reports_a_failed_model_next_to_the_other(gateway, client, monkeypatch):
+    disease = gateway.services["disease-identify"]
+
+    async def failing_submit(inputs):
+        raise RuntimeError("out of memory")
+
+    monkeypatch.setattr(disease.batcher, "submit", failing_submit)
+    contents = png(2)
+    response = analyze(client, contents)
+    assert response.status_code == 200
+    body = response.json()
+    assert body["disease"] == {"error": "Prediction failed: out of memory"}
+    assert body["breed"] == expected_result(gateway.services["breed-identification"], contents)
+
+    # Nothing was cached for the failed model
+    monkeypatch.undo()
+    assert "error" not in analyze(client, contents).json()["disease"]
+
+
+def test_analyze_fails_when_every_model_fails(gateway, client, monkeypatch):
+    async def failing_submit(inputs):
+        raise RuntimeError("out of memory")
+
+    for name in gateway.ANALYZE_SERVICES.values():
+        monkeypatch.setattr(gateway.services[name].batcher, "submit", failing_submit)
+    assert analyze(client, png(3)).status_code == 500
+    assert analyze(client, b"not an image").status_code == 400
@@ -0,0 +1,96 @@
+"""The image services' batch endpoint on a tiny Keras model"""
+import asyncio
+import io
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+from conftest import import_service
+
+SERVICES = ("breed-identification", "disease_identify")
+
+
+def png(seed):
+    pixels = np.random.default_rng(seed).integers(0, 256, (32, 32, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+@pytest.fixture(scope="module", params=SERVICES)
+def service(request, image_model_path, tmp_path_factory):
+    service = import_service(request.param, MODEL_PATH=image_model_path, INFERENCE_BACKEND="keras",
+                             EMBEDDING_INDEX_DIR=str(tmp_path_factory.mktemp("index")))
+    # One client per service: its shutdown stops the service's pool
+    with TestClient(service.app) as client:
+        service.client = client
+        yield service
+
+
+def post_batch(service, seeds):
+    files = [("files", (f"{seed}.png", png(seed), "image/png")) for seed in seeds]
+    return service.client.post("/predict/batch", files=files)
+
+
+def test_batch_streams_every_image_and_returns_its_slot(service):
+    response = post_batch(service, range(3))
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted(line["index"] for line in lines) == [0, 1, 2]
+    assert not any("error" in line for line in lines)
+    assert service.pool.pending == 0
+
+
+def test_no_model_answers_503(service, monkeypatch):
+    monkeypatch.setattr(service.models, "current", None)
+    response = service.client.post("/predict/", files={"file": ("0.png", png(0), "image/png")})
+    assert response.status_code == 503
+    assert post_batch(service, (0,)).status_code == 503
+
+
+def test_saturated_pool_answers_503_before_streaming(service):
+    pool = service.pool
+    pool._pending = pool.max_pending
+    try:
+        # Uncached images, so the request would need the model
+        response = post_batch(service, (10, 11))
+        assert response.status_code == 503
+        assert response.headers["Retry-After"]
+        assert pool.pending == pool.max_pending
+    finally:
+        pool._pending = 0
+
+    assert post_batch(service, (10, 11)).status_code == 200
+    assert pool.pending == 0
+
+
+def test_a_streaming_batch_holds_its_slot_until_sent(service, monkeypatch):
+    started, release = threading.Event(), threading.Event()
+    decode_chunk = service.decode_chunk
+
+    async def blocked_decode(chunk):
+        started.set()
+        while not release.is_set():
+            await asyncio.sleep(0.01)
+        return await decode_chunk(chunk)
+
+    monkeypatch.setattr(service, "decode_chunk", blocked_decode)
+    pool = service.pool
+    pool._pending = pool.max_pending - 1
+    try:
+        with ThreadPoolExecutor(1) as executor:
+            batch = executor.submit(post_batch, service, (20,))
+            assert started.wait(10)
+            # The stream holds the last slot, so the next request is turned away
+            assert post_batch(service, (21,)).status_code == 503
+            release.set()
+            assert batch.result(10).status_code == 200
+        assert pool.pending == pool.max_pending - 1
+    finally:
+        release.set()
+        pool._pending = 0
@@ -0,0 +1,152 @@
+"""The bit-packed Hamming KNN index against sklearn's KNeighborsClassifier"""
+import numpy as np
+import pytest
+from sklearn.ensemble import VotingClassifier
+from sklearn.neighbors import KNeighborsClassifier
+from sklearn.tree import DecisionTreeClassifier
+
+import neighbors
+from neighbors import HammingKNeighbors, build_hamming_ensemble
+
+N_FEATURES = 70
+
+
+def binary_rows(n_rows, seed, density=0.08):
+    return (np.random.default_rng(seed).random((n_rows, N_FEATURES)) < density).astype(np.float64)
+
+
+@pytest.fixture(scope="module")
+def training():
+    X = binary_rows(300, seed=0)
+    # Repeated patterns with different labels, as symptom data has
+    X = np.concatenate([X, X[:40]])
+    y = np.random.default_rng(1).integers(0, 4, len(X))
+    return X, y
+
+
+def queries(training_X):
+    return np.concatenate([training_X[:50], binary_rows(200, seed=2), binary_rows(50, seed=3, density=0.5)])
+
+
+@pytest.mark.parametrize("metric", ["minkowski", "euclidean", "manhattan", "hamming"])
+@pytest.mark.parametrize("weights", ["uniform", "distance"])
+@pytest.mark.parametrize("k", [1, 5, 12])
+def test_matches_sklearn(training, metric, weights, k):
+    X, y = training
+    knn = KNeighborsClassifier(n_neighbors=k, metric=metric, weights=weights).fit(X, y)
+    index = HammingKNeighbors(knn)
+    Q = queries(X)
+
+    np.testing.assert_array_equal(index.predict(Q), knn.predict(Q))
+    np.testing.assert_allclose(index.predict_proba(Q), knn.predict_proba(Q), rtol=1e-9, atol=1e-12)
+
+
+def test_ties_at_the_kth_neighbour_are_answered_by_sklearn():
+    # The query is one symptom away from four rows, two of each class, and k=3
+    # leaves one slot to fill from that tie
+    X = np.zeros((5, 8))
+    X[0, :] = 1
+    X[1:, :4] = np.eye(4)
+    y = np.array([0, 0, 0, 1, 1])
+    knn = KNeighborsClassifier(n_neighbors=3).fit(X, y)
+    index = HammingKNeighbors(knn)
+    query = np.zeros((1, 8))
+
+    _, ambiguous = index._votes(query)
+    assert ambiguous.tolist() == [True]
+    np.testing.assert_array_equal(index.predict(query), knn.predict(query))
+    np.testing.assert_allclose(index.predict_proba(query), knn.predict_proba(query))
+
+
+def test_ties_within_one_class_are_answered_by_the_index():
+    # Three rows of one class tie for the two neighbour slots
+    X = np.zeros((4, 8))
+    X[:3, :3] = np.eye(3)
+    X[3, :] = 1
+    y = np.array([1, 1, 1, 0])
+    knn = KNeighborsClassifier(n_neighbors=2).fit(X, y)
+    index = HammingKNeighbors(knn)
+    query = np.zeros((1, 8))
+
+    _, ambiguous = index._votes(query)
+    assert ambiguous.tolist() == [False]
+    np.testing.assert_allclose(index.predict_proba(query), [[0, 1]])
+    np.testing.assert_allclose(index.predict_proba(query), knn.predict_proba(query))
+
+
+def test_distance_weights_with_exact_matches():
+    X = binary_rows(60, seed=4)
+    # The first pattern appears three times with two labels
+    X = np.concatenate([X, X[:1], X[:1]])
+    y = np.random.default_rng(5).integers(0, 3, len(X))
+    y[0], y[-2], y[-1] = 0, 1, 1
+    knn = KNeighborsClassifier(n_neighbors=5, weights="distance").fit(X, y)
+    index = HammingKNeighbors(knn)
+    # Exact matches only, then a mix of matched and unmatched queries
+    Q = np.concatenate([X[:1], X[:10], binary_rows(10, seed=6)])
+
+    np.testing.assert_allclose(index.predict_proba(Q[:1]), [[1 / 3, 2 / 3, 0]])
+    np.testing.assert_allclose(index.predict_proba(Q), knn.predict_proba(Q), rtol=1e-9, atol=1e-12)
+    np.testing.assert_array_equal(index.predict(Q), knn.predict(Q))
+
+
+def test_non_binary_queries_go_to_sklearn(training):
+    X, y = training
+    knn = KNeighborsClassifier(n_neighbors=5).fit(X, y)
+    Q = binary_rows(10, seed=7) * 0.5
+    np.testing.assert_allclose(HammingKNeighbors(knn).predict_proba(Q), knn.predict_proba(Q))
+
+
+@pytest.mark.parametrize("knn, X", [
+    (KNeighborsClassifier(metric="cosine"), None),
+    (KNeighborsClassifier(), np.random.default_rng(8).random((20, N_FEATURES))),
+])
+def test_unsupported_models_are_refused(knn, X):
+    if X is None:
+        X = binary_rows(20, seed=9)
+    knn.fit(X, np.arange(len(X)) % 2)
+    with pytest.raises(NotImplementedError):
+        HammingKNeighbors(knn)
+
+
+@pytest.fixture
+def ensemble(training):
+    X, y = training
+    return VotingClassifier([
+        ("tree", DecisionTreeClassifier(random_state=0)),
+        ("knn", KNeighborsClassifier(n_neighbors=5)),
+    ], voting="soft").fit(X, y)
+
+
+def test_ensemble_is_served_by_the_index(ensemble, training):
+    fast = build_hamming_ensemble(ensemble, N_FEATURES)
+    assert isinstance(fast.estimators_[1], HammingKNeighbors)
+    assert ensemble.estimators_[1].__class__ is KNeighborsClassifier
+    Q = queries(training[0])
+    np.testing.assert_allclose(fast.predict_proba(Q), ensemble.predict_proba(Q), rtol=1e-9, atol=1e-12)
+
+
+def test_a_failed_parity_check_keeps_sklearn(ensemble, monkeypatch, capsys):
+    predict_proba = HammingKNeighbors.predict_proba
+
+    def skewed(self, X):
+        probabilities = predict_proba(self, X)
+        return probabilities[:, ::-1]
+
+    monkeypatch.setattr(HammingKNeighbors, "predict_proba", skewed)
+    assert build_hamming_ensemble(ensemble, N_FEATURES) is None
+    assert "differ from sklearn" in capsys.readouterr().out
+
+
+def test_sklearn_engine_can_be_forced(ensemble, monkeypatch):
+    monkeypatch.setenv("KNN_ENGINE", "sklearn")
+    assert build_hamming_ensemble(ensemble, N_FEATURES) is None
+
+
+def test_small_distance_chunks_give_the_same_answers(ensemble, training, monkeypatch):
+    knn = ensemble.estimators_[1]
+    Q = queries(training[0])
+    expected = HammingKNeighbors(knn).predict_proba(Q)
+    # One query per chunk
+    monkeypatch.setattr(neighbors, "MAX_CHUNK_PAIRS", 1)
+    np.testing.assert_array_equal(HammingKNeighbors(knn).predict_proba(Q), expected)
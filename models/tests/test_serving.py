@@ -0,0 +1,329 @@
+"""Tests for the shared serving helpers"""
+import asyncio
+
+import numpy as np
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import serving
+from serving import MicroBatcher, ModelManager, PredictionCache, SingleFlight
+
+
+def run_batched(batcher, requests):
+    async def main():
+        batcher.start()
+        try:
+            return await asyncio.gather(*(batcher.submit(inputs) for inputs in requests))
+        finally:
+            await batcher.stop()
+    return asyncio.run(main())
+
+
+def recording_predict(calls):
+    def predict(batch):
+        calls.append(len(batch))
+        return batch * 10
+    return predict
+
+
+def test_concurrent_requests_share_one_forward_pass():
+    calls = []
+    batcher = MicroBatcher(recording_predict(calls), max_batch_size=16, max_wait_ms=20)
+    requests = [np.full((1, 3), i, dtype=np.float32) for i in range(5)]
+
+    outputs = run_batched(batcher, requests)
+
+    assert calls == [5]
+    for inputs, output in zip(requests, outputs):
+        np.testing.assert_array_equal(output, inputs * 10)
+
+
+def test_batches_respect_max_batch_size_and_keep_order():
+    calls = []
+    batcher = MicroBatcher(recording_predict(calls), max_batch_size=4, max_wait_ms=20)
+    # Row counts 1, 2, 2, 1, 3: the second 2-row request does not fit and is carried over
+    requests = [np.arange(n, dtype=np.float32).reshape(n, 1) + 100 * i for i, n in enumerate((1, 2, 2, 1, 3))]
+
+    outputs = run_batched(batcher, requests)
+
+    assert calls == [3, 3, 3]
+    assert sum(calls) == sum(len(inputs) for inputs in requests)
+    for inputs, output in zip(requests, outputs):
+        assert output.shape == inputs.shape
+        np.testing.assert_array_equal(output, inputs * 10)
+
+
+def test_failed_forward_pass_reaches_every_caller():
+    def predict(batch):
+        raise ValueError("model failed")
+
+    batcher = MicroBatcher(predict, max_batch_size=8, max_wait_ms=20)
+
+    async def main():
+        batcher.start()
+        try:
+            return await asyncio.gather(*(batcher.submit(np.zeros((1, 2))) for _ in range(3)),
+                                        return_exceptions=True)
+        finally:
+            await batcher.stop()
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_tagged_batches_report_their_tag_to_every_caller():
+    versions = iter(["v1", "v2"])
+
+    def predict(batch):
+        return next(versions), batch * 10
+
+    batcher = MicroBatcher(predict, max_batch_size=2, max_wait_ms=20, tagged=True)
+    requests = [np.full((1, 1), i, dtype=np.float32) for i in range(4)]
+
+    outputs = run_batched(batcher, requests)
+
+    assert [tag for tag, _ in outputs] == ["v1", "v1", "v2", "v2"]
+    for inputs, (_, rows) in zip(requests, outputs):
+        np.testing.assert_array_equal(rows, inputs * 10)
+
+
+def gated_model(calls, gate, result="result"):
+    async def predict(x):
+        calls.append(x)
+        await gate.wait()
+        if isinstance(result, Exception):
+            raise result
+        return result
+    return predict
+
+
+def test_identical_requests_call_the_model_once():
+    async def main():
+        flight, calls, gate = SingleFlight("test"), [], asyncio.Event()
+        waiters = [asyncio.ensure_future(flight.run("key", gated_model(calls, gate), i)) for i in range(10)]
+        await asyncio.sleep(0)
+        gate.set()
+        return flight, calls, await asyncio.gather(*waiters)
+
+    flight, calls, results = asyncio.run(main())
+    assert calls == [0]
+    assert results == ["result"] * 10
+    assert flight.stats() == {"in_flight": 0, "leaders": 1, "coalesced": 9}
+
+
+def test_an_exception_reaches_every_waiter_and_clears_the_key():
+    async def main():
+        flight, calls, gate = SingleFlight("test"), [], asyncio.Event()
+        model = gated_model(calls, gate, ValueError("model failed"))
+        waiters = [asyncio.ensure_future(flight.run("key", model, i)) for i in range(5)]
+        await asyncio.sleep(0)
+        gate.set()
+        results = await asyncio.gather(*waiters, return_exceptions=True)
+        in_flight = flight.stats()["in_flight"]
+        # The next request for the key runs the model again
+        retry = await flight.run("key", gated_model(calls, gate), "retry")
+        return calls, results, in_flight, retry
+
+    calls, results, in_flight, retry = asyncio.run(main())
+    assert all(isinstance(result, ValueError) for result in results)
+    assert in_flight == 0
+    assert calls == [0, "retry"] and retry == "result"
+
+
+def test_a_cancelled_leader_does_not_strand_its_followers():
+    async def main():
+        flight, calls, gate = SingleFlight("test"), [], asyncio.Event()
+        leader = asyncio.ensure_future(flight.run("key", gated_model(calls, gate), "leader"))
+        await asyncio.sleep(0)
+        followers = [asyncio.ensure_future(flight.run("key", gated_model(calls, gate), i)) for i in range(3)]
+        await asyncio.sleep(0)
+
+        # The leader's client disconnects; the prediction carries on for the others
+        leader.cancel()
+        await asyncio.sleep(0)
+        gate.set()
+        results = await asyncio.wait_for(asyncio.gather(*followers), 5)
+        return flight, calls, leader, results
+
+    flight, calls, leader, results = asyncio.run(main())
+    assert leader.cancelled()
+    assert calls == ["leader"]
+    assert results == ["result"] * 3
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_a_cancelled_prediction_is_reported_to_every_waiter():
+    async def main():
+        flight, calls, gate = SingleFlight("test"), [], asyncio.Event()
+        waiters = [asyncio.ensure_future(flight.run("key", gated_model(calls, gate), i)) for i in range(3)]
+        await asyncio.sleep(0)
+        flight._tasks["key"].cancel()
+        results = await asyncio.wait_for(asyncio.gather(*waiters, return_exceptions=True), 5)
+        return flight, results
+
+    flight, results = asyncio.run(main())
+    assert all(isinstance(result, asyncio.CancelledError) for result in results)
+    assert flight.stats()["in_flight"] == 0
+
+
+def read_model(path):
+    with open(path) as f:
+        return {"model": f.read()}
+
+
+def check_model(candidate):
+    if candidate.model == "broken":
+        raise ValueError("model is broken")
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    monkeypatch.setenv("ADMIN_TOKEN", "secret")
+    (tmp_path / "v1.txt").write_text("one")
+    (tmp_path / "v2.txt").write_text("two")
+    (tmp_path / "broken.txt").write_text("broken")
+    manager = ModelManager(str(tmp_path / "v1.txt"), read_model, warmup=check_model)
+    manager.load()
+    return manager
+
+
+def test_reload_swaps_in_the_new_version(manager, tmp_path):
+    first = manager.current
+    version = asyncio.run(manager.reload(str(tmp_path / "v2.txt")))
+
+    assert manager.current is not first
+    assert manager.current.model == "two" and manager.version == version and version.startswith("v2.txt@")
+    assert manager.path == str(tmp_path / "v2.txt")
+    assert manager.info()["reloads"] == 1
+
+
+@pytest.mark.parametrize("name", ["broken.txt", "missing.txt"])
+def test_failed_load_keeps_the_old_version(manager, tmp_path, name):
+    first = manager.current
+    with pytest.raises((ValueError, OSError)):
+        manager.load(str(tmp_path / name))
+
+    assert manager.current is first and manager.current.model == "one"
+    assert manager.path == str(tmp_path / "v1.txt")
+    info = manager.info()
+    assert info["reloads"] == 0 and info["last_reload_error"].startswith(str(tmp_path / name))
+
+    # The next good load clears the error
+    manager.load(str(tmp_path / "v2.txt"))
+    assert manager.info()["last_reload_error"] is None
+
+
+def test_reload_endpoint_reports_a_failed_load(manager, tmp_path):
+    app = FastAPI()
+    manager.install(app)
+    client = TestClient(app)
+    headers = {"X-Admin-Token": "secret"}
+
+    response = client.post("/admin/reload", params={"path": str(tmp_path / "broken.txt")}, headers=headers)
+    assert response.status_code == 500 and "still serving v1.txt@" in response.json()["detail"]
+    assert manager.current.model == "one"
+
+    response = client.post("/admin/reload", params={"path": str(tmp_path / "v2.txt")}, headers=headers)
+    assert response.status_code == 200
+    assert response.headers["X-Model-Version"] == manager.version == response.json()["version"]
+    assert client.post("/admin/reload", headers={"X-Admin-Token": "wrong"}).status_code == 401
+
+
+def test_unload_and_load_again(manager):
+    version = manager.version
+    manager.unload()
+    assert manager.current is None and manager.version is None
+    assert manager.load() == version
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [serving.time.time()]
+    monkeypatch.setattr(serving.time, "time", lambda: now[0])
+    return now
+
+
+def result(i, size=100):
+    return {"class_id": i, "padding": "x" * size}
+
+
+def entry_mb(value):
+    return len(serving.json.dumps(value)) / (1024 * 1024)
+
+
+def flush(cache):
+    """Wait for the background disk writes queued so far"""
+    cache._disk_writer.submit(lambda: None).result()
+
+
+def test_cache_entries_expire(clock):
+    cache = PredictionCache(max_mb=1, ttl_seconds=10)
+    cache.put("key", result(1))
+
+    clock[0] += 9
+    assert cache.get("key") == result(1)
+    clock[0] += 2
+    assert cache.get("key") is None
+    assert cache.stats()["entries"] == 0 and cache.stats()["misses"] == 1
+
+
+def test_cache_evicts_the_least_recently_used_entry():
+    cache = PredictionCache(max_mb=3.5 * entry_mb(result(0)))
+    for key in "abc":
+        cache.put(key, result(ord(key)))
+    assert cache.get("a") is not None
+
+    cache.put("d", result(ord("d")))
+    assert cache.get("b") is None
+    assert all(cache.get(key) is not None for key in "acd")
+    assert cache.stats()["evictions"] == 1
+
+
+def test_cache_keys_carry_the_model_version():
+    cache = PredictionCache()
+    contents = b"image bytes"
+    cache.put(PredictionCache.make_key("model.h5@aaaa", contents), result(1))
+
+    assert cache.get(PredictionCache.make_key("model.h5@aaaa", contents)) == result(1)
+    assert cache.get(PredictionCache.make_key("model.h5@bbbb", contents)) is None
+    # Parts are length-prefixed, so moving bytes between parts changes the key
+    assert PredictionCache.make_key("ab", "c") != PredictionCache.make_key("a", "bc")
+    assert PredictionCache.make_key("v1", "tta", contents) != PredictionCache.make_key("v1", contents)
+
+
+def test_cache_survives_a_restart_on_disk(tmp_path):
+    cache = PredictionCache(disk_dir=str(tmp_path))
+    cache.put("key", result(1))
+    flush(cache)
+
+    restarted = PredictionCache(disk_dir=str(tmp_path))
+    assert asyncio.run(restarted.get_async("key")) == result(1)
+    assert restarted.get("key") == result(1)
+    assert restarted.stats()["disk_hits"] == 1 and restarted.stats()["hits"] == 1
+    assert restarted.get("other") is None
+
+
+def test_expired_disk_entries_are_removed(tmp_path, clock):
+    cache = PredictionCache(ttl_seconds=10, disk_dir=str(tmp_path))
+    cache.put("key", result(1))
+    flush(cache)
+
+    clock[0] += 11
+    restarted = PredictionCache(ttl_seconds=10, disk_dir=str(tmp_path))
+    assert restarted.get("key") is None
+    assert not list(tmp_path.iterdir())
+
+
+def test_disk_tier_drops_its_oldest_files(tmp_path):
+    size_mb = entry_mb(result(0, size=1000))
+    cache = PredictionCache(disk_dir=str(tmp_path), disk_max_mb=5.5 * size_mb)
+    for i in range(8):
+        cache.put(f"key{i}", result(i, size=1000))
+        flush(cache)
+        # Distinct modification times, oldest first
+        serving.os.utime(tmp_path / f"key{i}.json", (i, i))
+
+    remaining = sorted(path.name for path in tmp_path.iterdir())
+    assert 0 < len(remaining) <= 5
+    assert "key7.json" in remaining and "key0.json" not in remaining
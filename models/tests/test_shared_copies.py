@@ -0,0 +1,26 @@
+"""Every service is built from its own Docker context, so shared modules are copied into each one"""
+import os
+
+import pytest
+
+from conftest import MODELS_DIR
+
+# Module -> the services that keep a copy of it
+SHARED_MODULES = {
+    "serving.py": ("breed-identification", "breeding_model", "disease-qna", "disease_identify"),
+    "serve.py": ("breed-identification", "breeding_model", "disease-qna", "disease_identify"),
+    "backends.py": ("breed-identification", "disease_identify"),
+    "artifacts.py": ("breeding_model", "disease-qna"),
+}
+
+
+@pytest.mark.parametrize("name", sorted(SHARED_MODULES))
+def test_copies_are_identical(name):
+    copies = {}
+    for service in SHARED_MODULES[name]:
+        with open(os.path.join(MODELS_DIR, service, name), "rb") as f:
+            copies[service] = f.read()
+    reference = SHARED_MODULES[name][0]
+    different = sorted(service for service, content in copies.items() if content != copies[reference])
+    assert not different, (f"{name} in {', '.join(different)} differs from {reference}/{name}; "
+                           f"make the change in one copy and copy it to the others")
@@ -0,0 +1,151 @@
+"""The identity index: exact and IVF search, persistence, and training in the background"""
+import threading
+
+import numpy as np
+import pytest
+
+import vector_index
+from vector_index import VectorIndex
+
+DIM = 16
+
+
+def embeddings(n, seed=0):
+    return np.random.default_rng(seed).standard_normal((n, DIM)).astype(np.float32)
+
+
+def test_training_does_not_hold_the_lock(tmp_path, monkeypatch):
+    monkeypatch.setattr(vector_index, "IVF_MIN_ROWS", 64)
+    started, release = threading.Event(), threading.Event()
+    kmeans = vector_index.spherical_kmeans
+
+    def slow_kmeans(*args, **kwargs):
+        started.set()
+        assert release.wait(10)
+        return kmeans(*args, **kwargs)
+
+    monkeypatch.setattr(vector_index, "spherical_kmeans", slow_kmeans)
+    index = VectorIndex(str(tmp_path / "index"))
+    vectors = embeddings(80)
+    for i in range(63):
+        index.add(f"cow-{i}", vectors[i], "v1")
+
+    # The 64th enrollment starts training the IVF lists and returns
+    assert index.add("cow-63", vectors[63], "v1") == 1
+    assert started.wait(10)
+
+    # Meanwhile enrollments and searches go ahead
+    for i in range(64, 80):
+        index.add(f"cow-{i}", vectors[i], "v1")
+    results, info = index.search(vectors[70], k=1)
+    assert results[0]["animal_id"] == "cow-70" and info["exact"]
+
+    assert index.stats()["ivf_lists"] == 0
+
+    release.set()
+    assert index.wait_for_training(10)
+
+    stats = index.stats()
+    assert stats["images"] == 80 and stats["ivf_lists"] == 8
+    # Rows enrolled during training were assigned to the new lists too
+    expected = vector_index.nearest_centroids(vector_index.normalize(vectors), index._centroids)
+    np.testing.assert_array_equal(index._lists[:80], expected)
+    for i in (5, 63, 79):
+        results, info = index.search(vectors[i], k=1, nprobe=8)
+        assert results[0]["animal_id"] == f"cow-{i}" and not info["exact"]
+
+    reopened = VectorIndex(str(tmp_path / "index"))
+    assert reopened.stats() == stats
+
+
+def brute_force(vectors, ids, query, k):
+    """The k best animals by their best-matching image, by a plain scan"""
+    scores = vector_index.normalize(vectors) @ vector_index.normalize(query[None])[0]
+    best = {}
+    for i in np.argsort(-scores, kind="stable"):
+        best.setdefault(ids[i], float(scores[i]))
+    return list(best.items())[:k]
+
+
+def clustered(n, n_clusters, seed):
+    """Embeddings around ``n_clusters`` directions, as images of similar animals are"""
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((n_clusters, DIM))
+    return (centres[rng.integers(0, n_clusters, n)] + 0.3 * rng.standard_normal((n, DIM))).astype(np.float32)
+
+
+def test_exact_search_ranks_animals_by_their_best_image(tmp_path):
+    index = VectorIndex(str(tmp_path / "index"))
+    assert index.search(embeddings(1)[0]) == ([], {"exact": True, "rows_scanned": 0})
+    vectors = embeddings(90, seed=1)
+    # Three images for each of 30 animals
+    ids = [f"cow-{i % 30}" for i in range(len(vectors))]
+    for animal_id, vector in zip(ids, vectors):
+        index.add(animal_id, vector, "v1")
+
+    for query in embeddings(10, seed=2):
+        results, info = index.search(query, k=5)
+        assert info == {"exact": True, "rows_scanned": 90}
+        expected = brute_force(vectors, ids, query, 5)
+        assert [result["animal_id"] for result in results] == [animal_id for animal_id, _ in expected]
+        np.testing.assert_allclose([result["similarity"] for result in results],
+                                   [similarity for _, similarity in expected], rtol=1e-5)
+        assert all(result["images"] == 3 for result in results)
+
+    with pytest.raises(ValueError):
+        index.search(np.ones(DIM + 1))
+    with pytest.raises(ValueError):
+        index.add("cow\n1", vectors[0], "v1")
+
+
+def test_ivf_search_recalls_the_exact_neighbours(tmp_path, monkeypatch):
+    monkeypatch.setattr(vector_index, "IVF_MIN_ROWS", 400)
+    index = VectorIndex(str(tmp_path / "index"), nprobe=4)
+    vectors = clustered(600, 20, seed=3)
+    for i, vector in enumerate(vectors):
+        index.add(f"cow-{i}", vector, "v1")
+    assert index.wait_for_training(30)
+    assert index.stats()["ivf_lists"] == 20
+
+    k, hits, queries = 10, 0, clustered(50, 20, seed=4)
+    for query in queries:
+        exact, exact_info = index.search(query, k=k, exact=True)
+        approximate, info = index.search(query, k=k)
+        assert exact_info["exact"] and not info["exact"]
+        assert info["rows_scanned"] < len(vectors)
+        assert [result["animal_id"] for result in exact] == \
+            [animal_id for animal_id, _ in brute_force(vectors, [f"cow-{i}" for i in range(600)], query, k)]
+        hits += len({r["animal_id"] for r in exact} & {r["animal_id"] for r in approximate})
+    assert hits / (k * len(queries)) >= 0.9
+
+    # Probing every list finds exactly what the scan finds
+    for query in queries[:10]:
+        assert index.search(query, k=k, nprobe=20)[0] == index.search(query, k=k, exact=True)[0]
+
+
+def test_an_index_survives_a_reload(tmp_path, monkeypatch):
+    monkeypatch.setattr(vector_index, "IVF_MIN_ROWS", 100)
+    monkeypatch.setattr(vector_index, "INITIAL_CAPACITY", 64)
+    directory = str(tmp_path / "index")
+    index = VectorIndex(directory)
+    vectors = clustered(150, 10, seed=5)
+    # Grows the files past their initial capacity and trains once
+    for i, vector in enumerate(vectors):
+        index.add(f"cow-{i % 50}", vector, "v1")
+    assert index.wait_for_training(30)
+    stats = index.stats()
+    queries = clustered(5, 10, seed=6)
+    answers = [index.search(query, k=3)[0] for query in queries]
+
+    reopened = VectorIndex(directory)
+    assert reopened.stats() == stats
+    assert reopened.ids == index.ids and reopened.images == index.images
+    assert reopened.trained_rows == index.trained_rows == 100
+    # Rows enrolled after training are grouped into their lists on open, so fewer may be scanned
+    assert [reopened.search(query, k=3)[0] for query in queries] == answers
+
+    # An id line cut off by a crash is dropped on the next open
+    with open(tmp_path / "index" / "ids.txt", "a", encoding="utf-8") as f:
+        f.write("cow-partial")
+    assert len(VectorIndex(directory)) == 150
+    assert VectorIndex(directory).search(queries[0], k=3)[0] == answers[0]